@@ -13,8 +13,10 @@ class Image(admin.ModelAdmin):
         'description',
         'width',
         'height',
+        'status',
         'date_created',
         'date_updated',
     )
     empty_value_display = '-empty-'
+    list_filter = ('status',)
     exclude = ('width', 'height',)
@@ -3,12 +3,13 @@ import os
 from django.db import models
 
 from api.utils.img import Util
+from api.utils.storage import get_storage
 
 
 class HeifmgurModelField(models.FileField):
     """Custom Model FileField with HEIF support
     Essentially a copy of ImageField with width_field, height_field update 
-    functionality
+    functionality. Files go to the HEIFMGUR_STORAGE backend by default
     """
 
     validators = [Util.is_image_validator]
@@ -16,6 +17,7 @@ class HeifmgurModelField(models.FileField):
 
     def __init__(self, verbose_name=None, name=None, width_field=None, height_field=None, **kwargs):
         self.width_field, self.height_field = width_field, height_field
+        kwargs.setdefault('storage', get_storage)
         super().__init__(verbose_name, name, **kwargs)
 
     def check(self, **kwargs):
@@ -26,6 +28,9 @@ class HeifmgurModelField(models.FileField):
 
     def deconstruct(self):
         name, path, args, kwargs = super().deconstruct()
+        # The backend is a setting, not part of the schema
+        if kwargs.get('storage') is get_storage:
+            del kwargs['storage']
         if self.width_field:
             kwargs['width_field'] = self.width_field
         if self.height_field:
@@ -0,0 +1,268 @@
+import json
+import logging
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import connection, connections, transaction
+
+from .models import Image
+from .tasks import find_duplicate, process_image, release_files
+from .utils.cache import stream_digest
+from .utils.img import Util
+
+logger = logging.getLogger(__name__)
+
+DONE_STATUSES = ('created', 'duplicate', 'queued')
+
+
+def path_item(path: str) -> tuple:
+    """Ingestion item of a local file"""
+    return str(path), None, lambda: File(open(path, 'rb'), name=os.path.basename(path))
+
+
+def url_item(url: str) -> tuple:
+    """Ingestion item of an external URL, fetched once when processed"""
+    return url, url, lambda: Util.fetch_img(
+        url,
+        max_size=settings.HEIFMGUR_URL_MAX_SIZE,
+        spool_size=settings.HEIFMGUR_URL_SPOOL_SIZE)
+
+
+def upload_item(file) -> tuple:
+    """Ingestion item of an uploaded file"""
+    return file.name, None, lambda: file
+
+
+def directory_items(directory: str):
+    """Items of every file below a directory, in a stable order"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            yield path_item(os.path.join(root, name))
+
+
+def manifest_items(manifest: str):
+    """Items of a manifest listing one path or URL per line
+
+    Blank lines and lines starting with # are ignored,
+    relative paths are resolved against the manifest directory
+    """
+    base = Path(manifest).parent
+    with open(manifest) as lines:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith(('http://', 'https://')):
+                yield url_item(line)
+            else:
+                yield path_item(base / line)
+
+
+def tar_items(fileobj):
+    """Items of the regular files of a tar stream
+
+    The stream is read sequentially, every member is spooled
+    to a temporary buffer before it is yielded
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            buffer = SpooledTemporaryFile(max_size=settings.HEIFMGUR_SPILL_SIZE)
+            source = archive.extractfile(member)
+            while chunk := source.read(1024 * 1024):
+                buffer.write(chunk)
+            buffer.seek(0)
+            file = File(buffer, name=os.path.basename(member.name))
+            yield f'tar:{member.name}', None, lambda file=file: file
+
+
+def load_report(path: str) -> tuple:
+    """Sources already ingested according to a previous report
+
+    Returns (done, failed), `failed` maps the sources whose last attempt
+    failed to the id of the Image it left behind, if any
+    """
+    done, failed = set(), {}
+    if not path or not os.path.exists(path):
+        return done, failed
+    with open(path) as report:
+        for line in report:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get('status') in DONE_STATUSES:
+                done.add(result['source'])
+                failed.pop(result['source'], None)
+            elif result.get('status') == 'failed':
+                failed[result['source']] = result.get('id')
+    return done, failed
+
+
+class Ingestor:
+    """Ingest many images at once
+
+    Items are (source, url, opener) tuples. Sources are opened and hashed
+    by up to HEIFMGUR_URL_CONCURRENCY threads, URLs are downloaded through
+    the pooled connections of the fetcher. A batch of pending Images is inserted with bulk_create
+    and then converted in parallel through process_image, so that
+    conversions spread over the image engine workers. Identical sources
+    are converted once and share their files. With `queue` the pending
+    Images are left to the conversion workers instead. All of them are
+    encoded with `profile`, by default the profile of their size.
+    Downloaded URL images are passed to `charge(file)`, which may
+    raise to refuse them.
+
+    With a `report` path every item result is appended to it as a JSON
+    line and items already reported as done are skipped, so that an
+    interrupted run can be resumed. Failed items are retried, the Image
+    of their previous attempt is deleted
+    """
+
+    def __init__(self, workers: int = None, batch_size: int = 100, report: str = None,
+                 queue: bool = False, profile: str = '', charge=None):
+        self.workers = workers or settings.HEIFMGUR_ENGINE_WORKERS or 1
+        self.profile = profile
+        self.charge = charge
+        self.batch_size = batch_size
+        self.report = report
+        self.queue = queue
+        self.done, self.failed = load_report(report)
+
+    def run(self, items) -> list:
+        results = []
+        items = iter(items)
+        executor = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        # Opening is I/O bound and touches no database connection
+        open_executor = ThreadPoolExecutor(settings.HEIFMGUR_URL_CONCURRENCY)
+        try:
+            while batch := list(islice(items, self.batch_size)):
+                batch_results = self.ingest_batch(batch, open_executor, executor)
+                self.write_report(batch_results)
+                results += batch_results
+        finally:
+            open_executor.shutdown()
+            if executor:
+                executor.shutdown()
+        return results
+
+    def ingest_batch(self, batch: list, open_executor: ThreadPoolExecutor,
+                     executor: ThreadPoolExecutor = None) -> list:
+        parallel = executor.map if executor else map
+        results = []
+        pending = []
+        for source, url, opener in batch:
+            if source in self.done:
+                results.append({'source': source, 'status': 'skipped'})
+            else:
+                pending.append((source, url, opener))
+        self.discard_failed([source for source, _, _ in pending])
+
+        opened = list(open_executor.map(self.open_item, pending))
+        # Images converted here are claimed right away, workers skip them
+        initial = Image.Status.PENDING if self.queue else Image.Status.PROCESSING
+        images = []
+        for (source, url, _), (file, digest, error) in zip(pending, opened):
+            if error:
+                results.append({'source': source, 'status': 'failed', 'error': error})
+                continue
+            duplicate = find_duplicate(digest, profile=self.profile) is not None
+            image = Image(
+                url=url,
+                digest=digest,
+                profile=self.profile,
+                status=initial,
+                source=None if duplicate else file)
+            images.append((source, image, duplicate))
+
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Image.objects.bulk_create([image for _, image, _ in images])
+            else:
+                for _, image, _ in images:
+                    image.save()
+        # Sources are in storage now, conversions reopen them from there
+        for file, _, _ in opened:
+            if file is not None:
+                file.close()
+
+        if not self.queue:
+            # Repeated sources wait for the first one and then share its files
+            seen = set()
+            first, repeated = [], []
+            for _, image, _ in images:
+                (repeated if image.digest in seen else first).append(image)
+                seen.add(image.digest)
+            convert = self.convert_threaded if executor else process_image
+            list(parallel(convert, first))
+            list(parallel(convert, repeated))
+
+        for source, image, duplicate in images:
+            results.append(self.result(source, image, duplicate))
+        return results
+
+    def discard_failed(self, sources: list):
+        """Delete the Images left by failed previous attempts of sources"""
+        ids = [self.failed.pop(source) for source in sources if source in self.failed]
+        failed = Image.objects.filter(
+            pk__in=[pk for pk in ids if pk], status=Image.Status.FAILED)
+        for image in failed:
+            release_files(image)
+            image.delete()
+
+    def result(self, source: str, image: Image, duplicate: bool) -> dict:
+        result = {'source': source, 'id': image.pk}
+        if self.queue:
+            result['status'] = 'queued'
+        elif image.status == Image.Status.READY:
+            result['status'] = 'duplicate' if duplicate else 'created'
+        else:
+            result['status'] = 'failed'
+            result['error'] = image.error
+        return result
+
+    def open_item(self, item: tuple) -> tuple:
+        """Open, admit and hash a source, returns (file, digest, error)"""
+        source, url, opener = item
+        file = None
+        try:
+            file = opener()
+            Util.admit_image(
+                file,
+                max_megapixels=settings.HEIFMGUR_MAX_MEGAPIXELS,
+                max_bytes=settings.HEIFMGUR_MAX_IMAGE_BYTES)
+            if url and self.charge:
+                self.charge(file)
+            return file, stream_digest(file), None
+        except Exception as error:
+            if file is not None:
+                file.close()
+            if isinstance(error, ValidationError):
+                error = ' '.join(error.messages)
+            logger.warning('Cannot open %s: %s', source, error)
+            return None, None, str(error)
+
+    @staticmethod
+    def convert_threaded(image: Image):
+        try:
+            process_image(image)
+        finally:
+            # Every executor thread holds its own database connection
+            connections.close_all()
+
+    def write_report(self, results: list):
+        if not self.report:
+            return
+        with open(self.report, 'a') as report:
+            for result in results:
+                if result['status'] != 'skipped':
+                    report.write(json.dumps(result) + '\n')
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Prefetch, prefetch_related_objects
+
+from .models import Image, Rendition
+
+EXPANSIONS = ('parent', 'children', 'ancestors')
+
+# Columns of the compact list representation
+LIST_FIELDS = ('id', 'name', 'picture', 'width', 'height', 'parent_picture',
+               'transform', 'status', 'date_created', 'date_updated')
+
+
+def compact_renditions() -> Prefetch:
+    return Prefetch(
+        'renditions',
+        queryset=Rendition.objects.only(
+            'image_id', 'size', 'picture', 'width', 'height'))
+
+
+def expand_queryset(queryset, expand: set):
+    """Load the expanded relatives of Images along with them
+
+    The parent is joined, children and renditions are prefetched,
+    so the number of queries does not depend on the page size
+    """
+
+    if 'parent' in expand:
+        queryset = queryset.select_related('parent_picture').prefetch_related(
+            Prefetch('parent_picture__renditions',
+                     queryset=compact_renditions().queryset))
+    if 'children' in expand:
+        queryset = queryset.prefetch_related(Prefetch(
+            'children',
+            queryset=Image.objects.only(*LIST_FIELDS).prefetch_related(
+                compact_renditions()).order_by('id')))
+    return queryset
+
+
+def attach_ancestors(images: list, max_depth: int = None):
+    """Set `ancestors` of every Image, nearest first
+
+    A single recursive CTE walks the parent chains of all the Images,
+    stopping after `max_depth` levels so that cycles terminate
+    """
+
+    if max_depth is None:
+        max_depth = settings.HEIFMGUR_LINEAGE_MAX_DEPTH
+    for image in images:
+        image.ancestors = []
+    origins = [
+        image.pk for image in images if image.parent_picture_id is not None]
+    if not origins:
+        return
+
+    quote = connection.ops.quote_name
+    table = quote(Image._meta.db_table)
+    parent = quote(Image._meta.get_field('parent_picture').column)
+    placeholders = ', '.join(['%s'] * len(origins))
+    ancestors = list(Image.objects.raw(
+        f'WITH RECURSIVE lineage (origin, id, depth) AS ('
+        f' SELECT id, {parent}, 1 FROM {table}'
+        f' WHERE id IN ({placeholders}) AND {parent} IS NOT NULL'
+        f' UNION ALL'
+        f' SELECT lineage.origin, image.{parent}, lineage.depth + 1'
+        f' FROM lineage JOIN {table} AS image ON image.id = lineage.id'
+        f' WHERE image.{parent} IS NOT NULL AND lineage.depth < %s'
+        f') SELECT {table}.*, lineage.origin AS lineage_origin'
+        f' FROM lineage JOIN {table} ON {table}.id = lineage.id'
+        f' ORDER BY lineage.origin, lineage.depth',
+        [*origins, max_depth]))
+    prefetch_related_objects(ancestors, compact_renditions())
+
+    by_origin = {image.pk: image for image in images}
+    for ancestor in ancestors:
+        by_origin[ancestor.lineage_origin].ancestors.append(ancestor)
+
+
+def expanded_images(image: Image, expand: set) -> list:
+    """Relatives of an Image included in its expanded representation"""
+
+    related = []
+    if 'parent' in expand and image.parent_picture_id is not None:
+        related.append(image.parent_picture)
+    if 'children' in expand:
+        related += image.children.all()
+    if 'ancestors' in expand:
+        related += image.ancestors
+    return related
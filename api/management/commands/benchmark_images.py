@@ -0,0 +1,197 @@
+import json
+import tempfile
+from contextlib import contextmanager
+from io import BytesIO
+from pathlib import Path
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from PIL import Image
+from rest_framework.test import APIRequestFactory
+from wand.image import Image as Wand
+
+from api.models import Image as ImageModel
+from api.models import Rendition
+from api.utils.bench import compare, generate_corpus, measure
+from api.utils.engine import ImageEngine, set_engine
+from api.utils.probe import probe_dimensions
+from api.utils.profiles import get_profiles
+from api.utils.storage import get_storage
+from api.views import ImageViewSet
+
+STAGES = ('probe', 'decode', 'resize', 'encode', 'profile', 'create')
+
+
+class BenchmarkViewSet(ImageViewSet):
+    """ImageViewSet without throttling"""
+
+    def get_throttles(self):
+        return []
+
+
+@contextmanager
+def picture_storage(storage):
+    """Store the pictures of Images and Renditions in `storage` for a while
+
+    Picture fields build their storage once, at model import
+    """
+
+    fields = [model._meta.get_field('picture') for model in (ImageModel, Rendition)]
+    previous = [field.storage for field in fields]
+    for field in fields:
+        field.storage = storage
+    try:
+        yield
+    finally:
+        for field, field_storage in zip(fields, previous):
+            field.storage = field_storage
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the image pipeline on a generated corpus '
+            'and optionally fail on regressions against a baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=10,
+            help='Timed runs per benchmark')
+        parser.add_argument(
+            '--resolutions', nargs='+', default=['640x480', '1920x1080', '4000x3000'],
+            help='Corpus resolutions as WIDTHxHEIGHT')
+        parser.add_argument(
+            '--qualities', nargs='+', type=int, default=[50, 75, 90],
+            help='HEIF encode qualities')
+        parser.add_argument(
+            '--profiles', nargs='+', default=list(settings.HEIFMGUR_ENCODE_PROFILES),
+            help='HEIF encode profiles')
+        parser.add_argument(
+            '--stages', nargs='+', choices=STAGES, default=list(STAGES),
+            help='Pipeline stages to benchmark')
+        parser.add_argument(
+            '--engine-workers', type=int, default=0,
+            help='Image engine processes, 0 measures jobs in this process')
+        parser.add_argument(
+            '--output', type=Path,
+            help='Write the results as JSON')
+        parser.add_argument(
+            '--baseline', type=Path,
+            help='JSON results to compare against')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='Allowed relative p50 slowdown against the baseline')
+
+    def handle(self, *args, **options):
+        resolutions = [
+            tuple(int(side) for side in resolution.split('x'))
+            for resolution in options['resolutions']]
+        corpus = generate_corpus(resolutions)
+        set_engine(ImageEngine(workers=options['engine_workers']))
+
+        results = []
+        for (width, height), (resolution, data) in zip(resolutions, corpus.items()):
+            for stage in options['stages']:
+                for name, func in self.benchmarks(stage, data, options):
+                    result = measure(
+                        f'{stage}/{name}/{resolution}', func,
+                        iterations=options['iterations'],
+                        resolution=resolution,
+                        megapixels=width * height / 1e6)
+                    results.append(result)
+                    self.report(result)
+
+        if options['output']:
+            options['output'].write_text(json.dumps(results, indent=2))
+
+        if options['baseline']:
+            baseline = json.loads(options['baseline'].read_text())
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError(
+                    'Performance regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions'))
+
+    def report(self, result):
+        self.stdout.write(
+            f'{result["name"]:<36} '
+            f'p50 {result["p50"] * 1000:9.2f}ms '
+            f'p90 {result["p90"] * 1000:9.2f}ms '
+            f'p99 {result["p99"] * 1000:9.2f}ms '
+            f'{result["throughput"]:8.2f}/s '
+            f'rss {result["peak_rss"] / 1024 / 1024:7.1f}MB'
+            + (f' {result["bytes"] / 1024:9.1f}KB' if 'bytes' in result else ''))
+
+    def benchmarks(self, stage: str, data: bytes, options: dict):
+        """Yield (name, func) pairs measuring a stage on one image"""
+
+        if stage == 'probe':
+            yield 'header', lambda: probe_dimensions(BytesIO(data))
+            return
+
+        if stage == 'decode':
+            yield 'wand', lambda: Wand(blob=data).close()
+            yield 'pil', lambda: Image.open(BytesIO(data)).load()
+            return
+
+        decoded = Wand(blob=data)
+        width, height = decoded.width // 2, decoded.height // 2
+
+        if stage == 'resize':
+            def resize_wand():
+                with Wand(image=decoded) as image:
+                    image.resize(width, height)
+
+            pil_image = Image.open(BytesIO(data))
+            pil_image.load()
+            yield 'wand', resize_wand
+            yield 'pil', lambda: pil_image.resize((width, height))
+            return
+
+        if stage == 'encode':
+            for quality in options['qualities']:
+                def encode(quality=quality):
+                    with Wand(image=decoded) as image:
+                        image.compression_quality = quality
+                        image.format = 'heif'
+                        return image.make_blob()
+                yield f'heif-q{quality}', encode
+            return
+
+        if stage == 'profile':
+            profiles = get_profiles()
+            for name in options['profiles']:
+                def encode(profile=profiles.get(name)):
+                    with Wand(image=decoded) as image:
+                        profile.apply(image)
+                        image.format = 'heif'
+                        return image.make_blob()
+                yield name, encode
+            return
+
+        if stage == 'create':
+            yield 'sync', lambda: self.create(data)
+
+    def create(self, data: bytes):
+        """Full perform_create path, rolled back after every call"""
+
+        view = BenchmarkViewSet.as_view({'post': 'create'})
+        with tempfile.TemporaryDirectory() as media_root:
+            storage = dict(settings.HEIFMGUR_STORAGE)
+            storage['OPTIONS'] = {**storage.get('OPTIONS', {}), 'location': media_root}
+            with override_settings(
+                    MEDIA_ROOT=media_root,
+                    HEIFMGUR_STORAGE=storage,
+                    HEIFMGUR_ASYNC_CONVERSION=False,
+                    HEIFMGUR_ENCODE_TEMP_DIR=Path(media_root) / 'tmp'), \
+                    picture_storage(get_storage()):
+                request = APIRequestFactory().post(
+                    '/api/images/',
+                    {'picture': SimpleUploadedFile('benchmark.jpg', data, 'image/jpeg')},
+                    format='multipart')
+                with transaction.atomic():
+                    response = view(request)
+                    transaction.set_rollback(True)
+        if response.status_code != 201:
+            raise CommandError(f'Create failed: {response.data}')
@@ -0,0 +1,60 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.tasks import requeue_stale_images, run_worker
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of worker processes converting pending images to HEIF'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.HEIFMGUR_CONVERSION_WORKERS,
+            help='Number of worker processes',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.HEIFMGUR_CONVERSION_POLL_INTERVAL,
+            help='Seconds to wait when the queue is empty',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is drained',
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        requeued = requeue_stale_images()
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale job(s)')
+
+        if workers == 1:
+            processed = run_worker(options['poll_interval'], options['once'])
+            self.stdout.write(f'Processed {processed} job(s)')
+            return
+
+        # Each forked worker must open its own database connection
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(options['poll_interval'], options['once']),
+                daemon=True)
+            for _ in range(workers)
+        ]
+        self.stdout.write(f'Starting {workers} conversion workers')
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
@@ -0,0 +1,70 @@
+import sys
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ingest import Ingestor, directory_items, manifest_items, tar_items
+
+
+class Command(BaseCommand):
+    help = ('Ingest many images at once from a directory, a manifest of '
+            'paths and URLs, or a tar archive (- reads it from stdin)')
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument(
+            '--directory', type=Path,
+            help='Directory walked recursively')
+        source.add_argument(
+            '--manifest', type=Path,
+            help='File listing one path or URL per line')
+        source.add_argument(
+            '--tar',
+            help='Tar archive, optionally compressed')
+        parser.add_argument(
+            '--workers', type=int, default=settings.HEIFMGUR_ENGINE_WORKERS,
+            help='Images opened and converted in parallel')
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.HEIFMGUR_INGEST_BATCH_SIZE,
+            help='Images inserted per bulk query')
+        parser.add_argument(
+            '--report', type=Path,
+            help='JSON lines report, items it lists as done are skipped')
+        parser.add_argument(
+            '--queue', action='store_true',
+            help='Only store pending images for the conversion workers')
+        parser.add_argument(
+            '--profile', default='', choices=['', *settings.HEIFMGUR_ENCODE_PROFILES],
+            help='Encode profile, chosen by picture size by default')
+
+    def handle(self, *args, **options):
+        with ExitStack() as stack:
+            if options['directory']:
+                if not options['directory'].is_dir():
+                    raise CommandError(f'{options["directory"]} is not a directory')
+                items = directory_items(options['directory'])
+            elif options['manifest']:
+                items = manifest_items(options['manifest'])
+            elif options['tar'] == '-':
+                items = tar_items(sys.stdin.buffer)
+            else:
+                # The archive is read until the last item was ingested
+                items = tar_items(stack.enter_context(open(options['tar'], 'rb')))
+
+            ingestor = Ingestor(
+                workers=options['workers'],
+                batch_size=options['batch_size'],
+                report=options['report'],
+                queue=options['queue'],
+                profile=options['profile'])
+            results = ingestor.run(items)
+
+        for result in results:
+            if result['status'] == 'failed':
+                self.stderr.write(f'{result["source"]}: {result["error"]}')
+        counts = Counter(result['status'] for result in results)
+        self.stdout.write(', '.join(
+            f'{count} {status}' for status, count in sorted(counts.items())) or 'Nothing to ingest')
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from .utils.metrics import (REQUEST_SECONDS, format_breakdown, publish_metrics,
+                            track)
+
+logger = logging.getLogger(__name__)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record the latency of every request and log the slow ones
+
+    Requests slower than HEIFMGUR_SLOW_REQUEST_SECONDS are logged with
+    the time spent in each pipeline stage. Async views stay async.
+    Metrics are published for the other processes to expose
+    """
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            with track() as timings:
+                response = await get_response(request)
+            observe_request(request, response, time.perf_counter() - start, timings)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            with track() as timings:
+                response = get_response(request)
+            observe_request(request, response, time.perf_counter() - start, timings)
+            return response
+    return middleware
+
+
+def observe_request(request, response, elapsed: float, timings: list):
+    match = request.resolver_match
+    REQUEST_SECONDS.observe(
+        elapsed,
+        method=request.method,
+        view=match.view_name if match else '',
+        status=response.status_code)
+    publish_metrics()
+
+    threshold = settings.HEIFMGUR_SLOW_REQUEST_SECONDS
+    if threshold is not None and elapsed >= threshold:
+        logger.warning(
+            'Slow request %s %s %s in %.3fs: %s',
+            request.method, request.get_full_path(), response.status_code,
+            elapsed, format_breakdown(timings) or 'no stages')
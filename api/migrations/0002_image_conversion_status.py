@@ -0,0 +1,28 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='error',
+            field=models.TextField(blank=True, help_text='Reason of the last failed conversion', verbose_name='Conversion error'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='source',
+            field=models.FileField(blank=True, help_text='Original upload awaiting HEIF conversion', null=True, upload_to='sources/%Y/%m/%d', verbose_name='Source file'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], db_index=True, default='ready', help_text='State of the HEIF conversion job', max_length=16, verbose_name='Conversion status'),
+        ),
+    ]
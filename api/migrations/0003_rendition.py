@@ -0,0 +1,35 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:04
+
+import api.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_image_conversion_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField(help_text='Maximum of the rendition width and height', verbose_name='Long edge')),
+                ('picture', api.fields.HeifmgurModelField(height_field='height', verbose_name='Image', width_field='width')),
+                ('width', models.PositiveIntegerField(null=True, verbose_name='Picture width')),
+                ('height', models.PositiveIntegerField(null=True, verbose_name='Picture height')),
+                ('image', models.ForeignKey(help_text='Original picture of the rendition', on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='api.image')),
+            ],
+            options={
+                'verbose_name': 'Rendition',
+                'verbose_name_plural': 'Renditions',
+                'ordering': ('image', 'size'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='rendition',
+            constraint=models.UniqueConstraint(fields=('image', 'size'), name='unique_image_rendition'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_rendition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the uploaded source bytes', max_length=64, null=True, verbose_name='Source digest'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_image_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='parent_picture',
+            field=models.ForeignKey(blank=True, help_text='Specify parent picture', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='api.image'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_image_children'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='transform',
+            field=models.CharField(blank=True, default='', help_text='Canonical parameters the picture was derived from its parent picture with', max_length=255, verbose_name='Transform'),
+        ),
+        migrations.AddConstraint(
+            model_name='image',
+            constraint=models.UniqueConstraint(condition=models.Q(('transform', ''), _negated=True), fields=('parent_picture', 'transform'), name='unique_image_derivation'),
+        ),
+    ]
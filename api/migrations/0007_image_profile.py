@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_image_transform'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='profile',
+            field=models.CharField(blank=True, help_text='HEIF encode profile, chosen by picture size when empty', max_length=16, verbose_name='Encode profile'),
+        ),
+    ]
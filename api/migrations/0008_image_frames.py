@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_image_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='frames',
+            field=models.PositiveIntegerField(default=1, help_text='Number of frames, more than one for animations', verbose_name='Picture frames'),
+        ),
+    ]
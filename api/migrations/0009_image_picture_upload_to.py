@@ -0,0 +1,19 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:01
+
+import api.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_image_frames'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='picture',
+            field=api.fields.HeifmgurModelField(blank=True, height_field='height', help_text='Specify image file', null=True, upload_to='', verbose_name='Image', width_field='width'),
+        ),
+    ]
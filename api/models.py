@@ -5,6 +5,12 @@ from .fields import HeifmgurModelField
 
 class Image(models.Model):
 
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        PROCESSING = 'processing', 'Processing'
+        READY = 'ready', 'Ready'
+        FAILED = 'failed', 'Failed'
+
     name = models.CharField(
         'Picture name',
         help_text='Specify name of the picture',
@@ -22,21 +28,69 @@ class Image(models.Model):
     picture = HeifmgurModelField(
         'Image',
         help_text='Specify image file',
-        upload_to='%Y/%m/%d',
         height_field='height',
         width_field='width',
         null=True,
         blank=True,
     )
 
+    source = models.FileField(
+        'Source file',
+        help_text='Original upload awaiting HEIF conversion',
+        upload_to='sources/%Y/%m/%d',
+        null=True,
+        blank=True,
+    )
+
+    digest = models.CharField(
+        'Source digest',
+        help_text='SHA-256 of the uploaded source bytes',
+        max_length=64,
+        null=True,
+        blank=True,
+        db_index=True,
+    )
+
+    profile = models.CharField(
+        'Encode profile',
+        help_text='HEIF encode profile, chosen by picture size when empty',
+        max_length=16,
+        blank=True,
+    )
+
+    status = models.CharField(
+        'Conversion status',
+        help_text='State of the HEIF conversion job',
+        max_length=16,
+        choices=Status.choices,
+        default=Status.READY,
+        db_index=True,
+    )
+
+    error = models.TextField(
+        'Conversion error',
+        help_text='Reason of the last failed conversion',
+        blank=True,
+    )
+
     parent_picture = models.ForeignKey(
         'self',
         help_text='Specify parent picture',
         on_delete=models.CASCADE,
+        related_name='children',
         null=True,
         blank=True,
     )
 
+    transform = models.CharField(
+        'Transform',
+        help_text='Canonical parameters the picture was derived '
+                  'from its parent picture with',
+        max_length=255,
+        blank=True,
+        default='',
+    )
+
     url = models.CharField(
         'External picture',
         help_text='Specify picture url',
@@ -55,6 +109,12 @@ class Image(models.Model):
         null=True,
     )
 
+    frames = models.PositiveIntegerField(
+        'Picture frames',
+        help_text='Number of frames, more than one for animations',
+        default=1,
+    )
+
     date_created = models.DateTimeField(
         'Upload Date',
         auto_now_add=True,
@@ -69,6 +129,69 @@ class Image(models.Model):
         ordering = ('id',)
         verbose_name = 'Image'
         verbose_name_plural = 'Images'
+        constraints = [
+            # A derived picture is materialized once per parent and transform
+            models.UniqueConstraint(
+                fields=('parent_picture', 'transform'),
+                condition=~models.Q(transform=''),
+                name='unique_image_derivation'),
+        ]
 
     def __str__(self):
         return f'Image #{self.id}'
+
+    @property
+    def version(self) -> str:
+        """Changes whenever the picture or its renditions may have changed"""
+        return str(int(self.date_updated.timestamp() * 1_000_000))
+
+    @property
+    def root(self) -> 'Image':
+        """Original Image that a derived Image was transformed from"""
+        image = self
+        while image.transform and image.parent_picture_id is not None:
+            image = image.parent_picture
+        return image
+
+
+class Rendition(models.Model):
+
+    image = models.ForeignKey(
+        Image,
+        help_text='Original picture of the rendition',
+        on_delete=models.CASCADE,
+        related_name='renditions',
+    )
+
+    size = models.PositiveIntegerField(
+        'Long edge',
+        help_text='Maximum of the rendition width and height',
+    )
+
+    picture = HeifmgurModelField(
+        'Image',
+        height_field='height',
+        width_field='width',
+    )
+
+    width = models.PositiveIntegerField(
+        'Picture width',
+        null=True,
+    )
+
+    height = models.PositiveIntegerField(
+        'Picture height',
+        null=True,
+    )
+
+    class Meta:
+        ordering = ('image', 'size')
+        verbose_name = 'Rendition'
+        verbose_name_plural = 'Renditions'
+        constraints = [
+            models.UniqueConstraint(
+                fields=('image', 'size'), name='unique_image_rendition'),
+        ]
+
+    def __str__(self):
+        return f'Rendition {self.size}px of image #{self.image_id}'
@@ -0,0 +1,34 @@
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class ImagePagination(CursorPagination):
+    """Keyset pagination on id
+
+    Every page is an index range scan without COUNT(*), so its cost does
+    not grow with the table. Requests still using ?offset= are served
+    by LimitOffsetPagination for backwards compatibility
+    """
+
+    ordering = 'id'
+    page_size_query_param = 'limit'
+    max_page_size = 200
+    offset_query_param = 'offset'
+
+    def __init__(self):
+        self.legacy = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.offset_query_param in request.query_params:
+            self.legacy = LimitOffsetPagination()
+            return self.legacy.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.legacy:
+            return self.legacy.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_html_context(self):
+        if self.legacy:
+            return self.legacy.get_html_context()
+        return super().get_html_context()
@@ -1,10 +1,58 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 
-from .models import Image
-from .utils.img import Util
+from .models import Image, Rendition
+from .throttlers import charge_megapixels
+from .utils.img import RENDER_CONTENT_TYPES, Util
+from .utils.transform import TransformError, TransformSpec
 
 
-class ImageSerializer(serializers.ModelSerializer):
+def validate_profile(profile: str) -> str:
+    """Encode profile name, empty to choose by picture size"""
+    if profile and profile not in settings.HEIFMGUR_ENCODE_PROFILES:
+        raise serializers.ValidationError(
+            f'Unknown encode profile {profile}, choose from '
+            f'{", ".join(settings.HEIFMGUR_ENCODE_PROFILES)}')
+    return profile
+
+
+class RenditionSerializer(serializers.ModelSerializer):
+    """
+    Pre-generated downscaled variant of an Image
+    """
+
+    class Meta:
+        model = Rendition
+        fields = ('size', 'picture', 'width', 'height')
+        read_only_fields = fields
+
+
+class ExpandMixin:
+    """
+    Adds the relatives listed in the `expand` context,
+    loaded beforehand by the view, to the representation
+    """
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        expand = self.context.get('expand', ())
+        context = {**self.context, 'expand': ()}
+        if 'parent' in expand:
+            data['parent'] = None
+            if instance.parent_picture_id is not None:
+                data['parent'] = ImageListSerializer(
+                    instance.parent_picture, context=context).data
+        if 'children' in expand:
+            data['children'] = ImageListSerializer(
+                instance.children.all(), many=True, context=context).data
+        if 'ancestors' in expand:
+            data['ancestors'] = ImageListSerializer(
+                getattr(instance, 'ancestors', []), many=True, context=context).data
+        return data
+
+
+class ImageSerializer(ExpandMixin, serializers.ModelSerializer):
     """
     Base Image serializer
     """
@@ -13,6 +61,11 @@ class ImageSerializer(serializers.ModelSerializer):
         required=False,
     )
 
+    renditions = RenditionSerializer(
+        many=True,
+        read_only=True,
+    )
+
     def validate(self, attrs):
         if attrs.get('url', None) and attrs.get('picture', None):
             raise serializers.ValidationError(
@@ -22,22 +75,100 @@ class ImageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 {'error': 'Please provide a URL image file'})
 
-        if attrs.get('url', None):
-            good_url = Util.is_image_and_ready(attrs['url'])
-            if not good_url:
+        if attrs.get('url', None) and self.context.get('fetched'):
+            # Already downloaded by an async view
+            attrs['picture'] = self.context['fetched']
+        elif attrs.get('url', None):
+            # The URL is fetched once here, the same bytes are converted later
+            try:
+                attrs['picture'] = Util.fetch_img(
+                    attrs['url'],
+                    max_size=settings.HEIFMGUR_URL_MAX_SIZE,
+                    spool_size=settings.HEIFMGUR_URL_SPOOL_SIZE)
+            except DjangoValidationError as error:
                 raise serializers.ValidationError(
-                    {'error': 'URL validation error'})
-
-        if attrs.get('picture', None):
+                    {'error': 'URL validation error', 'detail': error.messages})
+        elif attrs.get('picture', None):
             Util.is_image_validator(attrs['picture'])
 
+        Util.admit_image(
+            attrs['picture'],
+            max_megapixels=settings.HEIFMGUR_MAX_MEGAPIXELS,
+            max_bytes=settings.HEIFMGUR_MAX_IMAGE_BYTES)
+        if attrs.get('url', None) and self.context.get('view'):
+            charge_megapixels(self.context['request'], self.context['view'], attrs['picture'])
         return attrs
 
+    def validate_profile(self, profile):
+        return validate_profile(profile)
+
     class Meta:
         model = Image
         fields = ('id', 'name', 'description', 'url', 'picture',
-                  'width', 'height', 'parent_picture', 'date_created', 'date_updated')
-        read_only_fields = ('height', 'width')
+                  'width', 'height', 'frames', 'renditions', 'parent_picture',
+                  'transform', 'profile', 'digest', 'status', 'error',
+                  'version', 'date_created', 'date_updated')
+        read_only_fields = ('height', 'width', 'frames', 'transform', 'status',
+                            'error', 'digest')
+
+
+class ImageListSerializer(ExpandMixin, serializers.ModelSerializer):
+    """
+    Compact Image serializer for the list endpoint
+    """
+
+    renditions = RenditionSerializer(
+        many=True,
+        read_only=True,
+    )
+
+    class Meta:
+        model = Image
+        fields = ('id', 'name', 'picture', 'width', 'height', 'renditions',
+                  'transform', 'status', 'version', 'date_created')
+        read_only_fields = fields
+
+
+class ImageBatchSerializer(serializers.Serializer):
+    """
+    Many uploaded files and URLs ingested at once
+    """
+
+    pictures = serializers.ListField(
+        child=serializers.FileField(),
+        required=False,
+        default=list,
+    )
+
+    urls = serializers.ListField(
+        child=serializers.URLField(),
+        required=False,
+        default=list,
+    )
+
+    profile = serializers.CharField(
+        required=False,
+        default='',
+    )
+
+    def validate_profile(self, profile):
+        return validate_profile(profile)
+
+    def validate_pictures(self, pictures):
+        for picture in pictures:
+            Util.is_image_validator(picture)
+        return pictures
+
+    def validate(self, attrs):
+        count = len(attrs['pictures']) + len(attrs['urls'])
+        if not count:
+            raise serializers.ValidationError(
+                {'error': 'Please provide image files or URLs'})
+        if count > settings.HEIFMGUR_BATCH_MAX_ITEMS:
+            raise serializers.ValidationError(
+                {'error': f'At most {settings.HEIFMGUR_BATCH_MAX_ITEMS} '
+                          'images can be sent at once'})
+        return attrs
 
 
 class ImageUpdateSerializer(serializers.ModelSerializer):
@@ -54,7 +185,9 @@ class ImageUpdateSerializer(serializers.ModelSerializer):
         return parent_picture
 
     class Meta(ImageSerializer.Meta):
-        read_only_fields = ('url', 'picture', 'height', 'width')
+        read_only_fields = ('url', 'picture', 'height', 'width', 'frames',
+                            'renditions', 'transform', 'profile', 'digest',
+                            'status', 'error')
 
 
 class ImageResizeSerializer(serializers.ModelSerializer):
@@ -82,5 +215,51 @@ class ImageResizeSerializer(serializers.ModelSerializer):
     )
 
     class Meta(ImageSerializer.Meta):
-        read_only_fields = ('id', 'name', 'url',
-                            'picture', 'parent_picture', 'description')
+        read_only_fields = ('id', 'name', 'url', 'picture', 'parent_picture',
+                            'description', 'frames', 'renditions', 'transform',
+                            'profile', 'digest', 'status', 'error')
+
+
+class ImageTransformSerializer(serializers.Serializer):
+    """
+    Transform pipeline, operations like {"op": "resize", "width": 800}
+    applied in order: resize, crop, rotate, orient, strip, format, quality
+    """
+
+    operations = serializers.ListField(
+        child=serializers.DictField(),
+    )
+
+    def validate(self, attrs):
+        try:
+            attrs['spec'] = TransformSpec.from_operations(attrs['operations'])
+        except TransformError as error:
+            raise serializers.ValidationError({'operations': str(error)})
+        return attrs
+
+
+class ImageRenderSerializer(serializers.Serializer):
+    """
+    Query parameters of on-the-fly render requests
+    """
+
+    w = serializers.IntegerField(
+        required=False,
+        validators=[ImageResizeSerializer.pixel_dimension],
+    )
+
+    h = serializers.IntegerField(
+        required=False,
+        validators=[ImageResizeSerializer.pixel_dimension],
+    )
+
+    fmt = serializers.ChoiceField(
+        choices=list(RENDER_CONTENT_TYPES),
+        default='heif',
+    )
+
+    def validate(self, attrs):
+        if not attrs.get('w') and not attrs.get('h'):
+            raise serializers.ValidationError(
+                {'error': 'Please provide a width, a height or both'})
+        return attrs
@@ -0,0 +1,375 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Image, Rendition
+from .utils.engine import ImageEngine, set_engine
+from .utils.img import Util, set_resource_limits
+from .utils.metrics import observe_conversion, publish_metrics, stage
+from .utils.storage import local_copy, local_path
+
+logger = logging.getLogger(__name__)
+
+HEIF_EXTENSIONS = ['heic', 'heif']
+# Statuses of an Image whose conversion may still be recorded
+CONVERTING = (Image.Status.PENDING, Image.Status.PROCESSING)
+
+
+class ImageDeleted(Exception):
+    """The Image was deleted while it was being converted"""
+
+
+def convert_image(image: Image) -> Image:
+    """Encode the source of a pending Image into its HEIF picture
+
+    The source is either an uploaded file stored in `Image.source`
+    or the external `Image.url`. Raises ImageDeleted, after releasing
+    the new files, if the Image was deleted in the meantime
+    """
+
+    # An identical upload may have been converted while this one waited
+    original = find_duplicate(image.digest, exclude=image.pk, profile=image.profile)
+    if original:
+        release_file(image.source)
+        share_picture(image, original)
+        return image
+
+    sizes = settings.HEIFMGUR_RENDITION_SIZES
+    renditions = []
+    bytes_in = None
+    if image.source:
+        bytes_in = image.source.size
+        image.source.open('rb')
+        frames = Util.get_frames_from_file(image.source)
+        img_ext = Util.parse_file_extension(image.source.name)
+        # HEIF sources, and animations kept in their format, are stored as is
+        keep = img_ext in HEIF_EXTENSIONS or keeps_format(frames)
+        image.frames = frames if keep else min(frames, settings.HEIFMGUR_MAX_FRAMES)
+        source_path = local_path(image.source)
+        if settings.HEIFMGUR_STREAMING_INGESTION and source_path:
+            picture, renditions = Util.convert_file_with_renditions(
+                source_path,
+                Util.parse_file_name(image.source.name),
+                sizes,
+                to_heif=not keep,
+                directory=settings.HEIFMGUR_ENCODE_TEMP_DIR,
+                profile=image.profile or None,
+                frames=image.frames)
+        else:
+            picture, renditions = Util.convert_with_renditions(
+                image.source, sizes, to_heif=not keep,
+                profile=image.profile or None, frames=image.frames)
+        if keep:
+            image.source.open('rb')
+            image.source.seek(0)
+            picture = image.source.file
+            picture.name = Util.parse_file_name(image.source.name, ext=True)
+    elif image.url:
+        source = Util.fetch_img(
+            image.url,
+            max_size=settings.HEIFMGUR_URL_MAX_SIZE,
+            spool_size=settings.HEIFMGUR_URL_SPOOL_SIZE)
+        bytes_in = source.size
+        frames = Util.get_frames_from_file(source)
+        keep = keeps_format(frames)
+        image.frames = frames if keep else min(frames, settings.HEIFMGUR_MAX_FRAMES)
+        picture, renditions = Util.convert_with_renditions(
+            source, sizes, to_heif=not keep,
+            profile=image.profile or None, frames=image.frames)
+        if keep:
+            source.seek(0)
+            picture = source
+    else:
+        raise ValueError(f'{image} has neither a source file nor a URL')
+
+    if not image.name:
+        image.name = picture.name
+    with stage('store'):
+        image.picture.save(picture.name, picture, save=False)
+    picture.close()
+
+    release_file(image.source)
+    image.status = Image.Status.READY
+    image.error = ''
+    with transaction.atomic():
+        recorded = record_conversion(image, statuses=CONVERTING)
+        if recorded:
+            with stage('store'):
+                save_renditions(image, renditions)
+    if not recorded:
+        release_file(image.picture)
+        for _, rendition in renditions:
+            rendition.close()
+        raise ImageDeleted(f'{image} was deleted during its conversion')
+    observe_conversion(bytes_in, image.picture.size, image.width, image.height)
+    return image
+
+
+def record_conversion(image: Image, statuses: tuple = None) -> bool:
+    """Write the outcome of a conversion with a conditional UPDATE
+
+    Unlike save(), an UPDATE never inserts again a row deleted while it
+    was being converted. Returns False if the row is gone or no longer
+    in one of `statuses`
+    """
+
+    rows = Image.objects.filter(pk=image.pk)
+    if statuses:
+        rows = rows.filter(status__in=statuses)
+    image.date_updated = timezone.now()
+    return bool(rows.update(
+        name=image.name,
+        picture=image.picture.name,
+        source=image.source.name,
+        width=image.width,
+        height=image.height,
+        frames=image.frames,
+        status=image.status,
+        error=image.error,
+        date_updated=image.date_updated))
+
+
+def keeps_format(frames: int) -> bool:
+    """Whether an animation is stored in its own format rather than as HEIF
+
+    Animations over HEIFMGUR_MAX_FRAMES are always converted, cut to the cap
+    """
+
+    return (settings.HEIFMGUR_ANIMATION_FORMAT is None
+            and 1 < frames <= settings.HEIFMGUR_MAX_FRAMES)
+
+
+def find_duplicate(digest: str, exclude: int = None, profile: str = '') -> Image | None:
+    """Oldest converted Image encoded from the same bytes and profile"""
+
+    if not digest:
+        return None
+    return Image.objects.filter(
+        digest=digest,
+        profile=profile,
+        status=Image.Status.READY,
+    ).exclude(pk=exclude).exclude(picture='').order_by('id').first()
+
+
+def share_picture(image: Image, original: Image):
+    """Point an Image at the already encoded files of its duplicate
+
+    Nothing is decoded, encoded or written to storage.
+    Raises ImageDeleted if the Image was deleted in the meantime
+    """
+
+    image.picture = original.picture.name
+    image.width, image.height = original.width, original.height
+    image.frames = original.frames
+    if not image.name:
+        image.name = original.name
+    image.status = Image.Status.READY
+    image.error = ''
+    with transaction.atomic():
+        if not record_conversion(image):
+            raise ImageDeleted(f'{image} was deleted before sharing {original}')
+        Rendition.objects.bulk_create([
+            Rendition(
+                image=image,
+                size=rendition.size,
+                picture=rendition.picture.name,
+                width=rendition.width,
+                height=rendition.height)
+            for rendition in original.renditions.all()])
+
+
+def release_file(file):
+    """Delete a stored file unless another row still references it
+
+    Deduplicated Images and their renditions share files,
+    so a file goes away only with its last reference
+    """
+
+    if not file:
+        return
+    instance = file.instance
+    shared = type(instance).objects.filter(
+        **{file.field.name: file.name}).exclude(pk=instance.pk).exists()
+    if shared:
+        file.close()
+        return
+    file.delete(save=False)
+
+
+def release_files(image: Image):
+    """Release every file of an Image before its deletion
+
+    Children are deleted along with their parent, their files too
+    """
+
+    for child in image.children.all():
+        release_files(child)
+    release_file(image.picture)
+    release_file(image.source)
+    for rendition in image.renditions.all():
+        release_file(rendition.picture)
+
+
+def derive_image(image: Image, transform: str, derive) -> tuple:
+    """Child Image holding a transform of the root original of an Image
+
+    Transforms never stack, they are always applied to the pristine root.
+    `derive(path)` encodes the picture and its renditions from the root
+    picture file, returned as (picture, renditions), and is only called
+    when no child exists yet for the root and `transform`.
+    Returns (child, created)
+    """
+
+    root = image.root
+    child = Image.objects.filter(parent_picture=root, transform=transform).first()
+    if child:
+        return child, False
+
+    with local_copy(root.picture) as path:
+        picture, renditions = derive(path)
+    child = Image(
+        name=root.name,
+        description=root.description,
+        parent_picture=root,
+        transform=transform)
+    with stage('store'):
+        child.picture.save(picture.name, picture, save=False)
+    picture.close()
+    try:
+        with transaction.atomic():
+            child.save()
+    except IntegrityError:
+        # A concurrent identical request materialized the child first
+        child.picture.delete(save=False)
+        for _, rendition in renditions:
+            rendition.close()
+        return Image.objects.get(parent_picture=root, transform=transform), False
+
+    with stage('store'):
+        save_renditions(child, renditions)
+    return child, True
+
+
+def save_renditions(image: Image, renditions: list):
+    """Replace the renditions of an Image with freshly encoded ones"""
+
+    for rendition in image.renditions.all():
+        release_file(rendition.picture)
+    image.renditions.all().delete()
+
+    for size, picture in renditions:
+        rendition = Rendition(image=image, size=size)
+        rendition.picture.save(picture.name, picture, save=False)
+        rendition.save()
+        picture.close()
+
+
+def claim_next_image() -> Image | None:
+    """Atomically move the oldest pending Image to processing
+
+    The conditional UPDATE guarantees that only one worker wins an Image,
+    even when several worker processes poll the same table
+    """
+
+    pending = Image.objects.filter(
+        status=Image.Status.PENDING).order_by('id').values_list('id', flat=True)
+    for pk in pending[:settings.HEIFMGUR_CONVERSION_CLAIM_BATCH]:
+        claimed = Image.objects.filter(
+            pk=pk, status=Image.Status.PENDING).update(
+                status=Image.Status.PROCESSING, date_updated=timezone.now())
+        if claimed:
+            return Image.objects.get(pk=pk)
+    return None
+
+
+def requeue_stale_images(timeout: int = None) -> int:
+    """Return jobs of crashed workers back to the queue"""
+
+    if timeout is None:
+        timeout = settings.HEIFMGUR_CONVERSION_TIMEOUT
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return Image.objects.filter(
+        status=Image.Status.PROCESSING,
+        date_updated__lt=cutoff).update(status=Image.Status.PENDING)
+
+
+def process_image(image: Image) -> bool:
+    """Run a single conversion job and record its outcome
+
+    The source of a failed conversion is released, nothing else
+    references it. A failure never overwrites an Image that is no
+    longer pending or processing
+    """
+
+    try:
+        with stage('convert'):
+            convert_image(image)
+    except ImageDeleted as error:
+        logger.info('%s', error)
+        return False
+    except Exception as error:
+        logger.exception('Conversion of %s failed', image)
+        # The Image may have been converted by another worker meanwhile
+        failed = Image.objects.filter(pk=image.pk, status__in=CONVERTING).update(
+            status=Image.Status.FAILED,
+            error=str(error),
+            date_updated=timezone.now())
+        if failed:
+            release_file(image.source)
+            Image.objects.filter(pk=image.pk).update(source=image.source.name)
+        return False
+    return True
+
+
+def run_worker(poll_interval: float = None, once: bool = False) -> int:
+    """Worker loop that converts pending Images until stopped
+
+    Stale jobs are requeued whenever the queue is empty. Metrics are
+    published for the web process to expose them. With `once`
+    the loop exits as soon as the queue is empty.
+    Returns the number of processed jobs
+    """
+
+    if poll_interval is None:
+        poll_interval = settings.HEIFMGUR_CONVERSION_POLL_INTERVAL
+
+    # Connections inherited from a forked parent must not be reused
+    close_old_connections()
+    # Jobs run one at a time, a single engine process is enough to
+    # enforce the timeout and memory limit
+    engine = None
+    if settings.HEIFMGUR_ENGINE_WORKERS:
+        engine = ImageEngine(
+            workers=1,
+            timeout=settings.HEIFMGUR_ENGINE_TIMEOUT,
+            memory_limit=settings.HEIFMGUR_ENGINE_MEMORY_LIMIT,
+            initializer=set_resource_limits,
+            initargs=(settings.HEIFMGUR_MAGICK_LIMITS,))
+        previous = set_engine(engine)
+    processed = 0
+    try:
+        while True:
+            image = claim_next_image()
+            if image is None:
+                # Jobs of the workers that crashed meanwhile go back to the queue
+                requeued = requeue_stale_images()
+                if requeued:
+                    logger.warning('Requeued %s stale job(s)', requeued)
+                    continue
+                publish_metrics()
+                if once:
+                    return processed
+                time.sleep(poll_interval)
+                continue
+            process_image(image)
+            processed += 1
+            publish_metrics()
+    finally:
+        publish_metrics(force=True)
+        # The engine of the process is back once the worker stops
+        if engine is not None:
+            set_engine(previous)
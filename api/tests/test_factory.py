@@ -62,7 +62,10 @@ settings = {
 }
 
 
-@override_settings(REST_FRAMEWORK=settings)
+@override_settings(
+    REST_FRAMEWORK=settings, HEIFMGUR_ASYNC_CONVERSION=False,
+    HEIFMGUR_THROTTLE_STORE={'BACKEND': 'api.utils.ratelimit.MemoryBucketStore'},
+    HEIFMGUR_METRICS_DIR=None)
 class TestModelFactory(TestCase):
     """Обобществлённый завод для создания моделей"""
 
@@ -1,8 +1,32 @@
+import asyncio
+import json
+import tarfile
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+
 from api.models import Image
+from api.tasks import (ImageDeleted, claim_next_image, process_image,
+                       run_worker, share_picture)
+from api.views import AsyncImageViewSet
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from django.test.client import AsyncRequestFactory
+from PIL import Image as PILImage
 from rest_framework.test import APIRequestFactory
 
-from .test_factory import TestModelFactory
+from .test_factory import TestModelFactory, createFunTestImage
+from .util import ImageServer
 
 
 class ImageURLTests(TestModelFactory):
@@ -14,6 +38,29 @@ class ImageURLTests(TestModelFactory):
         response = self.guest_client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_images_list_cursor(self):
+        """The page /api/images/ is paginated by cursor without COUNT(*)"""
+        url = reverse('images-list')
+        seen = []
+        response = self.guest_client.get(url, {'limit': 2})
+        while True:
+            page = response.json()
+            self.assertNotIn('count', page)
+            seen += [image['id'] for image in page['results']]
+            if not page['next']:
+                break
+            response = self.guest_client.get(page['next'])
+
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), self.number_of_images)
+
+    def test_images_list_offset(self):
+        """The page /api/images/ still accepts limit/offset pagination"""
+        url = reverse('images-list')
+        response = self.guest_client.get(url, {'limit': 2, 'offset': 2})
+        self.assertEqual(response.json()['count'], self.number_of_images)
+        self.assertEqual(len(response.json()['results']), 2)
+
     def test_images_list_post(self):
         """The page/api/images/accepts POST requests"""
 
@@ -57,7 +104,7 @@ class ImageURLTests(TestModelFactory):
 
     def test_images_resize_post(self):
         """The page /api/images/<id>/resize/ accepts POST requests
-        and changes images
+        and derives a resized child from the untouched original
         """
         url = reverse('images-detail', args=[self.image.id])
 
@@ -65,15 +112,144 @@ class ImageURLTests(TestModelFactory):
         name = self.image.picture.name
         response = self.guest_client.post(
             url+'resize/', {'width': 300, 'height': 200})
+        child = Image.objects.get(id=response.json()['id'])
 
         self.image = Image.objects.get(id=self.image.id)
-        new_size = (self.image.width, self.image.height)
-
-        self.assertNotEqual(size, new_size)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(size, (self.image.width, self.image.height))
         self.assertEqual(name, self.image.picture.name)
-        self.assertEqual(300, new_size[0])
-        self.assertEqual(200, new_size[1])
+        self.assertEqual(child.parent_picture_id, self.image.id)
+        self.assertEqual((child.width, child.height), (300, 200))
+
+        # Identical requests, on the child too, reuse the derived child
+        for pk in (self.image.id, child.id):
+            response = self.guest_client.post(
+                reverse('images-resize', args=[pk]),
+                {'width': 300, 'height': 200})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['id'], child.id)
+        self.number_of_images += 1
+
+    def test_images_transform_post(self):
+        """The page /api/images/<id>/transform/ derives a child through
+        a pipeline and reuses it for identical pipelines
+        """
+        url = reverse('images-transform', args=[self.image.id])
+        operations = [
+            {'op': 'crop', 'left': 0, 'top': 0, 'width': 100, 'height': 80},
+            {'op': 'resize', 'width': 50},
+            {'op': 'format', 'format': 'png'}]
+        response = self.guest_client.post(
+            url, {'operations': operations}, content_type='application/json')
+        child = response.json()
+
         self.assertEqual(response.status_code, 201)
+        self.assertEqual((child['width'], child['height']), (50, 40))
+        self.assertEqual(child['transform'], 'crop:0,0,100,80/resize:50x/format:png')
+        self.assertEqual(child['parent_picture'], self.image.id)
+
+        response = self.guest_client.post(
+            url, {'operations': operations}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], child['id'])
+
+        response = self.guest_client.post(
+            url, {'operations': [{'op': 'blur'}]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.number_of_images += 1
+
+    def test_images_render_get(self):
+        """The page /api/images/<id>/render/ returns a resized copy
+        and leaves the original untouched
+        """
+        url = reverse('images-render', args=[self.image.id])
+        size = (self.image.width, self.image.height)
+        response = self.guest_client.get(url, {'w': 50, 'h': 40, 'fmt': 'png'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.image.refresh_from_db()
+        self.assertEqual(size, (self.image.width, self.image.height))
+
+    def test_images_render_get_no_size(self):
+        """The page /api/images/<id>/render/ requires a width or height"""
+        url = reverse('images-render', args=[self.image.id])
+        response = self.guest_client.get(url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_images_detail_conditional_get(self):
+        """The page /api/images/<id>/ answers 304 to a matching ETag"""
+        url = reverse('images-detail', args=[self.image.id])
+        etag = self.guest_client.get(url)['ETag']
+        response = self.guest_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def chain_images(self):
+        """Make every image the parent of the next one"""
+        for pk in range(1, self.number_of_images):
+            Image.objects.filter(pk=pk).update(parent_picture=pk - 1)
+
+    def test_images_detail_expand(self):
+        """The page /api/images/<id>/?expand= inlines the whole lineage
+        with a number of queries that does not depend on its depth
+        """
+        self.chain_images()
+        last = self.number_of_images - 1
+        queries = []
+        for pk in (2, last - 1):
+            url = reverse('images-detail', args=[pk])
+            with CaptureQueriesContext(connection) as context:
+                response = self.guest_client.get(
+                    url, {'expand': 'parent,children,ancestors'})
+            queries.append(len(context))
+            data = response.json()
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['parent']['id'], pk - 1)
+            self.assertEqual([child['id'] for child in data['children']], [pk + 1])
+            self.assertEqual(
+                [ancestor['id'] for ancestor in data['ancestors']],
+                list(range(pk - 1, -1, -1)))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_images_list_expand(self):
+        """The page /api/images/?expand= inlines relatives of a whole page"""
+        self.chain_images()
+        url = reverse('images-list')
+        response = self.guest_client.get(
+            url, {'expand': 'parent,ancestors', 'limit': 100})
+        results = response.json()['results']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(results[0]['parent'])
+        for image in results:
+            self.assertEqual(len(image['ancestors']), image['id'])
+
+        response = self.guest_client.get(url, {'expand': 'siblings'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_images_picture_get(self):
+        """The page /api/images/<id>/picture/ serves the file with
+        validators, conditional GET and byte ranges
+        """
+        url = reverse('images-picture', args=[self.image.id])
+        response = self.guest_client.get(url)
+        content = b''.join(response.streaming_content)
+        etag = response['ETag']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.guest_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.guest_client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[10:20])
+
+        response = self.guest_client.get(url, {'v': self.image.version})
+        self.assertIn('immutable', response['Cache-Control'])
 
     def test_images_id_delete_url(self):
         """The page /api/images/<id>/ works with a DELETE request"""
@@ -87,6 +263,372 @@ class ImageURLTests(TestModelFactory):
         self.assertEqual(count+1, self.number_of_images)
         self.number_of_images -= 1
 
+    @override_settings(HEIFMGUR_RENDITION_SIZES=(128, 512, 2048))
+    def test_images_post_renditions(self):
+        """The page /api/images/ generates renditions smaller than the upload"""
+        url = reverse('images-list')
+        picture = createFunTestImage('renditions', size=(1000, 600))
+        response = self.guest_client.post(url, {'picture': picture})
+        renditions = response.json()['renditions']
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([r['size'] for r in renditions], [128, 512])
+        self.assertEqual(
+            (renditions[1]['width'], renditions[1]['height']), (512, 307))
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_RENDITION_SIZES=(128,), HEIFMGUR_MAX_FRAMES=2)
+    def test_images_post_animation(self):
+        """The page /api/images/ converts GIF and APNG animations into HEIF
+        sequences up to the frame cap, with still renditions of the first frame
+        """
+        frames = [createFunTestImage(f'frame-{index}', size=(300, 200)) for index in range(3)]
+        frames = [PILImage.open(frame) for frame in frames]
+        for format, name in (('GIF', 'animation.gif'), ('PNG', 'animation.png')):
+            with self.subTest(format=format):
+                content = BytesIO()
+                frames[0].save(
+                    content, format, save_all=True, append_images=frames[1:], duration=100)
+                response = self.guest_client.post(reverse('images-list'), {
+                    'picture': SimpleUploadedFile(name, content.getvalue())})
+
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.json()['frames'], 2)
+                self.assertTrue(response.json()['picture'].endswith('.heif'))
+                self.assertEqual(
+                    [r['size'] for r in response.json()['renditions']], [128])
+                self.number_of_images += 1
+
+    def test_images_post_duplicate(self):
+        """The page /api/images/ reuses the files of identical uploads
+        and keeps them until the last Image using them is deleted
+        """
+        url = reverse('images-list')
+        content = createFunTestImage('duplicate').read()
+        responses = [
+            self.guest_client.post(url, {
+                'picture': SimpleUploadedFile('duplicate.jpg', content)})
+            for _ in range(2)]
+        first, second = [
+            Image.objects.get(id=response.json()['id'])
+            for response in responses]
+
+        self.assertEqual(responses[1].status_code, 201)
+        self.assertEqual(first.digest, second.digest)
+        self.assertEqual(first.picture.name, second.picture.name)
+
+        self.guest_client.delete(reverse('images-detail', args=[first.id]))
+        self.assertTrue(second.picture.storage.exists(second.picture.name))
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_images_post_async(self):
+        """The page /api/images/ accepts uploads as pending conversion jobs
+        that are completed by a worker
+        """
+        url = reverse('images-list')
+        picture = createFunTestImage('async', size=(120, 80))
+        response = self.guest_client.post(url, {'picture': picture})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], Image.Status.PENDING)
+        self.assertIsNone(response.json()['width'])
+
+        processed = run_worker(once=True)
+        image = Image.objects.get(id=response.json()['id'])
+
+        self.assertEqual(processed, 1)
+        self.assertEqual(image.status, Image.Status.READY)
+        self.assertEqual((image.width, image.height), (120, 80))
+        self.assertFalse(image.source)
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_images_deleted_during_conversion(self):
+        """Conversions completing after their Image was deleted never
+        bring the row back
+        """
+        url = reverse('images-list')
+        response = self.guest_client.post(url, {
+            'picture': createFunTestImage('deleted', size=(120, 80))})
+        image = Image.objects.get(id=response.json()['id'])
+        self.guest_client.delete(reverse('images-detail', args=[image.id]))
+
+        with self.assertRaises(ImageDeleted):
+            share_picture(image, self.image)
+        self.assertFalse(Image.objects.filter(id=image.id).exists())
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_images_failed_conversion(self):
+        """Failed conversions release their source"""
+        url = reverse('images-list')
+        response = self.guest_client.post(url, {
+            'picture': createFunTestImage('failed', size=(120, 80))})
+        image = Image.objects.get(id=response.json()['id'])
+        source = image.source.name
+
+        with mock.patch('api.tasks.Util.get_frames_from_file', side_effect=ValueError('Broken')):
+            self.assertFalse(process_image(image))
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.Status.FAILED)
+        self.assertFalse(image.source)
+        self.assertFalse(image.source.storage.exists(source))
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_images_failed_after_ready(self):
+        """A failure never overwrites an Image converted by another worker"""
+        response = self.guest_client.post(reverse('images-list'), {
+            'picture': createFunTestImage('raced', size=(120, 80))})
+        image = Image.objects.get(id=response.json()['id'])
+        source = image.source.name
+        Image.objects.filter(pk=image.pk).update(status=Image.Status.READY)
+
+        with mock.patch('api.tasks.Util.get_frames_from_file', side_effect=ValueError('Broken')):
+            self.assertFalse(process_image(image))
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.Status.READY)
+        self.assertTrue(image.source.storage.exists(source))
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_run_worker_requeues_stale(self):
+        """Workers requeue the jobs of crashed workers while they run"""
+        response = self.guest_client.post(reverse('images-list'), {
+            'picture': createFunTestImage('stale', size=(120, 80))})
+        stale = timezone.now() - timedelta(seconds=settings.HEIFMGUR_CONVERSION_TIMEOUT + 1)
+        Image.objects.filter(id=response.json()['id']).update(
+            status=Image.Status.PROCESSING, date_updated=stale)
+
+        with mock.patch('api.tasks.process_image') as process:
+            self.assertEqual(run_worker(once=True), 1)
+        self.assertEqual(process.call_args[0][0].id, response.json()['id'])
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_images_async_views(self):
+        """Async views download URLs on the event loop,
+        other actions of their routes stay synchronous
+        """
+        list_view = AsyncImageViewSet.as_view({'get': 'list', 'post': 'create'})
+        detail_view = AsyncImageViewSet.as_view({'get': 'retrieve'})
+        self.assertTrue(asyncio.iscoroutinefunction(list_view))
+        self.assertFalse(asyncio.iscoroutinefunction(detail_view))
+        self.assertFalse(asyncio.iscoroutinefunction(
+            AsyncImageViewSet.as_view({'post': 'resize'})))
+
+        factory = AsyncRequestFactory()
+        body = createFunTestImage('async-view').read()
+        with ImageServer({'/image.jpg': (200, {'Content-Type': 'image/jpeg'}, body)}) as server:
+            response = async_to_sync(list_view)(factory.post(
+                '/api/images/', {'url': f'{server.url}/image.jpg'},
+                content_type='application/json'))
+        self.assertEqual(response.status_code, 202)
+        image = Image.objects.get(id=response.data['id'])
+        self.assertEqual(image.source.size, len(body))
+
+        response = detail_view(factory.get(f'/api/images/{image.id}/'), pk=image.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], image.id)
+
+        response = async_to_sync(list_view)(factory.get('/api/images/'))
+        self.assertEqual(response.status_code, 200)
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ENGINE_WORKERS=0)
+    def test_images_batch_post(self):
+        """The page /api/images/batch/ ingests many uploads at once
+        and converts identical ones only once
+        """
+        url = reverse('images-batch')
+        content = createFunTestImage('batch').read()
+        pictures = [
+            SimpleUploadedFile('first.jpg', content),
+            SimpleUploadedFile('second.jpg', content),
+            createFunTestImage('batch-other')]
+        response = self.guest_client.post(url, {'pictures': pictures})
+        results = response.json()['results']
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [result['status'] for result in results], ['created'] * 3)
+        first, second, other = [
+            Image.objects.get(id=result['id']) for result in results]
+        self.assertEqual(first.picture.name, second.picture.name)
+        self.assertNotEqual(first.picture.name, other.picture.name)
+        self.assertEqual(other.status, Image.Status.READY)
+        self.number_of_images += 3
+
+    def test_images_batch_post_empty(self):
+        """The page /api/images/batch/ needs at least one image"""
+        response = self.guest_client.post(reverse('images-batch'), {})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(HEIFMGUR_SLOW_REQUEST_SECONDS=0)
+    def test_metrics_get(self):
+        """The page /metrics exposes request and stage metrics, slow
+        requests are logged with their stage breakdown
+        """
+        with self.assertLogs('api.middleware', 'WARNING') as logs:
+            self.guest_client.post(reverse('images-list'), {})
+        self.assertIn('validate=', logs.output[0])
+
+        response = self.guest_client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn(
+            'heifmgur_request_seconds_count{method="POST",view="images-list",status="400"}',
+            body)
+        self.assertIn('heifmgur_stage_failures_total{stage="validate",type="ValidationError"}', body)
+
+    def test_images_post_unknown_profile(self):
+        """The page /api/images/ rejects encode profiles not configured"""
+        response = self.guest_client.post(reverse('images-list'), {
+            'url': 'https://example.com/image.jpg', 'profile': 'lossless'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('profile', response.data)
+
+    @override_settings(HEIFMGUR_MAX_MEGAPIXELS=0.01)
+    def test_images_post_too_large(self):
+        """The page /api/images/ refuses images over the megapixel budget
+        without decoding them
+        """
+        count = Image.objects.count()
+        picture = createFunTestImage('large', size=(200, 100))
+        with mock.patch('api.utils.img.Wand') as wand:
+            response = self.guest_client.post(
+                reverse('images-list'), {'picture': picture})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(wand.called, 'Image was decoded')
+        self.assertEqual(Image.objects.count(), count)
+
+    @override_settings(
+        REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {
+            'action.burst': '5/minute', 'action.sustained': '100/day'}},
+        HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST=0.01)
+    def test_images_post_throttled_by_cost(self):
+        """The page /api/images/ charges uploads by their megapixels"""
+        url = reverse('images-list')
+        # 1 + 0.04 / 0.01 tokens, the whole burst
+        picture = createFunTestImage('costly', size=(200, 200))
+        with mock.patch('api.views.ImageViewSet.create', return_value=Response(status=201)):
+            response = self.guest_client.post(url, {'picture': picture})
+            self.assertEqual(response.status_code, 201)
+            response = self.guest_client.post(url, {'name': 'cheap'})
+        self.assertEqual(response.status_code, 429)
+
+    @override_settings(
+        REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {
+            'action.burst': '5/minute', 'action.sustained': '100/day'}},
+        HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST=0.01,
+        # Fresh buckets, other tests drained those of the class
+        HEIFMGUR_THROTTLE_STORE={'BACKEND': 'api.utils.ratelimit.MemoryBucketStore'},
+        HEIFMGUR_ASYNC_CONVERSION=True)
+    def test_images_post_url_throttled_by_cost(self):
+        """The page /api/images/ charges URL images once downloaded"""
+        url = reverse('images-list')
+        body = createFunTestImage('costly', size=(200, 200)).read()
+        with ImageServer({'/image.jpg': (200, {'Content-Type': 'image/jpeg'}, body)}) as server:
+            response = self.guest_client.post(url, {'url': f'{server.url}/image.jpg'})
+            self.assertEqual(response.status_code, 202)
+            response = self.guest_client.post(url, {'url': f'{server.url}/image.jpg'})
+        self.assertEqual(response.status_code, 429)
+        self.number_of_images += 1
+
+    @override_settings(HEIFMGUR_ENGINE_WORKERS=0)
+    def test_ingest_images_resume(self):
+        """ingest_images skips the items its report lists as done"""
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            for name in ('a', 'b'):
+                (directory / f'{name}.jpg').write_bytes(
+                    createFunTestImage(name).read())
+            (directory / 'broken.jpg').write_bytes(b'not an image')
+            report = directory / 'report.jsonl'
+            options = {
+                'directory': directory, 'report': report,
+                'workers': 1, 'batch_size': 2}
+
+            call_command('ingest_images', stdout=StringIO(), stderr=StringIO(), **options)
+            results = [json.loads(line) for line in report.open()]
+            statuses = {Path(result['source']).name: result['status']
+                        for result in results}
+            self.assertEqual(statuses, {
+                'a.jpg': 'created', 'b.jpg': 'created', 'broken.jpg': 'failed'})
+
+            count = Image.objects.count()
+            call_command('ingest_images', stdout=StringIO(), stderr=StringIO(), **options)
+            # Only the failed item is retried, it leaves no row behind
+            self.assertEqual(Image.objects.count(), count)
+
+    @override_settings(HEIFMGUR_ENGINE_WORKERS=0)
+    def test_ingest_images_retry_failed(self):
+        """A retried conversion replaces the Image of the failed attempt"""
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            (directory / 'a.jpg').write_bytes(createFunTestImage('a').read())
+            report = directory / 'report.jsonl'
+            options = {'directory': directory, 'report': report, 'workers': 1}
+
+            with mock.patch('api.tasks.Util.get_frames_from_file',
+                            side_effect=ValueError('Broken encoder')):
+                call_command('ingest_images', stdout=StringIO(), stderr=StringIO(), **options)
+            failed = json.loads(report.read_text().splitlines()[-1])
+            self.assertEqual(failed['status'], 'failed')
+
+            count = Image.objects.count()
+            call_command('ingest_images', stdout=StringIO(), stderr=StringIO(), **options)
+            self.assertEqual(Image.objects.count(), count)
+            self.assertFalse(Image.objects.filter(pk=failed['id']).exists())
+
+    def test_ingest_images_not_claimable(self):
+        """Images ingested and converted inline are never claimed by workers"""
+        claimed = []
+        with tempfile.TemporaryDirectory() as directory:
+            (Path(directory) / 'a.jpg').write_bytes(createFunTestImage('a').read())
+            with mock.patch('api.ingest.process_image',
+                            side_effect=lambda image: claimed.append(claim_next_image())):
+                call_command('ingest_images', directory=Path(directory), workers=1,
+                             stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(claimed, [None])
+
+    def test_ingest_images_tar(self):
+        """ingest_images closes the tar archive it ingested"""
+        opened = []
+
+        def tracked_open(*args):
+            file = open(*args)
+            opened.append(file)
+            return file
+
+        with tempfile.TemporaryDirectory() as directory:
+            archive = Path(directory) / 'images.tar'
+            with tarfile.open(archive, 'w') as tar:
+                for name in ('a', 'b'):
+                    data = createFunTestImage(name).read()
+                    member = tarfile.TarInfo(f'{name}.jpg')
+                    member.size = len(data)
+                    tar.addfile(member, BytesIO(data))
+            stdout = StringIO()
+            with mock.patch('api.management.commands.ingest_images.open',
+                            side_effect=tracked_open, create=True):
+                call_command('ingest_images', tar=str(archive), queue=True,
+                             stdout=stdout, stderr=StringIO())
+        self.assertIn('2 queued', stdout.getvalue())
+        self.assertTrue(opened and opened[0].closed, 'Archive left open')
+
+    @override_settings(HEIFMGUR_ASYNC_CONVERSION=False)
+    def test_images_post_not_claimable(self):
+        """Uploads converted inline are never claimed by workers"""
+        claimed = []
+        with mock.patch('api.views.process_image',
+                        side_effect=lambda image: claimed.append(claim_next_image())):
+            self.guest_client.post(reverse('images-list'), {
+                'picture': createFunTestImage('claim')})
+        self.assertEqual(claimed, [None])
+
     def tearDown(self):
         """All images get deleted /api/images/<id>/ through DELETE request"""
         images = Image.objects.all()
@@ -1,15 +1,68 @@
+import asyncio
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from io import BytesIO
+from unittest import mock
 from pathlib import Path
 
-from api.utils.img import PILImage, URLImage, Util, WandImage
+from api.utils.bench import compare, generate_image, measure, percentile, reset_peak_rss
+from api.utils.cache import RenderCache
+from api.utils.engine import (EngineError, EngineTimeout, ImageEngine,
+                              get_engine)
+from api.utils.fetch import (AsyncFetcher, Fetcher, FetchError, FetchTimeout,
+                             FetchTooLarge)
+from api.utils.http import RangeNotSatisfiable, parse_range
+from api.utils.img import PILImage, URLImage, Util, WandImage, _job_dimensions
+from api.utils.metrics import (STAGE_FAILURES, STAGE_SECONDS, Registry,
+                               format_breakdown, stage, track)
+from api.utils.probe import probe_dimensions, probe_frames, sniff_image_format
+from api.utils.ratelimit import SQLiteBucketStore
+from api.utils.profiles import ProfileSelector
+from api.utils.storage import ContentAddressedStorage, content_digest
+from api.utils.transform import TransformError, TransformSpec, _job_transform
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from PIL import Image, ImageFile
+from wand.image import Image as Wand
 
-from .util import timer
+from .util import ImageServer, timer
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 MEDIA_DIR = f'{BASE_DIR}/media'
 
 
+def echo_job(data, times=1):
+    return [data * times, b'!'], len(data)
+
+
+def sleep_job(data):
+    time.sleep(5)
+    return [data], None
+
+
+def failing_job(data):
+    raise ValueError('Broken image')
+
+
+def staged_job(data):
+    with stage('test-worker'):
+        return [data], None
+
+
+def init_job(value):
+    global initialized
+    initialized = value
+
+
+def initialized_job(data):
+    return [], initialized
+
+
 class BaseTest(unittest.TestCase):
     image_path = f'{MEDIA_DIR}/logo.png'
     url = 'https://www.w3.org/People/mimasa/test/imgformat/img/w3c_home.jpg'
@@ -32,9 +85,45 @@ class PILImageTest(BaseTest):
         image.convert_to_wand()
         assert image.get().wand, 'Image is not a Wand instance'
 
+    def test_convert_Wand_pixels(self):
+        image = PILImage(self.image_path)
+        original = image.get().convert('RGBA')
+        image.convert_to_wand()
+        back = WandImage(image=image.get())
+        back.convert_to_PIL()
+        assert back.get().tobytes() == original.tobytes(), 'Pixels changed in the handoff'
+
+
+    def test_metadata_without_decode(self):
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as file:
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            file.write(generate_image(64, 32, exif=exif.tobytes()))
+            file.flush()
+            with mock.patch.object(ImageFile.ImageFile, 'load') as load:
+                image = PILImage(file.name)
+                assert (image.format, image.size, image.orientation) == ('JPEG', (64, 32), 6)
+                load.assert_not_called()
+
 
 class WandImageTest(BaseTest):
 
+    def test_metadata_without_decode(self):
+        data = generate_image(64, 32)
+        with mock.patch.object(Wand, 'read') as read:
+            image = WandImage(blob=data)
+            assert (image.format, image.size) == ('JPEG', (64, 32)), 'Wrong metadata'
+            assert image.orientation == 'undefined', 'Wrong orientation'
+            assert _job_dimensions(data) == ([], (64, 32)), 'Wrong dimensions'
+            read.assert_not_called()
+        assert image.get().size == (64, 32), 'Pixels were not decoded on use'
+
+    def test_file_rewound(self):
+        file = BytesIO(generate_image(64, 32))
+        image = WandImage(file=file)
+        assert image.size == (64, 32)
+        assert image.image.size == (64, 32), 'File was not rewound after the ping'
+
     def test_resize(self):
         image = WandImage(filename=self.image_path)
         size = (100, 200)
@@ -55,6 +144,89 @@ class WandImageTest(BaseTest):
         assert image.get().format == 'HEIC', 'Image was not converted to .heic format'
 
 
+class TransformSpecTest(unittest.TestCase):
+
+    def test_key(self):
+        spec = TransformSpec.from_operations([
+            {'op': 'resize', 'width': '800'},
+            {'op': 'quality', 'quality': 80},
+            {'op': 'format', 'format': 'WEBP'},
+            {'op': 'rotate', 'degrees': -90}])
+        same = TransformSpec.from_operations([
+            {'op': 'format', 'format': 'webp'},
+            {'op': 'resize', 'width': 800},
+            {'op': 'rotate', 'degrees': 270},
+            {'op': 'quality', 'quality': 80}])
+        assert spec.key == 'resize:800x/rotate:270/format:webp/quality:80', spec.key
+        assert spec == same and len({spec, same}) == 1, 'Equal specs differ'
+
+    def test_order_matters(self):
+        crop = {'op': 'crop', 'left': 0, 'top': 0, 'width': 10, 'height': 10}
+        resize = {'op': 'resize', 'height': 20}
+        assert (TransformSpec.from_operations([crop, resize])
+                != TransformSpec.from_operations([resize, crop]))
+
+    def test_invalid(self):
+        for steps in (
+                [],
+                [{'op': 'blur'}],
+                [{'op': 'resize'}],
+                [{'op': 'resize', 'width': 0}],
+                [{'op': 'crop', 'left': 0, 'top': 0, 'width': 10}],
+                [{'op': 'format', 'format': 'gif'}],
+                [{'op': 'quality', 'quality': 101}],
+                [{'op': 'rotate', 'degrees': 360}],
+                ['resize']):
+            with self.assertRaises(TransformError, msg=steps):
+                TransformSpec.from_operations(steps)
+
+    def test_apply(self):
+        spec = TransformSpec.from_operations([
+            {'op': 'resize', 'width': 32},
+            {'op': 'crop', 'left': 8, 'top': 0, 'width': 16, 'height': 8},
+            {'op': 'rotate', 'degrees': 90},
+            {'op': 'strip'},
+            {'op': 'format', 'format': 'png'}])
+        with mock.patch.object(Wand, 'read', autospec=True, side_effect=Wand.read) as read, \
+                mock.patch.object(Wand, 'make_blob', autospec=True, side_effect=Wand.make_blob) as encode:
+            blobs, (format, sizes) = _job_transform(generate_image(64, 32), spec=spec)
+        assert read.call_count == 1 and encode.call_count == 1, 'Decoded or encoded twice'
+        assert Image.open(BytesIO(blobs[0])).size == (8, 16)
+        assert format.lower() == 'png' and sizes == []
+
+    def test_apply_renditions(self):
+        spec = TransformSpec.from_operations([{'op': 'rotate', 'degrees': 90}])
+        with mock.patch.object(Wand, 'read', autospec=True, side_effect=Wand.read) as read:
+            blobs, (_, sizes) = _job_transform(generate_image(64, 32), spec=spec, sizes=(16, 100))
+        assert read.call_count == 1, 'Transformed image decoded again for its renditions'
+        assert sizes == [16] and len(blobs) == 2
+
+    def test_apply_crop_outside(self):
+        spec = TransformSpec.from_operations([
+            {'op': 'crop', 'left': 60, 'top': 0, 'width': 10, 'height': 10}])
+        with self.assertRaises(TransformError):
+            _job_transform(generate_image(64, 32), spec=spec)
+
+
+class ProfileSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.selector = ProfileSelector(
+            {'fast': {'quality': 60, 'speed': 9},
+             'archival': {'quality': 95, 'chroma': 444, 'depth': 10}},
+            ((1024, 'fast'), (None, 'archival')))
+
+    def test_select_by_size(self):
+        assert self.selector.select(1024, 768).name == 'fast'
+        assert self.selector.select(4000, 3000).name == 'archival'
+
+    def test_select_requested(self):
+        profile = self.selector.select(640, 480, name='archival')
+        assert (profile.quality, profile.chroma, profile.depth) == (95, '444', 10)
+        with self.assertRaises(ValueError):
+            self.selector.select(640, 480, name='lossless')
+
+
 class URLImageTest(BaseTest):
 
     def test_check_url(self):
@@ -62,6 +234,18 @@ class URLImageTest(BaseTest):
         status = image.check_url()
         assert status == True, 'URL to Image is not available'
 
+    def test_fetch(self):
+        image = URLImage(self.url)
+        buffer = image.fetch(max_size=1024 * 1024)
+        assert image.format == 'jpeg', 'Magic bytes were not sniffed'
+        image.download_img()
+        assert image.buffer is buffer, 'URL was fetched twice'
+
+    def test_fetch_too_large(self):
+        image = URLImage(self.url)
+        with self.assertRaises(ValidationError):
+            image.fetch(max_size=16)
+
     def test_download(self):
         image = URLImage(self.url)
         image.download_img()
@@ -70,6 +254,132 @@ class URLImageTest(BaseTest):
             72, 48), 'URL to Image does not have the correct size'
 
 
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.body = generate_image(16, 16, format='PNG')
+        self.server = ImageServer({
+            '/image.png': (200, {'Content-Type': 'image/png'}, self.body),
+            '/moved': (302, {'Location': '/image.png'}, b''),
+            '/slow': (200, {}, self.slow),
+            '/stream': (200, {}, self.stream),
+        }).__enter__()
+        self.fetcher = Fetcher(read_timeout=0.5, connections_per_host=2)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.__exit__()
+
+    @staticmethod
+    def slow(handler):
+        time.sleep(0.2)
+        handler.send_response(200)
+        handler.send_header('Content-Length', '2')
+        handler.end_headers()
+        time.sleep(1)
+        handler.wfile.write(b'ok')
+
+    @staticmethod
+    def stream(handler):
+        # No Content-Length, the body ends with the connection
+        handler.send_response(200)
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        handler.wfile.write(b'x' * 4096)
+        handler.close_connection = True
+
+    def get(self, path, **kwargs):
+        with self.fetcher.open(self.server.url + path) as response:
+            return response.download(**kwargs).read()
+
+    def test_keep_alive(self):
+        for _ in range(3):
+            assert self.get('/image.png') == self.body
+        assert self.server.connections == 1, 'Connection was not reused'
+
+    def test_max_hosts(self):
+        self.fetcher.max_hosts = 1
+        assert self.get('/image.png') == self.body
+        first = self.fetcher.pool('http', '127.0.0.1', self.server.httpd.server_address[1])
+        self.server.url = self.server.url.replace('127.0.0.1', 'localhost')
+        assert self.get('/image.png') == self.body
+        assert first.closed and len(self.fetcher._pools) == 1, 'Least recently used pool kept'
+
+    def test_redirect(self):
+        assert self.get('/moved') == self.body
+
+    def test_read_timeout(self):
+        start = time.perf_counter()
+        with self.assertRaises(FetchTimeout):
+            self.get('/slow')
+        assert time.perf_counter() - start < 1, 'Read did not time out'
+
+    def test_max_size(self):
+        with self.assertRaises(FetchTooLarge):
+            self.get('/image.png', max_size=16)
+        with self.assertRaises(FetchTooLarge):
+            self.get('/stream', max_size=1024)
+        assert len(self.get('/stream')) == 4096
+
+    def test_connections_per_host(self):
+        threads = [
+            threading.Thread(target=self.get, args=('/image.png',))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.server.peak <= 2, 'Too many concurrent connections to a host'
+        assert self.server.connections <= 2, 'Pooled connections were not reused'
+
+    def test_unsupported_url(self):
+        with self.assertRaises(FetchError):
+            with self.fetcher.open('ftp://example.com/image.png'):
+                pass
+
+    def test_url_image_fetch(self):
+        image = URLImage(f'{self.server.url}/image.png')
+        image.fetch(fetcher=self.fetcher)
+        assert image.format == 'png', 'Magic bytes were not sniffed'
+
+
+class AsyncFetcherTest(FetcherTest):
+    """FetcherTest against AsyncFetcher, on a single event loop"""
+
+    def setUp(self):
+        super().setUp()
+        self.fetcher = AsyncFetcher(read_timeout=0.5, connections_per_host=2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        super().tearDown()
+        self.loop.close()
+
+    async def download(self, url, **kwargs):
+        async with self.fetcher.open(url) as response:
+            return (await response.download(**kwargs)).read()
+
+    def get(self, path, **kwargs):
+        return self.loop.run_until_complete(self.download(self.server.url + path, **kwargs))
+
+    def test_connections_per_host(self):
+        async def download_many():
+            await asyncio.gather(*(
+                self.download(f'{self.server.url}/image.png') for _ in range(8)))
+        self.loop.run_until_complete(download_many())
+        assert self.server.peak <= 2, 'Too many concurrent connections to a host'
+        assert self.server.connections <= 2, 'Pooled connections were not reused'
+
+    def test_unsupported_url(self):
+        with self.assertRaises(FetchError):
+            self.loop.run_until_complete(self.download('ftp://example.com/image.png'))
+
+    def test_url_image_fetch(self):
+        image = URLImage(f'{self.server.url}/image.png')
+        self.loop.run_until_complete(image.fetch_async(fetcher=self.fetcher))
+        assert image.format == 'png', 'Magic bytes were not sniffed'
+
+
 class UtilTest(BaseTest):
 
     def test_parse_file_name(self):
@@ -90,10 +400,388 @@ class UtilTest(BaseTest):
         size = {'width': 500, 'height': 500}
         Util.resize_image_PIL(self.image_path, **size)
 
+    def test_admit_image(self):
+        with open(self.image_path, 'rb') as file:
+            Util.admit_image(File(file), max_megapixels=1, max_bytes=1024 * 1024)
+            with self.assertRaises(ValidationError):
+                Util.admit_image(File(file), max_megapixels=0.5)
+            with self.assertRaises(ValidationError):
+                Util.admit_image(File(file), max_bytes=1024)
+
+    @override_settings(HEIFMGUR_ENGINE_WORKERS=0)
+    def test_admit_image_undecodable(self):
+        with self.assertRaises(ValidationError):
+            Util.admit_image(File(BytesIO(b'not an image'), name='x.png'), max_megapixels=1)
+
+    @override_settings(HEIFMGUR_ENGINE_WORKERS=0)
+    def test_convert_animation(self):
+        frames = [Image.new('RGB', (40, 20), color) for color in ('red', 'green', 'blue')]
+        image_io = BytesIO()
+        frames[0].save(image_io, 'GIF', save_all=True, append_images=frames[1:], duration=100)
+        with mock.patch('PIL.Image.open', side_effect=Image.open) as open_image, \
+                mock.patch.object(Wand, 'read', autospec=True, side_effect=Wand.read) as read:
+            picture, renditions = Util.convert_with_renditions(
+                File(image_io, name='animation.gif'), (10,), frames=3)
+        assert open_image.call_count == 1 and not read.called, 'Animation decoded twice'
+        assert [size for size, _ in renditions] == [10]
+        assert picture.name == 'animation.heif'
+
     def get_dimensions_from_path(self):
         dimensions = Util.get_dimensions(self.image_path)
         assert dimensions == (1460, 366)
 
 
+class ProbeTest(BaseTest):
+    heif_path = f'{MEDIA_DIR}/logo.heif'
+
+    def test_probe_png(self):
+        with open(self.image_path, 'rb') as file:
+            assert probe_dimensions(file) == (1460, 366), 'PNG IHDR not parsed'
+
+    def test_probe_heif(self):
+        with open(self.heif_path, 'rb') as file:
+            dimensions = probe_dimensions(file)
+            assert file.tell() == 0, 'File position was not restored'
+        assert dimensions == WandImage(filename=self.heif_path).get().size, \
+            'HEIF ispe does not match decoded dimensions'
+
+    def test_probe_jpeg(self):
+        image_io = BytesIO()
+        Image.new('RGB', (321, 123)).save(image_io, 'JPEG', progressive=True)
+        assert probe_dimensions(image_io) == (321, 123), 'JPEG SOF not parsed'
+
+    def test_probe_gif_screen(self):
+        image_io = BytesIO()
+        Image.new('RGB', (400, 300)).save(image_io, 'GIF')
+        data = bytearray(image_io.getvalue())
+        # A logical screen of 1x1 pixels must not hide the frame size
+        data[6:10] = b'\x01\x00\x01\x00'
+        assert probe_dimensions(BytesIO(data)) == (400, 300), 'GIF frames not read'
+
+    def test_probe_frames(self):
+        frames = [Image.new('RGB', (40, 20), color) for color in ('red', 'green', 'blue')]
+        for format in ('GIF', 'PNG'):
+            image_io = BytesIO()
+            frames[0].save(image_io, format, save_all=True, append_images=frames[1:], duration=100)
+            assert probe_frames(image_io) == 3, f'{format} frames not counted'
+            assert image_io.tell() == len(image_io.getvalue()), 'File position was not restored'
+        with open(self.image_path, 'rb') as file:
+            assert probe_frames(file) == 1
+        with open(self.heif_path, 'rb') as file:
+            assert probe_frames(file) == 1
+
+    def test_sniff_image_format(self):
+        with open(self.image_path, 'rb') as file:
+            assert sniff_image_format(file.read(32)) == 'png'
+        with open(self.heif_path, 'rb') as file:
+            assert sniff_image_format(file.read(32)) == 'heif'
+        assert sniff_image_format(b'<html></html>') is None
+
+    def test_probe_unknown(self):
+        assert probe_dimensions(BytesIO(b'not an image')) is None
+
+    @timer
+    def test_get_dimensions_probe(self):
+        """Completes in 0.0056 secs for 100 probes """
+        with open(self.heif_path, 'rb') as file:
+            for _ in range(100):
+                Util.get_dimensions_from_file(File(file))
+
+    @timer
+    def test_get_dimensions_wand(self):
+        """Full decode for comparison with test_get_dimensions_probe """
+        for _ in range(100):
+            image = WandImage(filename=self.heif_path)
+            image.get().size
+
+
+class ImageEngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = ImageEngine(workers=2, timeout=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.shutdown()
+
+    def test_run(self):
+        blobs, meta = self.engine.run(echo_job, b'heif', times=2)
+        assert blobs == [b'heifheif', b'!'] and meta == 4, 'Wrong job result'
+
+    def test_inline(self):
+        blobs, _ = ImageEngine(workers=0).run(echo_job, b'heif')
+        assert blobs == [b'heif', b'!'], 'Wrong inline job result'
+
+    def test_inline_error(self):
+        with self.assertRaises(EngineError):
+            ImageEngine(workers=0).run(failing_job, b'')
+
+    def test_settings_reset(self):
+        with override_settings(HEIFMGUR_ENGINE_WORKERS=0):
+            engine = get_engine()
+            assert engine.workers == 0, 'Engine ignores the overridden settings'
+        assert get_engine() is not engine, 'Engine outlives the overridden settings'
+
+    def test_initializer(self):
+        engine = ImageEngine(workers=1, initializer=init_job, initargs=('worker',))
+        try:
+            _, meta = engine.run(initialized_job)
+        finally:
+            engine.shutdown()
+        assert meta == 'worker', 'Worker was not initialized'
+
+    def test_error(self):
+        with self.assertRaises(EngineError):
+            self.engine.run(failing_job, b'')
+
+    def test_worker_stages(self):
+        before = STAGE_SECONDS.count(stage='test-worker')
+        with track() as timings:
+            self.engine.run(staged_job, b'heif')
+        assert STAGE_SECONDS.count(stage='test-worker') == before + 1
+        assert [name for name, _, _ in timings] == ['test-worker']
+
+    def test_timeout(self):
+        with self.assertRaises(EngineTimeout):
+            self.engine.run(sleep_job, b'')
+        blobs, _ = self.engine.run(echo_job, b'ok')
+        assert blobs[0] == b'ok', 'Timed out worker was not replaced'
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        latency = registry.histogram('test_seconds', 'Latency', ('stage',), buckets=(0.1, 1))
+        failures = registry.counter('test_failures_total', 'Failures', ('type',))
+        latency.observe(0.05, stage='decode')
+        latency.observe(0.5, stage='decode')
+        failures.inc(type='Value"Error')
+        lines = registry.render().splitlines()
+        assert '# TYPE test_seconds histogram' in lines
+        assert 'test_seconds_bucket{stage="decode",le="0.1"} 1' in lines
+        assert 'test_seconds_bucket{stage="decode",le="+Inf"} 2' in lines
+        assert 'test_seconds_count{stage="decode"} 2' in lines
+        assert 'test_failures_total{type="Value\\"Error"} 1' in lines
+        with self.assertRaises(ValueError):
+            latency.observe(1, format='heif')
+
+    def test_publish(self):
+        registries = [Registry(), Registry()]
+        for registry in registries:
+            registry.histogram('test_seconds', 'Latency', buckets=(0.1, 1)).observe(0.5)
+            registry.counter('test_total', 'Jobs').inc(2)
+        with tempfile.TemporaryDirectory() as directory:
+            registries[0].publish(directory)
+            registries[0].publish(directory)
+            lines = registries[1].render(directory).splitlines()
+            assert registries[0].render(directory) == registries[0].render(), \
+                'Own published metrics were counted twice'
+        assert 'test_total 4' in lines, 'Published counters were not summed'
+        assert 'test_seconds_bucket{le="1"} 2' in lines, 'Published histograms were not summed'
+
+    def test_stage(self):
+        failures = STAGE_FAILURES.value(stage='test-stage', type='ValueError')
+        with track() as timings:
+            with stage('test-stage'):
+                pass
+            with self.assertRaises(ValueError), stage('test-stage'):
+                raise ValueError('Broken image')
+        assert STAGE_FAILURES.value(stage='test-stage', type='ValueError') == failures + 1
+        assert [error for _, _, error in timings] == [None, 'ValueError']
+        assert format_breakdown(timings).endswith('(failed)')
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_percentile(self):
+        assert percentile([4, 1, 3, 2], 50) == 2.5
+        assert percentile([1, 2, 3, 4, 5], 90) == 4.6
+
+    def test_generate_image(self):
+        data = generate_image(64, 48, seed=1)
+        assert data == generate_image(64, 48, seed=1), 'Corpus is not deterministic'
+        assert probe_dimensions(BytesIO(data)) == (64, 48)
+
+    def test_compare(self):
+        result = measure('noop', lambda: None, iterations=3)
+        slower = dict(result, p50=result['p50'] * 2)
+        assert compare([result], [result], 0.2) == []
+        assert len(compare([slower], [result], 0.2)) == 1, 'Regression not detected'
+
+    @unittest.skipUnless(reset_peak_rss(), 'Peak RSS cannot be reset')
+    def test_peak_rss(self):
+        held = b'x' * 64 * 1024 * 1024
+        del held
+        small = measure('noop', lambda: None, iterations=1)['peak_rss']
+        large = measure('alloc', lambda: b'x' * 64 * 1024 * 1024, iterations=1)['peak_rss']
+        assert small < large, 'Peak of earlier calls reported'
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_parse_range(self):
+        assert parse_range('bytes=0-99', 1000) == (0, 99)
+        assert parse_range('bytes=900-', 1000) == (900, 999)
+        assert parse_range('bytes=-100', 1000) == (900, 999)
+        assert parse_range('bytes=500-5000', 1000) == (500, 999)
+
+    def test_parse_range_ignored(self):
+        assert parse_range(None, 1000) is None
+        assert parse_range('bytes=0-1,5-6', 1000) is None
+        assert parse_range('items=0-1', 1000) is None
+
+    def test_parse_range_unsatisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=1000-', 1000)
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = RenderCache(self.temp_dir.name, max_size=100)
+        self.renders = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def render(self, size=40):
+        self.renders += 1
+        time.sleep(0.05)
+        return b'x' * size
+
+    def test_key(self):
+        key = RenderCache.key('abc', w=10, fmt='png')
+        assert key == RenderCache.key('abc', fmt='png', w=10), 'Key depends on order'
+        assert key != RenderCache.key('abd', w=10, fmt='png'), 'Key ignores source'
+
+    def test_hit(self):
+        path = self.cache.get_or_create('aa11', 'png', self.render)
+        again = self.cache.get_or_create('aa11', 'png', self.render)
+        assert path == again and path.read_bytes() == b'x' * 40
+        assert self.renders == 1, 'Cached entry was rendered again'
+
+    def test_single_flight(self):
+        threads = [
+            threading.Thread(
+                target=self.cache.get_or_create,
+                args=('bb22', 'png', self.render))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.renders == 1, 'Concurrent requests rendered more than once'
+
+    def test_lru_eviction(self):
+        first = self.cache.get_or_create('cc01', 'png', self.render)
+        second = self.cache.get_or_create('cc02', 'png', self.render)
+        # Use the first entry so that the second is the least recent one
+        time.sleep(0.01)
+        self.cache.get_or_create('cc01', 'png', self.render)
+        self.cache.get_or_create('cc03', 'png', self.render)
+        assert first.exists(), 'Recently used entry was evicted'
+        assert not second.exists(), 'Least recently used entry was kept'
+
+    def test_eviction_threshold(self):
+        self.cache.get_or_create('ee01', 'png', self.render)
+        with mock.patch.object(self.cache, 'evict') as evict:
+            self.cache.get_or_create('ee02', 'png', self.render)
+            assert not evict.called, 'Cache was scanned under its maximum size'
+            self.cache.get_or_create('ee03', 'png', self.render)
+            assert evict.called, 'Cache was not trimmed over its maximum size'
+
+    def test_open_evicted(self):
+        get_or_create = self.cache.get_or_create
+
+        def evicted(*args):
+            path = get_or_create(*args)
+            if self.renders == 1:
+                path.unlink()
+            return path
+
+        with mock.patch.object(self.cache, 'get_or_create', side_effect=evicted):
+            with self.cache.open_or_create('dd01', 'png', self.render) as file:
+                assert file.read() == b'x' * 40
+        assert self.renders == 2, 'Evicted entry was not rendered again'
+
+
+class ContentAddressedStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.storage = ContentAddressedStorage(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_layout(self):
+        name = self.storage.save('2026/01/01/photo.HEIC', ContentFile(b'pixels'))
+        digest = content_digest(name)
+        assert name.startswith(f'{digest[:2]}/{digest[2:4]}/{digest}-'), 'Not fanned out'
+        assert name.endswith('.heic')
+        assert self.storage.open(name).read() == b'pixels'
+        assert not list(Path(self.temp_dir.name, 'objects', 'tmp').iterdir()), \
+            'Temporary file left behind'
+
+    def test_dedup(self):
+        first = self.storage.save('a.heic', ContentFile(b'same'))
+        second = self.storage.save('b.heic', ContentFile(b'same'))
+        assert first != second, 'Names must stay unique'
+        obj = Path(self.storage.object_path(content_digest(first)))
+        assert obj.stat().st_nlink == 3, 'Identical content not hardlinked'
+
+        self.storage.delete(first)
+        assert self.storage.open(second).read() == b'same', 'Shared content deleted'
+        self.storage.delete(second)
+        assert not obj.exists(), 'Object kept after its last name'
+
+    def test_legacy_name(self):
+        legacy = Path(self.temp_dir.name, '2026', 'photo.heic')
+        legacy.parent.mkdir()
+        legacy.write_bytes(b'old')
+        assert content_digest('2026/photo.heic') is None
+        self.storage.delete('2026/photo.heic')
+        assert not legacy.exists()
+
+
+class SQLiteBucketStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = f'{self.temp_dir.name}/throttle.sqlite3'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_consume(self):
+        store = SQLiteBucketStore(self.path)
+        assert not store.consume('a', 1, capacity=2, period=60)
+        assert not store.consume('a', 1, capacity=2, period=60)
+        wait = store.consume('a', 1, capacity=2, period=60)
+        assert 0 < wait <= 30, 'Empty bucket let a request through'
+        assert not store.consume('b', 1, capacity=2, period=60), 'Buckets are not per key'
+
+    def test_cost_over_capacity(self):
+        store = SQLiteBucketStore(self.path)
+        assert not store.consume('a', 5, capacity=2, period=60), 'Full bucket refused'
+        # The bucket is 3 tokens in debt, 4 are missing for the next token
+        self.assertAlmostEqual(store.consume('a', 1, capacity=2, period=60), 120, delta=1)
+
+    def test_shared(self):
+        first = SQLiteBucketStore(self.path)
+        second = SQLiteBucketStore(self.path)
+        threads = [
+            threading.Thread(target=store.consume, args=('a', 1, 10, 3600))
+            for store in (first, second) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert second.consume('a', 1, capacity=10, period=3600), 'Charges were lost'
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
 import functools
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 def timer(func):
@@ -23,3 +25,62 @@ def timer(func):
 
         return value
     return wrapper_timer
+
+
+class ImageServer:
+    """Local HTTP/1.1 stand-in for remote image hosts
+
+    Serves `routes`, a dict of path to (status, headers, body), where a
+    callable body is called with the handler to write the response
+    itself. Counts accepted connections and the peak of concurrent
+    requests
+    """
+
+    def __init__(self, routes: dict):
+        self.routes = routes
+        self.connections = 0
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                with server.lock:
+                    server.active += 1
+                    server.peak = max(server.peak, server.active)
+                try:
+                    status, headers, body = server.routes[self.path]
+                    if callable(body):
+                        return body(self)
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,25 +1,125 @@
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from rest_framework.settings import api_settings
 from rest_framework.throttling import AnonRateThrottle
 
+from .models import Image
+from .utils.probe import probe_dimensions
+from .utils.ratelimit import get_throttle_store
 
-class ListThrottleBurst(AnonRateThrottle):
+
+class CostRateThrottle(AnonRateThrottle):
+    """AnonRateThrottle charging requests by cost from shared buckets
+
+    The rate of the scope is a token bucket kept in the
+    HEIFMGUR_THROTTLE_STORE, shared by every process. A request costs
+    one token unless get_cost() tells otherwise
+    """
+
+    def __init__(self):
+        # Rates are read on every request, not once at import
+        self.THROTTLE_RATES = api_settings.DEFAULT_THROTTLE_RATES
+        super().__init__()
+        self.store = get_throttle_store()
+        self.wait_seconds = None
+
+    def get_cost(self, request, view) -> float:
+        return 1
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        self.wait_seconds = self.store.consume(
+            self.key, self.get_cost(request, view), self.num_requests, self.duration)
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+    def charge(self, request, view, cost: float) -> float:
+        """Charge a cost found after the request was let through
+
+        Returns 0 if the bucket affords it or the seconds to wait
+        """
+        if self.rate is None:
+            return 0
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return 0
+        return self.store.consume(key, cost, self.num_requests, self.duration)
+
+
+class EncodeCostRateThrottle(CostRateThrottle):
+    """Charges the megapixels a request makes the encoder decode
+
+    Every HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST megapixels cost one
+    more token. Uploads are measured from their headers, derivations
+    from the stored dimensions of the image. URL images are charged
+    once downloaded, see charge_megapixels()
+    """
+
+    def get_cost(self, request, view) -> float:
+        return 1 + request_megapixels(request, view) / settings.HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST
+
+
+def request_megapixels(request, view) -> float:
+    """Megapixels of the uploaded files or of the image a request derives"""
+
+    pixels = 0
+    for _, files in request.FILES.lists():
+        for file in files:
+            dimensions = probe_dimensions(file)
+            if dimensions:
+                pixels += dimensions[0] * dimensions[1]
+    if view.action in ('resize', 'transform') and view.kwargs.get('pk'):
+        dimensions = Image.objects.filter(pk=view.kwargs['pk']).values_list(
+            'width', 'height').first()
+        if dimensions and all(dimensions):
+            pixels += dimensions[0] * dimensions[1]
+    return pixels / 1e6
+
+
+def charge_megapixels(request, view, file):
+    """Charge the encode cost of a file only known once it was fetched
+
+    URL images are measured from their headers after the download, like
+    uploads are before the request. Raises Throttled when a bucket of
+    the view cannot afford them
+    """
+
+    dimensions = probe_dimensions(file)
+    if not dimensions:
+        return
+    cost = dimensions[0] * dimensions[1] / 1e6 / settings.HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST
+    for throttle in view.get_throttles():
+        if isinstance(throttle, EncodeCostRateThrottle):
+            wait = throttle.charge(request, view, cost)
+            if wait:
+                raise Throttled(wait)
+
+
+class ListThrottleBurst(CostRateThrottle):
     scope = 'list.burst'
 
 
-class ListThrottleSustained(AnonRateThrottle):
+class ListThrottleSustained(CostRateThrottle):
     scope = 'list.sustained'
 
 
-class DetailThrottleBurst(AnonRateThrottle):
+class DetailThrottleBurst(CostRateThrottle):
     scope = 'detail.burst'
 
 
-class DetailThrottleSustained(AnonRateThrottle):
+class DetailThrottleSustained(CostRateThrottle):
     scope = 'detail.sustained'
 
 
-class ActionThrottleBurst(AnonRateThrottle):
+class ActionThrottleBurst(EncodeCostRateThrottle):
     scope = 'action.burst'
 
 
-class ActionThrottleSustained(AnonRateThrottle):
-    scope = 'detail.sustained'
+class ActionThrottleSustained(EncodeCostRateThrottle):
+    scope = 'action.sustained'
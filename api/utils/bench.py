@@ -0,0 +1,138 @@
+import math
+import random
+import resource
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+
+def percentile(samples: list, q: float) -> float:
+    """Percentile of samples with linear interpolation, q in [0, 100]"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    weight = position - lower
+    return ordered[lower] * (1 - weight) + ordered[upper] * weight
+
+
+def reset_peak_rss() -> bool:
+    """Restart the peak resident set size of this process from now
+
+    Only Linux can, returns False elsewhere
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> int:
+    """Peak resident set size in bytes of this process alone
+
+    On Linux it is the peak since the last reset_peak_rss(),
+    elsewhere since the process started
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(name: str, func, iterations: int = 10, warmup: int = 1, **extra) -> dict:
+    """Time `func()` and summarize its latency distribution
+
+    Latencies are in seconds, throughput in calls per second.
+    When `func` returns bytes their size is reported as `bytes`.
+    `peak_rss` is the peak of this process over the timed calls
+    where the platform can reset it, engine workers are not counted
+    """
+    for _ in range(warmup):
+        func()
+
+    reset_peak_rss()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        output = func()
+        samples.append(time.perf_counter() - start)
+    if isinstance(output, bytes):
+        extra['bytes'] = len(output)
+
+    return {
+        'name': name,
+        'iterations': iterations,
+        'mean': sum(samples) / len(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'throughput': len(samples) / sum(samples),
+        'peak_rss': peak_rss(),
+        **extra,
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float, metric: str = 'p50') -> list:
+    """List benchmarks slower than the baseline by more than `tolerance`
+
+    `tolerance` is relative, 0.2 allows a 20% slowdown.
+    Benchmarks missing from the baseline are ignored
+    """
+    reference = {result['name']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = reference.get(result['name'])
+        if not previous or not previous[metric]:
+            continue
+        ratio = result[metric] / previous[metric]
+        if ratio > 1 + tolerance:
+            regressions.append(
+                f'{result["name"]}: {metric} {result[metric]:.4f}s '
+                f'vs {previous[metric]:.4f}s (+{(ratio - 1) * 100:.0f}%)')
+    return regressions
+
+
+def generate_image(width: int, height: int, seed: int = 0, format: str = 'JPEG', **params) -> bytes:
+    """Deterministic photo-like test image
+
+    A gradient with noise and shapes, so that encoders
+    can neither skip it as flat nor choke on pure noise
+    """
+    rand = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.frombytes(
+        'L', (width, height), rand.randbytes(width * height)).point(
+            lambda value: 96 + value // 4)
+    image = Image.merge('RGB', (
+        gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rand.randrange(width), rand.randrange(height)
+        radius = rand.randrange(1, max(2, min(width, height) // 4))
+        color = tuple(rand.randrange(256) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+
+    image_io = BytesIO()
+    image.save(image_io, format, **params)
+    return image_io.getvalue()
+
+
+def generate_corpus(resolutions: list, seed: int = 0) -> dict:
+    """Fixed corpus of JPEG images keyed by resolution name"""
+    return {
+        f'{width}x{height}': generate_image(width, height, seed=seed)
+        for width, height in resolutions}
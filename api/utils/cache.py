@@ -0,0 +1,188 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=1024)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(DIGEST_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file, memoized until the file changes"""
+    stat = os.stat(path)
+    return _file_digest(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+def stream_digest(file) -> str:
+    """SHA-256 of a Django File, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks(DIGEST_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Content addressed on-disk cache of derived images
+
+    Entries are keyed by the digest of the source image and the render
+    parameters and evicted least recently used first once the cache
+    grows over `max_size` bytes. Concurrent requests for the same entry,
+    from threads or processes, wait on a file lock so that it is
+    rendered only once. The total size is counted as entries are
+    written, the cache is only scanned when it goes over `max_size`,
+    and then trimmed to `LOW_WATER` of it
+    """
+
+    LOCK_STRIPES = 64
+    # Share of max_size left once an eviction pass is done
+    LOW_WATER = 0.9
+
+    def __init__(self, root: str, max_size: int):
+        self.root = Path(root)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(source_digest: str, **params) -> str:
+        payload = json.dumps(
+            {'source': source_digest, **params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key: str, ext: str) -> Path:
+        return self.root / key[:2] / f'{key}.{ext}'
+
+    def get_or_create(self, key: str, ext: str, render) -> Path:
+        """Return the cached entry, rendering it with `render()` if missing
+
+        `render` must return the bytes of the derived image
+        """
+
+        path = self.path(key, ext)
+        if self._touch(path):
+            return path
+
+        with self._lock(key):
+            # Another request may have rendered it while we waited
+            if self._touch(path):
+                return path
+            content = render()
+            self._write(path, content)
+
+        total = self._grow(len(content))
+        if total is None or total > self.max_size:
+            self.evict(keep=path)
+        return path
+
+    def open_or_create(self, key: str, ext: str, render):
+        """Open the cached entry for reading, see get_or_create()
+
+        An open entry stays readable once evicted, an entry evicted
+        before it could be opened is rendered again
+        """
+
+        while True:
+            path = self.get_or_create(key, ext, render)
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                continue
+
+    def evict(self, keep: Path = None) -> int:
+        """Delete least recently used entries until under `LOW_WATER`
+
+        The `keep` entry, typically the one just rendered, is never
+        deleted. The size counter is reset to the size left.
+        Returns the number of bytes freed
+        """
+
+        with _FileLock(self.root / 'locks' / 'size.lock'):
+            entries = []
+            total = 0
+            for path in self.root.glob('??/*'):
+                if path.suffix == '.tmp':
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+
+            freed = 0
+            if total > self.max_size:
+                for _, size, path in sorted(entries):
+                    if total - freed <= self.max_size * self.LOW_WATER:
+                        break
+                    if path == keep:
+                        continue
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        continue
+                    freed += size
+            (self.root / 'size').write_text(str(total - freed))
+        return freed
+
+    def _grow(self, size: int) -> int | None:
+        """Add to the size counter, returns the total or None if unknown"""
+        with _FileLock(self.root / 'locks' / 'size.lock'):
+            counter = self.root / 'size'
+            try:
+                total = int(counter.read_text()) + size
+            except (FileNotFoundError, ValueError):
+                return None
+            counter.write_text(str(total))
+        return total
+
+    def _touch(self, path: Path) -> bool:
+        """Mark an entry as recently used, False if it does not exist"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _write(self, path: Path, content: bytes):
+        """Write atomically so readers never see a partial entry"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _lock(self, key: str):
+        return _FileLock(
+            self.root / 'locks' / f'{int(key[:8], 16) % self.LOCK_STRIPES}.lock')
+
+
+class _FileLock:
+    """Exclusive flock held for the duration of a with block"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
@@ -0,0 +1,251 @@
+import atexit
+import multiprocessing
+import queue
+import resource
+import secrets
+import threading
+from multiprocessing.shared_memory import SharedMemory
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .metrics import observe_stage, track
+
+
+class EngineError(Exception):
+    """Image job failed in the engine"""
+
+
+class EngineTimeout(EngineError):
+    """Image job did not complete in time"""
+
+
+def _worker_main(conn, memory_limit: int = None, initializer=None, initargs: tuple = ()):
+    """Loop of an engine worker process
+
+    Receives (job, shared memory name, size, kwargs), runs the job on the
+    payload and answers with the name of a shared memory block holding
+    the resulting blobs, along with the stage timings of the job
+    """
+
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if initializer:
+        initializer(*initargs)
+
+    while True:
+        try:
+            job, name, size, kwargs = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        with track() as timings:
+            try:
+                data = None
+                if size is not None:
+                    payload = SharedMemory(name=name)
+                    try:
+                        data = bytes(payload.buf[:size])
+                    finally:
+                        payload.close()
+
+                blobs, meta = job(data, **kwargs)
+                sizes = [len(blob) for blob in blobs]
+                if blobs:
+                    output = SharedMemory(
+                        name=f'{name}o', create=True, size=max(1, sum(sizes)))
+                    try:
+                        offset = 0
+                        for blob in blobs:
+                            output.buf[offset:offset + len(blob)] = blob
+                            offset += len(blob)
+                    finally:
+                        output.close()
+                conn.send(('ok', sizes, meta, timings))
+            except Exception as error:
+                conn.send(('error', f'{type(error).__name__}: {error}', None, timings))
+
+
+class _Worker:
+
+    def __init__(self, context, memory_limit: int = None, initializer=None, initargs: tuple = ()):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit, initializer, initargs),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ImageEngine:
+    """Runs CPU heavy image jobs in a warm pool of worker processes
+
+    A job is a module level function `job(data: bytes, **kwargs)` returning
+    a list of blobs and a picklable meta value. Payloads and results
+    travel through shared memory, only their names go through the pipes.
+    Jobs working on files take `data=None` and return no blobs.
+    A worker exceeding `timeout` seconds is killed and replaced without
+    affecting the jobs of other workers, `memory_limit` caps the address
+    space of every worker in bytes. `initializer(*initargs)` is called
+    once in every worker, or in this process when jobs run inline
+    with `workers=0`. Stages timed by a job in a worker are recorded
+    in this process
+    """
+
+    def __init__(self, workers: int = 0, timeout: float = None, memory_limit: int = None,
+                 initializer=None, initargs: tuple = ()):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.initializer = initializer
+        self.initargs = initargs
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.workers):
+                self._idle.put(self._spawn())
+            if not self.workers and self.initializer:
+                self.initializer(*self.initargs)
+            self._started = True
+
+    def shutdown(self):
+        with self._lock:
+            while not self._idle.empty():
+                self._idle.get_nowait().kill()
+            self._started = False
+
+    def run(self, job, data: bytes = None, **kwargs) -> tuple:
+        """Run a job on a payload and return its (blobs, meta)"""
+
+        self.start()
+        if not self.workers:
+            # Inline jobs fail the same way as jobs in a worker
+            try:
+                return job(data, **kwargs)
+            except Exception as error:
+                raise EngineError(f'{type(error).__name__}: {error}') from error
+
+        worker = self._idle.get()
+        name = f'hm{secrets.token_hex(6)}'
+        size = None
+        payload = None
+        try:
+            if data is not None:
+                size = len(data)
+                payload = SharedMemory(name=name, create=True, size=max(1, size))
+                payload.buf[:size] = data
+            try:
+                worker.conn.send((job, name, size, kwargs))
+            except OSError:
+                worker = self._replace(worker, name)
+                raise EngineError(f'{job.__name__} worker is gone')
+            if not worker.conn.poll(self.timeout):
+                worker = self._replace(worker, name)
+                raise EngineTimeout(
+                    f'{job.__name__} did not complete in {self.timeout} seconds')
+            try:
+                status, result, meta, timings = worker.conn.recv()
+            except (EOFError, OSError):
+                worker = self._replace(worker, name)
+                raise EngineError(
+                    f'{job.__name__} worker died, memory limit exceeded?')
+        finally:
+            if payload is not None:
+                payload.close()
+                payload.unlink()
+            self._idle.put(worker)
+
+        for timing in timings:
+            observe_stage(*timing)
+        if status == 'error':
+            raise EngineError(result)
+        return self._collect(f'{name}o', result), meta
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self._context, self.memory_limit, self.initializer, self.initargs)
+
+    def _replace(self, worker: _Worker, name: str) -> _Worker:
+        worker.kill()
+        # The killed worker may have left its output behind
+        try:
+            output = SharedMemory(name=f'{name}o')
+        except FileNotFoundError:
+            pass
+        else:
+            output.close()
+            output.unlink()
+        return self._spawn()
+
+    @staticmethod
+    def _collect(name: str, sizes: list) -> list:
+        if not sizes:
+            return []
+        output = SharedMemory(name=name)
+        try:
+            blobs = []
+            offset = 0
+            for size in sizes:
+                blobs.append(bytes(output.buf[offset:offset + size]))
+                offset += size
+        finally:
+            output.close()
+            output.unlink()
+        return blobs
+
+
+_engine = None
+
+
+def get_engine() -> ImageEngine:
+    """Process wide engine configured from Django settings"""
+
+    global _engine
+    if _engine is None:
+        from django.conf import settings
+
+        from .img import set_resource_limits
+        set_engine(ImageEngine(
+            workers=settings.HEIFMGUR_ENGINE_WORKERS,
+            timeout=settings.HEIFMGUR_ENGINE_TIMEOUT,
+            memory_limit=settings.HEIFMGUR_ENGINE_MEMORY_LIMIT,
+            initializer=set_resource_limits,
+            initargs=(settings.HEIFMGUR_MAGICK_LIMITS,)))
+    return _engine
+
+
+def set_engine(engine: ImageEngine | None) -> ImageEngine | None:
+    """Replace the process wide engine, returns the previous one
+
+    The previous engine is shut down, its workers are spawned again
+    if it is set back and used
+    """
+
+    global _engine
+    previous = _engine
+    if previous is not None:
+        previous.shutdown()
+    _engine = engine
+    return previous
+
+
+@receiver(setting_changed)
+def reset_engine(setting, **kwargs):
+    """Drop the engine when a setting it is built from changes"""
+
+    if setting.startswith('HEIFMGUR_ENGINE_') or setting == 'HEIFMGUR_MAGICK_LIMITS':
+        set_engine(None)
+
+
+atexit.register(lambda: _engine and _engine.shutdown())
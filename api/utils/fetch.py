@@ -0,0 +1,660 @@
+import asyncio
+import http.client
+import os
+import ssl
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from urllib.parse import urljoin, urlsplit
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADERS = 100
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class FetchError(Exception):
+    """URL could not be fetched"""
+
+
+class FetchTimeout(FetchError):
+    """Remote host did not answer in time"""
+
+
+class FetchTooLarge(FetchError):
+    """Response body is larger than allowed"""
+
+
+def _split(url: str) -> tuple:
+    """Scheme, host, port and request target of a fetchable URL"""
+
+    parts = urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise FetchError(f'Unsupported URL {url}')
+    try:
+        port = parts.port or DEFAULT_PORTS[parts.scheme]
+    except ValueError:
+        raise FetchError(f'Invalid port in {url}')
+    target = parts.path or '/'
+    if parts.query:
+        target += f'?{parts.query}'
+    return parts.scheme, parts.hostname, port, target
+
+
+class HostPool:
+    """Keep-alive connections to one scheme, host and port
+
+    At most `maxsize` connections are checked out at once,
+    further callers wait for one to be released. Connections released
+    to a closed pool are closed
+    """
+
+    def __init__(self, scheme: str, host: str, port: int, maxsize: int, connect_timeout: float):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.opened = 0
+        self.busy = 0
+        self.closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def acquire(self, timeout: float) -> tuple:
+        """Check out a connection, returns (connection, reused)"""
+
+        if not self._slots.acquire(timeout=max(0, timeout)):
+            raise FetchTimeout(f'No free connection to {self.host}')
+        with self._lock:
+            self.busy += 1
+            if self._idle:
+                return self._idle.pop(), True
+            self.opened += 1
+        try:
+            return self._connect(), False
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def release(self, conn: http.client.HTTPConnection, reusable: bool):
+        with self._lock:
+            if reusable and not self.closed:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        self._release_slot()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _release_slot(self):
+        with self._lock:
+            self.busy -= 1
+        self._slots.release()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except TimeoutError:
+            raise FetchTimeout(f'Connection to {self.host} timed out')
+        except OSError as exc:
+            raise FetchError(f'Cannot connect to {self.host}: {exc}')
+        return conn
+
+
+class _Body:
+    """Spooled buffer of a response body that enforces its size limit
+
+    Bodies larger than `spool_size` are spilled to a temporary file,
+    bodies larger than `max_size` are rejected as soon as the
+    Content-Length or the streamed size tells so
+    """
+
+    def __init__(self, headers, max_size: int = None, spool_size: int = 0):
+        length = headers.get('Content-Length')
+        if max_size and length and length.isdigit() and int(length) > max_size:
+            raise FetchTooLarge(f'Body is larger than {max_size} bytes')
+        self.max_size = max_size
+        self.size = 0
+        self.buffer = SpooledTemporaryFile(max_size=spool_size)
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            raise FetchTooLarge(f'Body is larger than {self.max_size} bytes')
+        self.buffer.write(chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.buffer.seek(0)
+        else:
+            self.buffer.close()
+
+
+class _BaseResponse:
+    """Status, headers and limits shared by Response and AsyncResponse
+
+    `status` and `headers` are those of urllib responses,
+    the body is read with download()
+    """
+
+    def __init__(self, status: int, headers, url: str, deadline: float,
+                 read_timeout: float, max_size: int = None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self._deadline = deadline
+        self._read_timeout = read_timeout
+        self._max_size = max_size
+
+    @property
+    def location(self) -> str | None:
+        """Absolute URL the response redirects to, if any"""
+        location = self.headers.get('Location')
+        if self.status in REDIRECT_STATUSES and location:
+            return urljoin(self.url, location)
+        return None
+
+    def _remaining(self) -> float:
+        """Seconds left to read the body, raises FetchTimeout if none"""
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise FetchTimeout(f'Download of {self.url} took too long')
+        return remaining
+
+    def _body(self, max_size: int = None, spool_size: int = 0) -> _Body:
+        return _Body(self.headers, max_size or self._max_size, spool_size)
+
+
+class Response(_BaseResponse):
+    """Response on a pooled connection"""
+
+    def __init__(self, response: http.client.HTTPResponse, conn: http.client.HTTPConnection,
+                 url: str, deadline: float, read_timeout: float, max_size: int = None):
+        super().__init__(response.status, response.headers, url, deadline, read_timeout, max_size)
+        self._response = response
+        self._conn = conn
+
+    @property
+    def reusable(self) -> bool:
+        """The body was read completely and the server keeps the connection"""
+        return self._response.isclosed() and not self._response.will_close
+
+    def download(self, max_size: int = None, spool_size: int = 0) -> SpooledTemporaryFile:
+        """Read the body into a spooled buffer, see _Body"""
+
+        with self._body(max_size, spool_size) as body:
+            try:
+                while True:
+                    remaining = self._remaining()
+                    if self._conn.sock:
+                        self._conn.sock.settimeout(min(self._read_timeout, remaining))
+                    chunk = self._response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    body.write(chunk)
+            except TimeoutError:
+                raise FetchTimeout(f'Reading {self.url} timed out')
+            except (OSError, http.client.HTTPException) as exc:
+                raise FetchError(f'Reading {self.url} failed: {exc}')
+        return body.buffer
+
+    def discard(self, limit: int = CHUNK_SIZE):
+        """Read and drop a small body, larger ones leave the connection unusable"""
+
+        try:
+            if self._conn.sock:
+                self._conn.sock.settimeout(max(0.001, self._deadline - time.monotonic()))
+            self._response.read(limit)
+        except (OSError, http.client.HTTPException):
+            pass
+
+
+class _BaseFetcher:
+    """Options, host pools and request headers shared by Fetcher and AsyncFetcher
+
+    At most `max_hosts` host pools are kept, the least recently used
+    ones without a checked out connection are closed beyond that
+    """
+
+    pool_class = None
+
+    def __init__(self, connect_timeout: float = 5, read_timeout: float = 15,
+                 total_timeout: float = 120, max_size: int = None,
+                 connections_per_host: int = 4, concurrency: int = 16,
+                 max_redirects: int = 5, headers: dict = None, max_hosts: int = 64):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_size = max_size
+        self.connections_per_host = connections_per_host
+        self.concurrency = concurrency
+        self.max_redirects = max_redirects
+        self.headers = headers or {}
+        self.max_hosts = max_hosts
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pool(self, scheme: str, host: str, port: int):
+        key = (scheme, host, port)
+        with self._lock:
+            if key in self._pools:
+                self._pools.move_to_end(key)
+                return self._pools[key]
+            pool = self._pools[key] = self.pool_class(
+                scheme, host, port,
+                self.connections_per_host,
+                self.connect_timeout)
+            evicted = self._evict()
+        for old in evicted:
+            old.close()
+        return pool
+
+    def _evict(self) -> list:
+        """Drop the least recently used idle pools beyond max_hosts"""
+        evicted = []
+        for key, pool in list(self._pools.items())[:-1]:
+            if len(self._pools) <= self.max_hosts:
+                break
+            if not pool.busy:
+                evicted.append(self._pools.pop(key))
+        return evicted
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), OrderedDict()
+        for pool in pools:
+            pool.close()
+
+    def request_headers(self, headers: dict = None) -> dict:
+        """Headers of a request, those given override the default ones"""
+        return {**self.headers, **(headers or {})}
+
+
+class Fetcher(_BaseFetcher):
+    """HTTP client with per host keep-alive pools and strict limits
+
+    `connect_timeout` bounds the TCP and TLS handshake, `read_timeout`
+    the wait for every read and `total_timeout` the whole request,
+    redirects included. At most `connections_per_host` requests run
+    against one host and `concurrency` requests in total, further
+    requests wait for a free slot within their total timeout
+    """
+
+    pool_class = HostPool
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    @contextmanager
+    def open(self, url: str, headers: dict = None):
+        """GET a URL, following redirects, and yield its Response
+
+        The connection returns to its pool when the body was read
+        completely, otherwise it is closed
+        """
+
+        deadline = time.monotonic() + self.total_timeout
+        if not self._slots.acquire(timeout=self.total_timeout):
+            raise FetchTimeout('Too many concurrent requests')
+        try:
+            for _ in range(self.max_redirects + 1):
+                pool, conn, response = self._request(url, headers, deadline)
+                if response.location:
+                    # Drain small redirect bodies to keep the connection
+                    response.discard()
+                    pool.release(conn, response.reusable)
+                    url = response.location
+                    continue
+                try:
+                    yield response
+                finally:
+                    pool.release(conn, response.reusable)
+                return
+            raise FetchError(f'More than {self.max_redirects} redirects')
+        finally:
+            self._slots.release()
+
+    def _request(self, url: str, headers: dict, deadline: float) -> tuple:
+        scheme, host, port, target = _split(url)
+        pool = self.pool(scheme, host, port)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            conn, reused = pool.acquire(remaining)
+            try:
+                conn.sock.settimeout(max(0.001, min(self.read_timeout, remaining)))
+                conn.request('GET', target, headers=self.request_headers(headers))
+                response = conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine) as exc:
+                pool.release(conn, False)
+                # The server closed an idle keep-alive connection, retry on a new one
+                if reused:
+                    continue
+                raise FetchError(f'Request to {url} failed: {exc}')
+            except TimeoutError:
+                pool.release(conn, False)
+                raise FetchTimeout(f'Request to {url} timed out')
+            except (OSError, http.client.HTTPException) as exc:
+                pool.release(conn, False)
+                raise FetchError(f'Request to {url} failed: {exc}')
+            return pool, conn, Response(
+                response, conn, url, deadline, self.read_timeout, self.max_size)
+
+
+class AsyncHostPool:
+    """asyncio counterpart of HostPool, connections are stream pairs"""
+
+    def __init__(self, scheme: str, host: str, port: int, maxsize: int, connect_timeout: float):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.opened = 0
+        self.busy = 0
+        self.closed = False
+        self._idle = []
+        self._slots = asyncio.Semaphore(maxsize)
+
+    async def acquire(self, timeout: float) -> tuple:
+        """Check out a (reader, writer) connection, returns (connection, reused)"""
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), max(0.001, timeout))
+        except asyncio.TimeoutError:
+            raise FetchTimeout(f'No free connection to {self.host}')
+        self.busy += 1
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+        self.opened += 1
+        try:
+            return await self._connect(), False
+        except BaseException:
+            self.busy -= 1
+            self._slots.release()
+            raise
+
+    def release(self, conn: tuple, reusable: bool):
+        if reusable and not self.closed:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        self.busy -= 1
+        self._slots.release()
+
+    def close(self):
+        self.closed = True
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def _connect(self) -> tuple:
+        context = ssl.create_default_context() if self.scheme == 'https' else None
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=context),
+                self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise FetchTimeout(f'Connection to {self.host} timed out')
+        except OSError as exc:
+            raise FetchError(f'Cannot connect to {self.host}: {exc}')
+
+
+class AsyncResponse(_BaseResponse):
+    """Response on a pooled asyncio connection
+
+    The body is framed here, as http.client does for Response
+    """
+
+    def __init__(self, status: int, headers, reader: asyncio.StreamReader, url: str,
+                 deadline: float, read_timeout: float, max_size: int = None,
+                 will_close: bool = False):
+        super().__init__(status, headers, url, deadline, read_timeout, max_size)
+        self._reader = reader
+        self._will_close = will_close
+        self._complete = False
+
+    @property
+    def reusable(self) -> bool:
+        """The body was read completely and the server keeps the connection"""
+        return self._complete and not self._will_close
+
+    async def _read(self, read):
+        try:
+            remaining = self._remaining()
+        except FetchTimeout:
+            read.close()
+            raise
+        try:
+            return await asyncio.wait_for(read, min(self._read_timeout, remaining))
+        except asyncio.TimeoutError:
+            raise FetchTimeout(f'Reading {self.url} timed out')
+        except asyncio.IncompleteReadError:
+            raise FetchError(f'Reading {self.url} failed: connection closed')
+        except (OSError, ValueError) as exc:
+            raise FetchError(f'Reading {self.url} failed: {exc}')
+
+    async def chunks(self):
+        """Yield the body in chunks, as framed by the response headers"""
+
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            self._complete = True
+            return
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await self._read(self._reader.readline())
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise FetchError(f'Reading {self.url} failed: bad chunk size')
+                if not size:
+                    # Trailers end with an empty line
+                    while (await self._read(self._reader.readline())).strip():
+                        pass
+                    break
+                while size:
+                    chunk = await self._read(self._reader.read(min(CHUNK_SIZE, size)))
+                    if not chunk:
+                        raise FetchError(f'Reading {self.url} failed: connection closed')
+                    size -= len(chunk)
+                    yield chunk
+                await self._read(self._reader.readexactly(2))
+        elif self.headers.get('Content-Length', '').isdigit():
+            remaining = int(self.headers['Content-Length'])
+            while remaining:
+                chunk = await self._read(self._reader.read(min(CHUNK_SIZE, remaining)))
+                if not chunk:
+                    raise FetchError(f'Reading {self.url} failed: connection closed')
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # Delimited by the end of the connection
+            self._will_close = True
+            while chunk := await self._read(self._reader.read(CHUNK_SIZE)):
+                yield chunk
+        self._complete = True
+
+    async def download(self, max_size: int = None, spool_size: int = 0) -> SpooledTemporaryFile:
+        """Read the body into a spooled buffer, see _Body"""
+
+        with self._body(max_size, spool_size) as body:
+            async for chunk in self.chunks():
+                body.write(chunk)
+        return body.buffer
+
+    async def discard(self, limit: int = CHUNK_SIZE):
+        """Read and drop a small body, larger ones leave the connection unusable"""
+
+        size = 0
+        async for chunk in self.chunks():
+            size += len(chunk)
+            if size > limit:
+                return
+
+
+class AsyncFetcher(_BaseFetcher):
+    """asyncio counterpart of Fetcher with the same limits
+
+    Waiting on the network never blocks the event loop. Pools and
+    connections belong to the event loop they were created on
+    """
+
+    pool_class = AsyncHostPool
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+    @asynccontextmanager
+    async def open(self, url: str, headers: dict = None):
+        """GET a URL, following redirects, and yield its AsyncResponse"""
+
+        deadline = time.monotonic() + self.total_timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.total_timeout)
+        except asyncio.TimeoutError:
+            raise FetchTimeout('Too many concurrent requests')
+        try:
+            for _ in range(self.max_redirects + 1):
+                pool, conn, response = await self._request(url, headers, deadline)
+                if response.location:
+                    # Drain small redirect bodies to keep the connection
+                    try:
+                        await response.discard()
+                    except FetchError:
+                        pass
+                    pool.release(conn, response.reusable)
+                    url = response.location
+                    continue
+                try:
+                    yield response
+                finally:
+                    pool.release(conn, response.reusable)
+                return
+            raise FetchError(f'More than {self.max_redirects} redirects')
+        finally:
+            self._slots.release()
+
+    async def _request(self, url: str, headers: dict, deadline: float) -> tuple:
+        scheme, host, port, target = _split(url)
+        pool = self.pool(scheme, host, port)
+        authority = host if port == DEFAULT_PORTS[scheme] else f'{host}:{port}'
+        lines = [f'GET {target} HTTP/1.1', f'Host: {authority}', 'Accept-Encoding: identity']
+        lines += [f'{name}: {value}' for name, value in self.request_headers(headers).items()]
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        while True:
+            remaining = deadline - time.monotonic()
+            conn, reused = await pool.acquire(remaining)
+            reader, writer = conn
+            try:
+                writer.write(head)
+                status, response_headers, will_close = await asyncio.wait_for(
+                    self._read_head(reader, writer),
+                    max(0.001, min(self.read_timeout, remaining)))
+            except (ConnectionError, asyncio.IncompleteReadError) as exc:
+                pool.release(conn, False)
+                # The server closed an idle keep-alive connection, retry on a new one
+                if reused:
+                    continue
+                raise FetchError(f'Request to {url} failed: {exc}')
+            except asyncio.TimeoutError:
+                pool.release(conn, False)
+                raise FetchTimeout(f'Request to {url} timed out')
+            except (OSError, ValueError, http.client.HTTPException) as exc:
+                pool.release(conn, False)
+                raise FetchError(f'Request to {url} failed: {exc}')
+            return pool, conn, AsyncResponse(
+                status, response_headers, reader, url, deadline,
+                self.read_timeout, self.max_size, will_close)
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> tuple:
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed before the response')
+        version, status, *_ = line.decode('latin-1').split(None, 2) + ['']
+        if not version.startswith('HTTP/') or not status.isdigit():
+            raise http.client.BadStatusLine(line)
+
+        block = []
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            block.append(line)
+            if len(block) > MAX_HEADERS:
+                raise http.client.HTTPException(f'More than {MAX_HEADERS} headers')
+        headers = http.client.parse_headers(BytesIO(b''.join(block) + b'\r\n'))
+        connection = headers.get('Connection', '').lower()
+        will_close = connection == 'close' or (
+            version == 'HTTP/1.0' and connection != 'keep-alive')
+        return int(status), headers, will_close
+
+
+_fetcher = None
+_fetcher_pid = None
+_async_fetchers = weakref.WeakKeyDictionary()
+
+
+def _settings_options() -> dict:
+    from django.conf import settings
+    return {
+        'connect_timeout': settings.HEIFMGUR_URL_CONNECT_TIMEOUT,
+        'read_timeout': settings.HEIFMGUR_URL_READ_TIMEOUT,
+        'total_timeout': settings.HEIFMGUR_URL_TOTAL_TIMEOUT,
+        'max_size': settings.HEIFMGUR_URL_MAX_SIZE,
+        'connections_per_host': settings.HEIFMGUR_URL_CONNECTIONS_PER_HOST,
+        'concurrency': settings.HEIFMGUR_URL_CONCURRENCY,
+        'max_hosts': settings.HEIFMGUR_URL_MAX_HOSTS,
+    }
+
+
+def get_fetcher() -> Fetcher:
+    """Process wide fetcher configured from Django settings
+
+    Forked processes get their own, pooled sockets are never shared
+    """
+
+    global _fetcher, _fetcher_pid
+    if _fetcher is None or _fetcher_pid != os.getpid():
+        set_fetcher(Fetcher(**_settings_options()))
+    return _fetcher
+
+
+def set_fetcher(fetcher: Fetcher):
+    global _fetcher, _fetcher_pid
+    if _fetcher is not None and _fetcher_pid == os.getpid():
+        _fetcher.close()
+    _fetcher = fetcher
+    _fetcher_pid = os.getpid()
+
+
+def get_async_fetcher() -> AsyncFetcher:
+    """Fetcher of the running event loop configured from Django settings"""
+
+    loop = asyncio.get_running_loop()
+    if loop not in _async_fetchers:
+        _async_fetchers[loop] = AsyncFetcher(**_settings_options())
+    return _async_fetchers[loop]
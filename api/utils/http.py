@@ -0,0 +1,110 @@
+import mimetypes
+import os
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .img import RENDER_CONTENT_TYPES, parse_file_extension
+
+RANGE_CHUNK_SIZE = 64 * 1024
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+
+def guess_content_type(name: str) -> str:
+    """Content type of an image file name, HEIF included"""
+    extension = parse_file_extension(name).lower()
+    if extension in RENDER_CONTENT_TYPES:
+        return RENDER_CONTENT_TYPES[extension]
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class RangeNotSatisfiable(Exception):
+    """Requested byte range lies outside of the file"""
+
+
+def parse_range(header: str, size: int) -> tuple | None:
+    """Parse a single `bytes=` Range header into inclusive (start, end)
+
+    Returns None when the header is absent, malformed or asks for
+    several ranges, in which case the whole file is served
+    """
+
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec or '-' not in spec:
+        return None
+
+    first, last = (part.strip() for part in spec.split('-', 1))
+    try:
+        if not first:
+            # Suffix range, the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if start > end:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+def iter_range(path: str, start: int, end: int):
+    """Stream the inclusive byte range of a file in chunks"""
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, path: str, content_type: str, etag: str,
+               last_modified: int, cache_control: str = REVALIDATE_CACHE_CONTROL):
+    """Serve a file with validators, conditional GET and byte ranges
+
+    Full responses are FileResponses so that the WSGI server can use
+    sendfile, ranges are streamed from disk in chunks
+    """
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        size = os.path.getsize(path)
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range in (etag, http_date(last_modified)):
+            try:
+                byte_range = parse_range(request.headers.get('Range'), size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                iter_range(path, start, end),
+                status=206,
+                content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = cache_control
+    return response
@@ -1,16 +1,43 @@
+import ctypes
 import mimetypes
 import os
+import shutil
+from contextlib import contextmanager
 from io import BytesIO
 from operator import methodcaller
-from urllib import parse, request
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile, mkstemp
+from urllib import parse
 
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+from wand.api import library as wand_library
+from wand.image import STORAGE_TYPES
 from wand.image import Image as Wand
+from wand.resource import limits as magick_limits
 from wand.version import formats as wand_formats
 
+from .engine import EngineError, get_engine
+from .fetch import (AsyncFetcher, Fetcher, FetchError, FetchTooLarge,
+                    get_async_fetcher, get_fetcher)
+from .metrics import stage
+from .probe import probe_dimensions, probe_frames, sniff_image_format
+from .profiles import ProfileSelector, get_profiles
+
+EXIF_ORIENTATION = 0x0112
+
+# Pixel operations WandImage.call_method forwards to Wand
+WAND_METHODS = ('resize', 'crop', 'rotate', 'auto_orient', 'strip')
+
+RENDER_CONTENT_TYPES = {
+    'heif': 'image/heif',
+    'heic': 'image/heic',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
 
 def parse_file_name(path: str, ext: bool = False) -> str:
     """Parse path minus extension (.html, .jpg, etc.)"""
@@ -29,13 +56,46 @@ def parse_file_extension(path: str) -> str:
     return extension
 
 
+def pil_to_wand(image: Image.Image) -> Wand:
+    """Hand a PIL image over to Wand as raw pixels
+
+    Pixels are copied once by `tobytes()`, no codec is involved
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    wand = Wand(width=image.width, height=image.height)
+    imported = wand_library.MagickImportImagePixels(
+        wand.wand, 0, 0, image.width, image.height,
+        image.mode.encode(), STORAGE_TYPES.index('char'), image.tobytes())
+    if not imported:
+        wand.raise_exception()
+    return wand
+
+
+def wand_to_pil(image: Wand) -> Image.Image:
+    """Hand a Wand image over to PIL as raw pixels
+
+    Pixels are exported once into a buffer that PIL uses without copying
+    """
+    mode = 'RGBA' if image.alpha_channel else 'RGB'
+    width, height = image.size
+    buffer = ctypes.create_string_buffer(width * height * len(mode))
+    exported = wand_library.MagickExportImagePixels(
+        image.wand, 0, 0, width, height,
+        mode.encode(), STORAGE_TYPES.index('char'), buffer)
+    if not exported:
+        image.raise_exception()
+    return Image.frombuffer(mode, (width, height), buffer, 'raw', mode, 0, 1)
+
+
 def validate_file_extension(value):
     ext = os.path.splitext(value.name)[1]
     ext = ext.replace('.', '')
     valid_extensions = []
     valid_extensions += wand_formats('PNG*')
     valid_extensions += wand_formats('HEI*')
-    valid_extensions += ['JPEG', 'JPG', 'ICO']
+    valid_extensions += ['JPEG', 'JPG', 'ICO', 'GIF']
     if not ext.upper() in valid_extensions:
         message = {
             'error': f'{ext.upper()} is an unsupported image extension.',
@@ -43,6 +103,123 @@ def validate_file_extension(value):
         raise ValidationError(message)
 
 
+def admit_image(file: File, max_megapixels: float = None, max_bytes: int = None):
+    """Refuse an image over the byte or pixel budget before it is decoded
+
+    Dimensions come from the container headers, or from an ImageMagick
+    header ping for formats the probe does not know. Files that
+    ImageMagick cannot read either, e.g. truncated ones, are refused
+    """
+    if max_bytes and file.size > max_bytes:
+        raise ValidationError(
+            {'error': f'Image is over the {max_bytes} bytes limit'})
+    if not max_megapixels:
+        return
+    try:
+        width, height = Util.get_dimensions_from_file(file)
+    except EngineError as error:
+        raise ValidationError(
+            {'error': 'Image cannot be decoded', 'detail': str(error)})
+    if width * height > max_megapixels * 1e6:
+        raise ValidationError(
+            {'error': f'Image of {width}x{height} pixels is over '
+                      f'the {max_megapixels} megapixels limit'})
+
+
+def set_resource_limits(limits: dict):
+    """Cap the ImageMagick resources of this process
+
+    Keys are ImageMagick resources, e.g. memory and map in bytes,
+    area, width and height in pixels or thread
+    """
+    for name, value in (limits or {}).items():
+        magick_limits[name] = value
+
+
+def read_blob(file) -> bytes:
+    """Read a whole file object from its start"""
+    file.seek(0)
+    return file.read()
+
+
+@contextmanager
+def file_path(file: File):
+    """Filesystem path of a Django file, copied to a temporary file if it has none
+
+    The copy is written a chunk at a time, the file is never read whole
+    """
+    try:
+        path = file.path
+    except (AttributeError, NotImplementedError):
+        path = None
+    if path is None and hasattr(file, 'temporary_file_path'):
+        path = file.temporary_file_path()
+    if path is not None:
+        yield path
+        return
+    _, extension = os.path.splitext(file.name or '')
+    with NamedTemporaryFile(suffix=extension) as copy:
+        file.seek(0)
+        shutil.copyfileobj(file, copy)
+        copy.flush()
+        yield copy.name
+
+
+def django_file(blob: bytes, name: str) -> InMemoryUploadedFile:
+    """Wrap encoded image bytes as an uploaded file for Django storage"""
+    return InMemoryUploadedFile(
+        file=BytesIO(blob),
+        name=name,
+        field_name=None,
+        content_type=mimetypes.guess_type(name)[0],
+        size=len(blob),
+        charset=None,)
+
+
+class TemporaryImageFile(File):
+    """Encoded image in a temporary file
+
+    FileSystemStorage moves it into place instead of copying it,
+    so the encoded bytes never have to be held in memory
+    """
+
+    def __init__(self, path: str, name: str):
+        super().__init__(open(path, 'rb'), name=name)
+        self.path = path
+
+    def temporary_file_path(self) -> str:
+        return self.path
+
+    def close(self):
+        super().close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def save_temporary(image: Wand, directory: str = None) -> str:
+    """Let ImageMagick encode an image straight into a temporary file"""
+    fd, path = mkstemp(dir=directory, suffix=f'.{image.format.lower()}')
+    os.close(fd)
+    with stage('encode'):
+        image.save(filename=path)
+    return path
+
+
+def encode(image: Wand) -> bytes:
+    """Encoded blob of an image"""
+    with stage('encode'):
+        return image.make_blob()
+
+
+def decode(image: 'WandImage') -> 'WandImage':
+    """Decode the pixels of a lazy WandImage now"""
+    with stage('decode'):
+        image.image
+    return image
+
+
 class BaseImage():
     """Base Image class"""
 
@@ -83,20 +260,35 @@ class BaseImage():
 
 
 class PILImage(BaseImage):
-    """Class for PIL Image"""
+    """Class for PIL Image
+
+    Image.open only parses the header, pixels are decoded
+    by the first pixel operation
+    """
 
     def __init__(self, filename: str):
         super().__init__()
         self.image = Image.open(filename)
         self.format = self.image.format
 
+    @property
+    def size(self) -> tuple:
+        return self.image.size
+
+    @property
+    def orientation(self) -> int:
+        """EXIF orientation, 1 when absent"""
+        # getexif() of some plugins loads the pixels, parse the header copy
+        exif = Image.Exif()
+        exif.load(self.image.info.get('exif', b''))
+        return exif.get(EXIF_ORIENTATION, 1)
+
     def call_method(self, *args, ** kwargs):
         method = kwargs.pop('method', None)
         if not method:
             raise AttributeError(
                 'Must provide a method in str format as a kwarg for an PIL Image object')
 
-        self.image.convert(mode=self.mode)
         caller = methodcaller(method, *args, **kwargs)
         self.image = caller(self.image)
 
@@ -104,10 +296,10 @@ class PILImage(BaseImage):
         """Convert a PIL image to a Wand image"""
         if not format:
             format = self.format
-        image_io = BytesIO()
-        self.image.save(image_io, format=format)
-        blob = image_io.getvalue()
-        self.image = Wand(blob=blob)
+        wand = pil_to_wand(self.image)
+        if format:
+            wand.format = format
+        self.image = wand
 
     def get(self, django_file: bool = False):
         if django_file:
@@ -118,20 +310,88 @@ class PILImage(BaseImage):
 
 
 class WandImage(BaseImage):
-    """Class for Imagemagick's Wand Image"""
+    """Class for Imagemagick's Wand Image
+
+    Nothing is decoded on construction. Format, size and orientation
+    come from a header ping, pixels are decoded the first time `image`
+    is used
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__()
-        self.image = Wand(*args, **kwargs)
-        self.format = self.image.format
+        self._args = args
+        self._kwargs = kwargs
+        self._image = None
+        self._ping = None
+        # Unknown until pinged, not the BaseImage default
+        self._format = None
+        file = kwargs.get('file', None)
+        self._offset = file.tell() if callable(getattr(file, 'tell', None)) else None
         if kwargs.get('filename', None):
             self.name = parse_file_name(kwargs.get('filename'))
-        file = kwargs.get('file', None)
         if file:
-            if file.url:
+            if getattr(file, 'url', None):
                 name = parse_file_name(file.url)
                 self.name = name
 
+    @property
+    def image(self) -> Wand:
+        if self._image is None:
+            self._rewind()
+            self._image = Wand(*self._args, **self._kwargs)
+            self._args, self._kwargs = (), {}
+            if self._ping is not None:
+                self._ping.close()
+                self._ping = None
+        return self._image
+
+    @image.setter
+    def image(self, image: Wand):
+        self._image = image
+
+    @property
+    def format(self) -> str:
+        if self._format is None:
+            self._format = self.ping().format
+        return self._format
+
+    @format.setter
+    def format(self, format: str):
+        self._format = format
+
+    @property
+    def size(self) -> tuple:
+        return self.ping().size
+
+    @property
+    def orientation(self) -> str:
+        """EXIF orientation as named by ImageMagick, e.g. top_left"""
+        return self.ping().orientation
+
+    @property
+    def frames(self) -> int:
+        return len(self.ping().sequence)
+
+    def ping(self) -> Wand:
+        """Image with the header only, or the decoded image if any"""
+        if self._image is not None:
+            return self._image
+        if self._args or 'image' in self._kwargs:
+            # Wrapping an already decoded image
+            return self.image
+        if self._ping is None:
+            sources = {
+                key: value for key, value in self._kwargs.items()
+                if key in ('blob', 'file', 'filename', 'format')}
+            self._rewind()
+            self._ping = Wand.ping(**sources)
+            self._rewind()
+        return self._ping
+
+    def _rewind(self):
+        if self._offset is not None and self._kwargs.get('file') is not None:
+            self._kwargs['file'].seek(self._offset)
+
     def convert_to(self, format: str = None):
         if format == self.format:
             return
@@ -147,24 +407,43 @@ class WandImage(BaseImage):
         if not method:
             raise AttributeError(
                 'Must provide a method in str format as a kwarg for a Wand Image object')
+        if method not in WAND_METHODS:
+            raise AttributeError(
+                f'Unsupported method {method}, choose from {", ".join(WAND_METHODS)}')
 
-        if method == 'resize':
-            width = kwargs.pop('width', None)
-            height = kwargs.pop('height', None)
-            self.image.resize(width, height)
-            return
-
-        raise AttributeError(
-            'New methods under work')
-
-        # TODO
-        # caller = methodcaller(method, *args, **kwargs)
-        # caller(self.image)
+        caller = methodcaller(method, *args, **kwargs)
+        caller(self.image)
+
+    def renditions(self, sizes: tuple, profiles: ProfileSelector = None):
+        """Yield (size, WandImage) HEIF renditions fitting each long edge
+
+        Renditions are downscaled from the already decoded pixels,
+        the largest first, each next one from the previous rendition.
+        Sizes not smaller than the image itself are skipped. With
+        `profiles` every rendition is encoded with the profile of its size
+        """
+        width, height = self.image.size
+        source = self.image
+        for size in sorted(set(sizes), reverse=True):
+            if size >= max(width, height):
+                continue
+            ratio = size / max(width, height)
+            with stage('resize'):
+                rendition = WandImage(image=source)
+                rendition.call_method(
+                    method='resize',
+                    width=max(1, round(width * ratio)),
+                    height=max(1, round(height * ratio)))
+            rendition.name = f'{self.name}_{size}'
+            rendition.convert_to('heif')
+            if profiles:
+                profiles.select(*rendition.image.size).apply(rendition.image)
+            yield size, rendition
+            source = rendition.image
 
     def convert_to_PIL(self):
         """Convert a Wand image to a PIL image"""
-        pil_image = Image.open(BytesIO(self.image.make_blob()))
-        self.image = pil_image
+        self.image = wand_to_pil(self.image)
 
     def get(self, django_file: bool = False):
         if django_file:
@@ -193,37 +472,97 @@ class URLImage(BaseImage):
     def __init__(self, url: str):
         super().__init__()
         self.url = url
-        self.request = request.Request(url, headers=self.HEADERS)
         self.name = parse_file_name(self.url)
         self.format = parse_file_extension(self.url)
         self.wand = None
         self.pil = None
+        self.buffer = None
+
+    def fetch(self, max_size: int = None, spool_size: int = 0, fetcher: Fetcher = None) -> SpooledTemporaryFile:
+        """Download the image once into a spooled buffer
+
+        Status, content type, size and magic bytes are checked on the
+        same stream, so the buffer can be handed to the encoder as is.
+        Bodies larger than `spool_size` are spilled to a temporary file,
+        bodies larger than `max_size` are rejected. The download goes
+        through the pooled, time limited connections of the fetcher
+        """
+
+        fetcher = fetcher or get_fetcher()
+        try:
+            with stage('download'), fetcher.open(self.url, headers=self.HEADERS) as response:
+                self._check_response(response)
+                buffer = response.download(max_size, spool_size)
+        except FetchTooLarge:
+            raise ValidationError(
+                f'Image is larger than {max_size or fetcher.max_size} bytes')
+        except FetchError as exc:
+            raise ValidationError(f'URL is not available: {exc}')
+        return self._accept(buffer)
+
+    async def fetch_async(self, max_size: int = None, spool_size: int = 0,
+                          fetcher: AsyncFetcher = None) -> SpooledTemporaryFile:
+        """fetch() waiting on the network without blocking the event loop"""
+
+        fetcher = fetcher or get_async_fetcher()
+        try:
+            with stage('download'):
+                async with fetcher.open(self.url, headers=self.HEADERS) as response:
+                    self._check_response(response)
+                    buffer = await response.download(max_size, spool_size)
+        except FetchTooLarge:
+            raise ValidationError(
+                f'Image is larger than {max_size or fetcher.max_size} bytes')
+        except FetchError as exc:
+            raise ValidationError(f'URL is not available: {exc}')
+        return self._accept(buffer)
+
+    @staticmethod
+    def _check_response(response):
+        if response.status not in range(200, 209):
+            raise ValidationError(
+                f'URL responded with status {response.status}')
+
+        content_type = response.headers.get_content_type()
+        if not (content_type.startswith('image/')
+                or content_type == 'application/octet-stream'):
+            raise ValidationError(
+                f'URL content type {content_type} is not an image')
+
+    def _accept(self, buffer: SpooledTemporaryFile) -> SpooledTemporaryFile:
+        """Keep a downloaded body whose magic bytes are a supported image"""
+
+        buffer.seek(0)
+        image_format = sniff_image_format(buffer.read(32))
+        buffer.seek(0)
+        if not image_format:
+            buffer.close()
+            raise ValidationError('URL content is not a supported image')
+
+        self.format = image_format
+        self.buffer = buffer
+        return buffer
 
     def download_img(self, to_heif: bool = False):
         """Download image"""
-        req = request.urlopen(self.request)
-        self.wand = WandImage(file=req)
+        if self.buffer is None:
+            self.fetch()
+        self.wand = WandImage(file=self.buffer)
         is_heif = self.format in ['heic', 'heif']
         if not is_heif:
             self.wand.convert_to('heif')
 
     def check_url(self):
-        """Check URL of the image"""
+        """Check URL of the image
 
-        is_url_image = check_url = False
+        The fetched body is kept, a later download_img() reuses it
+        """
 
-        # Check that if the URL is an image
-        mimetype, encoding = mimetypes.guess_type(self.url)
-        is_url_image = (mimetype and mimetype.startswith('image'))
-
-        # Check that the URL is working
         try:
-            response = request.urlopen(self.request)
-            check_url = response.status in range(200, 209)
-        except Exception:
-            check_url = False
-
-        return is_url_image and check_url
+            self.fetch()
+        except ValidationError:
+            return False
+        return True
 
     def get(self, django_file: bool = False):
         if django_file:
@@ -239,6 +578,154 @@ class URLImage(BaseImage):
         return self.wand
 
 
+def iter_frames(path: str, count: int):
+    """Yield (frame, delay) for the first `count` frames of an animation
+
+    The file is decoded once, a frame at a time: Pillow composes every
+    frame over the previous ones according to its offset and disposal.
+    Formats Pillow cannot open are read by ImageMagick in a single pass.
+    Delays are in ticks of 1/100 seconds, like ImageMagick ones
+    """
+    try:
+        image = Image.open(path)
+    except UnidentifiedImageError:
+        yield from _iter_wand_frames(path, count)
+        return
+    with image:
+        for index in range(count):
+            with stage('decode'):
+                try:
+                    image.seek(index)
+                except EOFError:
+                    return
+                frame = pil_to_wand(image)
+            with frame:
+                yield frame, round(image.info.get('duration', 0) / 10)
+
+
+def _iter_wand_frames(path: str, count: int):
+    with stage('decode'):
+        sequence = Wand(filename=f'{path}[0-{count - 1}]')
+    with sequence:
+        sequence.coalesce()
+        for single in sequence.sequence:
+            with Wand(image=single) as frame:
+                yield frame, single.delay
+
+
+def convert_animation(path: str, count: int, format: str = 'heif', profile=None, first=None) -> Wand:
+    """Image sequence of the first `count` frames of an animation
+
+    The encoder gets the composed frames, a frame at a time is decoded.
+    `first(frame)` is called with the first composed frame
+    """
+    output = None
+    for canvas, delay in iter_frames(path, count):
+        if output is None:
+            if first:
+                first(canvas)
+            output = canvas.clone()
+        else:
+            output.sequence.append(canvas)
+        output.sequence[-1].delay = delay
+    output.format = format
+    if profile:
+        profile.apply(output)
+    return output
+
+
+def _job_convert(data: bytes, format: str = 'heif', sizes: tuple = (), convert: bool = True,
+                 profiles: ProfileSelector = None, profile: str = None) -> tuple:
+    """Engine job: convert an image and encode its renditions
+
+    Returns the blobs, converted picture first unless `convert` is False,
+    and the sizes of the renditions that were generated. The picture is
+    encoded with the `profile` requested or selected by `profiles`.
+    Animations are converted from their file by _job_convert_file
+    """
+    image = decode(WandImage(blob=data))
+    renditions = list(image.renditions(sizes, profiles))
+    blobs = [encode(rendition.image) for _, rendition in renditions]
+    if convert:
+        image.convert_to(format)
+        if profiles:
+            profiles.select(*image.size, name=profile).apply(image.image)
+        blobs.insert(0, encode(image.image))
+    return blobs, [size for size, _ in renditions]
+
+
+def _job_convert_file(data: None, path: str, directory: str = None, format: str = 'heif', sizes: tuple = (), convert: bool = True,
+                      profiles: ProfileSelector = None, profile: str = None, frames: int = 1, blobs: bool = False) -> tuple:
+    """Engine job: convert an image file and encode its renditions
+
+    Outputs are written by the encoder to temporary files in `directory`.
+    Returns no blobs and the paths of the outputs, converted picture
+    first unless `convert` is False, along with the rendition sizes.
+    With `blobs` the outputs are returned as blobs like _job_convert does.
+    With `frames` over 1 the picture is an image sequence of that many
+    frames and renditions are stills of the first one
+    """
+    output = encode if blobs else lambda image: save_temporary(image, directory)
+    outputs = []
+    rendition_sizes = []
+
+    def add_renditions(image: WandImage):
+        for size, rendition in image.renditions(sizes, profiles):
+            outputs.append(output(rendition.image))
+            rendition_sizes.append(size)
+
+    if frames > 1:
+        # Renditions are made of the first frame the animation decode
+        # yields, before it moves on to the next ones
+        if convert:
+            picture = convert_animation(
+                path, frames, format,
+                first=lambda frame: add_renditions(WandImage(image=frame)))
+            if profiles:
+                profiles.select(*picture.size, name=profile).apply(picture)
+        else:
+            for frame, _ in iter_frames(path, 1):
+                add_renditions(WandImage(image=frame))
+    else:
+        image = decode(WandImage(filename=path))
+        add_renditions(image)
+        if convert:
+            image.convert_to(format)
+            if profiles:
+                profiles.select(*image.size, name=profile).apply(image.image)
+            picture = image.image
+    if convert:
+        outputs.insert(0, output(picture))
+    if blobs:
+        return outputs, rendition_sizes
+    return [], (outputs, rendition_sizes)
+
+
+def _job_resize(data: bytes, width: int = None, height: int = None, format: str = None) -> tuple:
+    """Engine job: resize an image, a missing side keeps the aspect ratio"""
+    image = decode(WandImage(blob=data))
+    source_width, source_height = image.size
+    if not width:
+        width = max(1, round(source_width * height / source_height))
+    if not height:
+        height = max(1, round(source_height * width / source_width))
+    with stage('resize'):
+        image.call_method(method='resize', width=width, height=height)
+    if format:
+        image.convert_to(format)
+    return [encode(image.image)], image.format
+
+
+def _job_dimensions(data: bytes) -> tuple:
+    """Engine job: read the dimensions of an image with a header ping"""
+    return [], WandImage(blob=data).size
+
+
+def _job_frames(data: bytes) -> tuple:
+    """Engine job: count the frames of an image with a header ping"""
+    return [], WandImage(blob=data).frames
+
+
 class Util:
     """Image and URL Utilities for api project"""
 
@@ -253,10 +740,28 @@ class Util:
     @staticmethod
     def resize_image(path: str, width: int, height: int, django: bool = False) -> InMemoryUploadedFile:
         """Change image size with Wand library"""
+        if django:
+            with open(path, 'rb') as file:
+                blobs, format = get_engine().run(
+                    _job_resize, file.read(), width=width, height=height)
+            name = f'{parse_file_name(path)}.{format.lower()}'
+            return django_file(blobs[0], name)
         image = WandImage(filename=path)
         image.call_method(method='resize', width=width, height=height)
         return image.get(django_file=django)
 
+    @staticmethod
+    def render_image(path: str, width: int = None, height: int = None, format: str = 'heif') -> bytes:
+        """Derive a resized copy of an image without touching the original
+
+        A missing width or height is computed from the aspect ratio
+        """
+        with open(path, 'rb') as file:
+            blobs, _ = get_engine().run(
+                _job_resize, file.read(),
+                width=width, height=height, format=format)
+        return blobs[0]
+
     @staticmethod
     def resize_image_PIL(path: str, width: int, height: int, django: bool = False):
         """Change image size with PIL library"""
@@ -266,19 +771,97 @@ class Util:
 
     @staticmethod
     def get_dimensions_from_file(file: File) -> tuple:
-        """Get dimensions of an image file"""
-        image = WandImage(blob=file.file)
-        dimensions = (image.image.width, image.image.height)
+        """Get dimensions of an image file
+
+        Dimensions are read from the container headers when possible,
+        the file is fully decoded with Wand only as a fallback
+        """
+        dimensions = probe_dimensions(file.file)
+        if dimensions:
+            return dimensions
+        _, dimensions = get_engine().run(_job_dimensions, read_blob(file.file))
         return dimensions
 
+    @staticmethod
+    def get_frames_from_file(file: File) -> int:
+        """Get the number of frames of an image file, 1 for still images
+
+        Like dimensions, frames are counted from the headers when possible
+        """
+        frames = probe_frames(file.file)
+        if frames:
+            return frames
+        _, frames = get_engine().run(_job_frames, read_blob(file.file))
+        return frames
+
+    @staticmethod
+    def admit_image(file: File, max_megapixels: float = None, max_bytes: int = None):
+        admit_image(file, max_megapixels, max_bytes)
+
     @staticmethod
     def convert_to_heic(file: File, django=True) -> InMemoryUploadedFile:
         """Convert image to heic format"""
+        if django:
+            picture, _ = Util.convert_with_renditions(file, ())
+            return picture
         image = WandImage(blob=file.file)
         image.convert_to('heif')
         image.name = parse_file_name(file.name)
         return image.get(django_file=django)
 
+    @staticmethod
+    def convert_with_renditions(file: File, sizes: tuple, to_heif: bool = True, profile: str = None,
+                                frames: int = 1) -> tuple:
+        """Convert image to heic format along with its renditions
+
+        The image is decoded only once. Returns the converted picture,
+        None if `to_heif` is False, and a list of (size, picture).
+        The picture is encoded with `profile`, or the profile of its size.
+        The first `frames` frames of animations make a HEIF image sequence
+        """
+        name = parse_file_name(file.name)
+        options = dict(
+            format='heif', sizes=tuple(sizes), convert=to_heif,
+            profiles=get_profiles(), profile=profile)
+        if frames > 1:
+            # Frames are read one at a time from a file, never from a blob
+            with file_path(file) as path:
+                blobs, rendition_sizes = get_engine().run(
+                    _job_convert_file, path=path, frames=frames, blobs=True, **options)
+        else:
+            blobs, rendition_sizes = get_engine().run(
+                _job_convert, read_blob(file.file), **options)
+        picture = None
+        if to_heif:
+            picture = django_file(blobs.pop(0), f'{name}.heif')
+        renditions = [
+            (size, django_file(blob, f'{name}_{size}.heif'))
+            for size, blob in zip(rendition_sizes, blobs)]
+        return picture, renditions
+
+    @staticmethod
+    def convert_file_with_renditions(path: str, name: str, sizes: tuple, to_heif: bool = True, directory: str = None,
+                                     profile: str = None, frames: int = 1) -> tuple:
+        """Streaming variant of convert_with_renditions
+
+        The encoder reads the image from `path` and writes its outputs
+        to temporary files in `directory`, which storage then moves into
+        place. Neither the source nor the outputs are loaded into memory
+        """
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _, (outputs, rendition_sizes) = get_engine().run(
+            _job_convert_file, path=path, directory=directory,
+            format='heif', sizes=tuple(sizes), convert=to_heif,
+            profiles=get_profiles(), profile=profile, frames=frames)
+        picture = None
+        if to_heif:
+            picture = TemporaryImageFile(outputs.pop(0), f'{name}.heif')
+        renditions = [
+            (size, TemporaryImageFile(output, f'{name}_{size}.heif'))
+            for size, output in zip(rendition_sizes, outputs)]
+        return picture, renditions
+
     @staticmethod
     def download_img(url: str, django: bool = False, to_heif: bool = False):
         url_img = URLImage(url)
@@ -289,6 +872,20 @@ class Util:
             return url_img.wand.get(django_file=django)
         return url_img.get(django_file=django)
 
+    @staticmethod
+    def fetch_img(url: str, max_size: int = None, spool_size: int = 0) -> File:
+        """Fetch an image via URL once, validated and ready for conversion"""
+        url_img = URLImage(url)
+        buffer = url_img.fetch(max_size=max_size, spool_size=spool_size)
+        return File(buffer, name=url_img.name_ext)
+
+    @staticmethod
+    async def fetch_img_async(url: str, max_size: int = None, spool_size: int = 0) -> File:
+        """fetch_img() for async views"""
+        url_img = URLImage(url)
+        buffer = await url_img.fetch_async(max_size=max_size, spool_size=spool_size)
+        return File(buffer, name=url_img.name_ext)
+
     @staticmethod
     def is_image_and_ready(url: str):
         image = URLImage(url)
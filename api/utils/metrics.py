@@ -0,0 +1,325 @@
+import contextvars
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(10))
+MEGAPIXEL_BUCKETS = (0.1, 0.5, 1, 2, 4, 8, 12, 16, 24, 50, 100)
+RATIO_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2)
+# Seconds between two publications of the metrics of a process
+PUBLISH_INTERVAL = 1.0
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Named family of series told apart by their label values"""
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                f'{self.name} takes the labels {", ".join(self.labels) or "none"}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def snapshot(self) -> list:
+        """JSON serializable [label values, value] pairs of every series"""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._series.items()]
+
+    def render(self, snapshots: tuple = ()) -> list:
+        """Exposition lines of the series, summed with those of `snapshots`"""
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        series = {}
+        for snapshot in (self.snapshot(), *snapshots):
+            for key, value in snapshot:
+                key = tuple(key)
+                series[key] = self._add(series[key], value) if key in series else value
+        for key, value in sorted(series.items()):
+            lines += self._render_series(list(zip(self.labels, key)), value)
+        return lines
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    """Monotonic total, e.g. failures by type"""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._series.get(key, 0)
+
+    @staticmethod
+    def _add(value, other):
+        return value + other
+
+    def _render_series(self, pairs: list, value) -> list:
+        return [f'{self.name}{_labels(pairs)} {_number(value)}']
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._series[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        key = self._key(labels)
+        with self._lock:
+            counts, _ = self._series.get(key, ((), 0))
+            return sum(counts)
+
+    @staticmethod
+    def _copy(value):
+        counts, total = value
+        return [list(counts), total]
+
+    @staticmethod
+    def _add(value, other):
+        (counts, total), (other_counts, other_total) = value, other
+        return [a + b for a, b in zip(counts, other_counts)], total + other_total
+
+    def _render_series(self, pairs: list, value) -> list:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket{_labels(pairs + [("le", _number(bound))])} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(pairs)} {_number(total)}')
+        lines.append(f'{self.name}_count{_labels(pairs)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Metrics in the Prometheus text exposition format
+
+    Every process records its own metrics. With a shared directory,
+    processes publish() their metrics there and render() sums those
+    of the other processes with its own, so that any of them exposes
+    the metrics of all, e.g. the web process those of the conversion
+    workers. Files of exited processes are kept, their counters never
+    go backwards, clear the directory when deploying
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._process = None
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'{metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self, directory: str = None) -> str:
+        snapshots = self.collect(directory) if directory else []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(
+            f'{line}\n' for metric in metrics
+            for line in metric.render(tuple(
+                snapshot[metric.name] for snapshot in snapshots
+                if metric.name in snapshot)))
+
+    def publish(self, directory: str):
+        """Write the metrics of this process to the shared `directory`"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {metric.name: metric.snapshot() for metric in metrics}
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(snapshot, file)
+            os.replace(temp_path, directory / f'{self.process}.json')
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def collect(self, directory: str) -> list:
+        """Metrics published by the other processes"""
+
+        snapshots = []
+        for path in Path(directory).glob('*.json'):
+            if path.stem == self.process:
+                continue
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    @property
+    def process(self) -> str:
+        """Name of this process in the shared directory, forked ones get theirs"""
+        pid = os.getpid()
+        if self._process is None or self._process[0] != pid:
+            self._process = (pid, f'{pid}-{secrets.token_hex(4)}')
+        return self._process[1]
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'heifmgur_stage_seconds', 'Latency of image pipeline stages', ('stage',))
+STAGE_FAILURES = REGISTRY.counter(
+    'heifmgur_stage_failures_total', 'Image pipeline stages that raised', ('stage', 'type'))
+IMAGE_BYTES = REGISTRY.histogram(
+    'heifmgur_image_bytes', 'Size of converted images, in and out',
+    ('direction',), BYTES_BUCKETS)
+IMAGE_MEGAPIXELS = REGISTRY.histogram(
+    'heifmgur_image_megapixels', 'Resolution of converted images', (), MEGAPIXEL_BUCKETS)
+ENCODE_RATIO = REGISTRY.histogram(
+    'heifmgur_encode_ratio', 'Encoded picture size over source size', (), RATIO_BUCKETS)
+REQUEST_SECONDS = REGISTRY.histogram(
+    'heifmgur_request_seconds', 'Latency of HTTP requests', ('method', 'view', 'status'))
+
+_breakdown = contextvars.ContextVar('heifmgur_breakdown', default=None)
+_published = 0
+
+
+def publish_metrics(force: bool = False):
+    """Publish the metrics of this process to HEIFMGUR_METRICS_DIR
+
+    At most once per PUBLISH_INTERVAL unless forced
+    """
+
+    global _published
+    from django.conf import settings
+    directory = settings.HEIFMGUR_METRICS_DIR
+    now = time.monotonic()
+    if not directory or (not force and now - _published < PUBLISH_INTERVAL):
+        return
+    _published = now
+    REGISTRY.publish(directory)
+
+
+@contextmanager
+def track():
+    """Collect the (stage, seconds, error) timings of the stages run inside"""
+
+    timings = []
+    token = _breakdown.set(timings)
+    try:
+        yield timings
+    finally:
+        _breakdown.reset(token)
+
+
+def observe_stage(name: str, seconds: float, error: str = None):
+    """Record a stage timing, also for the breakdown being tracked"""
+
+    STAGE_SECONDS.observe(seconds, stage=name)
+    if error:
+        STAGE_FAILURES.inc(stage=name, type=error)
+    timings = _breakdown.get()
+    if timings is not None:
+        timings.append((name, seconds, error))
+
+
+@contextmanager
+def stage(name: str):
+    """Time a pipeline stage, an exception counts as its failure
+
+    Stages may nest, an outer stage includes the time of inner ones
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as error:
+        observe_stage(name, time.perf_counter() - start, type(error).__name__)
+        raise
+    observe_stage(name, time.perf_counter() - start)
+
+
+def observe_conversion(bytes_in: int, bytes_out: int, width: int = None, height: int = None):
+    """Record the sizes and resolution of a converted image"""
+
+    if bytes_in:
+        IMAGE_BYTES.observe(bytes_in, direction='in')
+    if bytes_out:
+        IMAGE_BYTES.observe(bytes_out, direction='out')
+    if bytes_in and bytes_out:
+        ENCODE_RATIO.observe(bytes_out / bytes_in)
+    if width and height:
+        IMAGE_MEGAPIXELS.observe(width * height / 1e6)
+
+
+def format_breakdown(timings: list) -> str:
+    """Total time per stage in order of appearance, e.g. decode=0.120s"""
+
+    totals = {}
+    failed = set()
+    for name, seconds, error in timings:
+        totals[name] = totals.get(name, 0) + seconds
+        if error:
+            failed.add(name)
+    return ' '.join(
+        f'{name}={seconds:.3f}s' + (' (failed)' if name in failed else '')
+        for name, seconds in totals.items())
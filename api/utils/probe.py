@@ -0,0 +1,312 @@
+import os
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+GIF_SIGNATURES = (b'GIF87a', b'GIF89a')
+HEIF_BRANDS = {
+    b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx',
+    b'mif1', b'msf1', b'avif', b'avis'}
+# Brands of HEIF image sequences, their frames live in a track
+HEIF_SEQUENCE_BRANDS = {b'msf1', b'hevc', b'hevx', b'hevm', b'hevs', b'avis'}
+
+# JPEG Start Of Frame markers, DHT (C4), JPG (C8) and DAC (CC) excluded
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD8, *range(0xD0, 0xD8)}
+
+
+def sniff_image_format(head: bytes) -> str | None:
+    """Guess the image format from the leading magic bytes"""
+
+    if head.startswith(PNG_SIGNATURE):
+        return 'png'
+    if head[:2] == b'\xff\xd8':
+        return 'jpeg'
+    if head[:6] in GIF_SIGNATURES:
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if head[:4] == b'\x00\x00\x01\x00':
+        return 'ico'
+    if head[4:8] == b'ftyp':
+        brands = {head[i:i + 4] for i in range(8, len(head) - 3, 4)}
+        if HEIF_BRANDS & brands:
+            return 'heif'
+    return None
+
+
+def probe_dimensions(file) -> tuple | None:
+    """Read (width, height) of an image from its container headers
+
+    Only the PNG IHDR chunk, the GIF image descriptors, the JPEG SOF
+    segment or the HEIF `ispe` property of the primary item are read,
+    pixel data is never decoded. Returns None if the format is not
+    recognized or the headers are malformed, in which case the caller
+    should fall back to a full decode
+    """
+
+    if hasattr(file, 'seekable') and not file.seekable():
+        return None
+
+    position = file.tell()
+    try:
+        file.seek(0)
+        head = file.read(32)
+        if head.startswith(PNG_SIGNATURE):
+            return _probe_png(head)
+        if head[:6] in GIF_SIGNATURES:
+            return _probe_gif(file)
+        if head[:2] == b'\xff\xd8':
+            return _probe_jpeg(file)
+        if head[4:8] == b'ftyp':
+            return _probe_heif(file)
+        return None
+    except (struct.error, ValueError, IndexError, OSError):
+        return None
+    finally:
+        file.seek(position)
+
+
+def probe_frames(file) -> int | None:
+    """Count the frames of an image from its headers
+
+    APNG tell their frame count in the acTL chunk, GIF frames are
+    counted by walking the blocks without decompressing them. JPEG and
+    HEIF still images have a single frame. Returns None when unknown,
+    e.g. for HEIF image sequences
+    """
+
+    if hasattr(file, 'seekable') and not file.seekable():
+        return None
+
+    position = file.tell()
+    try:
+        file.seek(0)
+        head = file.read(32)
+        if head.startswith(PNG_SIGNATURE):
+            return _probe_png_frames(file)
+        if head[:6] in GIF_SIGNATURES:
+            return _probe_gif_frames(file)
+        if head[:2] == b'\xff\xd8':
+            return 1
+        if head[4:8] == b'ftyp':
+            brands = {head[i:i + 4] for i in range(8, len(head) - 3, 4)}
+            if HEIF_BRANDS & brands and not HEIF_SEQUENCE_BRANDS & brands:
+                return 1
+        return None
+    except (struct.error, ValueError, IndexError, OSError):
+        return None
+    finally:
+        file.seek(position)
+
+
+def _probe_png_frames(file) -> int | None:
+    file.seek(len(PNG_SIGNATURE))
+    while True:
+        chunk = file.read(8)
+        if len(chunk) < 8:
+            return None
+        length, chunk_type = struct.unpack('>I4s', chunk)
+        if chunk_type == b'acTL':
+            frames, = struct.unpack('>I', file.read(4))
+            return frames
+        # acTL comes before the image data
+        if chunk_type in (b'IDAT', b'IEND'):
+            return 1
+        # Skip the data and the CRC
+        file.seek(length + 4, os.SEEK_CUR)
+
+
+def _probe_gif_frames(file) -> int | None:
+    frames = sum(1 for _ in _iter_gif_frames(file))
+    return frames or None
+
+
+def _probe_gif(file) -> tuple | None:
+    # The logical screen may be smaller than the frames, a decoder
+    # allocates each frame at its own size
+    file.seek(6)
+    width, height = struct.unpack('<HH', file.read(4))
+    frames = False
+    for frame_width, frame_height in _iter_gif_frames(file):
+        width, height = max(width, frame_width), max(height, frame_height)
+        frames = True
+    return (width, height) if frames else None
+
+
+def _iter_gif_frames(file):
+    """Iterate over the (width, height) of the image descriptors of a GIF
+
+    Blocks are walked without decompressing the image data
+    """
+
+    file.seek(10)
+    flags = file.read(1)[0]
+    # Background color index and aspect ratio, then the global color table
+    file.seek(2, os.SEEK_CUR)
+    if flags & 0x80:
+        file.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR)
+
+    while True:
+        block = file.read(1)
+        if not block or block == b'\x3b':
+            return
+        if block == b'\x2c':
+            descriptor = file.read(9)
+            yield struct.unpack('<HH', descriptor[4:8])
+            if descriptor[8] & 0x80:
+                file.seek(3 << ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)
+            # LZW minimum code size
+            file.seek(1, os.SEEK_CUR)
+        elif block == b'\x21':
+            # Extension label
+            file.seek(1, os.SEEK_CUR)
+        else:
+            raise ValueError(f'Unknown GIF block {block!r}')
+        _skip_gif_sub_blocks(file)
+
+
+def _skip_gif_sub_blocks(file):
+    while True:
+        size = file.read(1)
+        if not size:
+            raise ValueError('Truncated GIF')
+        if not size[0]:
+            return
+        file.seek(size[0], os.SEEK_CUR)
+
+
+def _probe_png(head: bytes) -> tuple | None:
+    if head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def _probe_jpeg(file) -> tuple | None:
+    file.seek(2)
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        # Markers may be preceded by any number of 0xFF fill bytes
+        while code == 0xFF:
+            code = file.read(1)[0]
+        if code in JPEG_STANDALONE_MARKERS:
+            continue
+        length, = struct.unpack('>H', file.read(2))
+        if code in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack('>BHH', file.read(5))
+            return width, height
+        file.seek(length - 2, os.SEEK_CUR)
+
+
+def _iter_boxes(file, end: int):
+    """Iterate over ISOBMFF boxes up to `end`
+
+    Yields (type, payload start, box end) and moves the file
+    to the end of the box once the consumer is done with it
+    """
+
+    offset = file.tell()
+    while offset + 8 <= end:
+        file.seek(offset)
+        size, box_type = struct.unpack('>I4s', file.read(8))
+        header = 8
+        if size == 1:
+            size, = struct.unpack('>Q', file.read(8))
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise ValueError(f'Malformed {box_type!r} box')
+        yield box_type, offset + header, offset + size
+        offset += size
+    file.seek(end)
+
+
+def _probe_heif(file) -> tuple | None:
+    end = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    for box_type, start, box_end in _iter_boxes(file, end):
+        if box_type == b'ftyp':
+            brands = file.read(box_end - start)
+            compatible = {brands[i:i + 4] for i in range(8, len(brands), 4)}
+            if not HEIF_BRANDS & {brands[:4], *compatible}:
+                return None
+        elif box_type == b'meta':
+            # Full box: skip version and flags
+            file.seek(start + 4)
+            return _probe_heif_meta(file, box_end)
+    return None
+
+
+def _probe_heif_meta(file, end: int) -> tuple | None:
+    primary = None
+    properties = []
+    associations = {}
+
+    for box_type, start, box_end in _iter_boxes(file, end):
+        if box_type == b'pitm':
+            version = file.read(4)[0]
+            item_format = '>H' if version == 0 else '>I'
+            primary, = struct.unpack(
+                item_format, file.read(struct.calcsize(item_format)))
+        elif box_type == b'iprp':
+            for iprp_type, _, iprp_end in _iter_boxes(file, box_end):
+                if iprp_type == b'ipco':
+                    properties = _read_heif_properties(file, iprp_end)
+                elif iprp_type == b'ipma':
+                    _read_heif_associations(file, associations)
+
+    dimensions, rotation = None, 0
+    for index in associations.get(primary, []):
+        if not 0 < index <= len(properties):
+            continue
+        kind, value = properties[index - 1]
+        if kind == b'ispe':
+            dimensions = value
+        elif kind == b'irot':
+            rotation = value
+
+    if dimensions is None:
+        return None
+    # Decoders apply the rotation, so do we
+    if rotation in (1, 3):
+        return dimensions[::-1]
+    return dimensions
+
+
+def _read_heif_properties(file, end: int) -> list:
+    properties = []
+    for box_type, _, _ in _iter_boxes(file, end):
+        value = None
+        if box_type == b'ispe':
+            file.read(4)
+            value = struct.unpack('>II', file.read(8))
+        elif box_type == b'irot':
+            value = file.read(1)[0] & 0b11
+        properties.append((box_type, value))
+    return properties
+
+
+def _read_heif_associations(file, associations: dict):
+    version = file.read(1)[0]
+    flags = int.from_bytes(file.read(3), 'big')
+    item_format = '>H' if version < 1 else '>I'
+    entry_count, = struct.unpack('>I', file.read(4))
+    for _ in range(entry_count):
+        item_id, = struct.unpack(
+            item_format, file.read(struct.calcsize(item_format)))
+        count = file.read(1)[0]
+        indexes = associations.setdefault(item_id, [])
+        for _ in range(count):
+            if flags & 1:
+                value, = struct.unpack('>H', file.read(2))
+                indexes.append(value & 0x7FFF)
+            else:
+                indexes.append(file.read(1)[0] & 0x7F)
@@ -0,0 +1,63 @@
+class EncodeProfile:
+    """Named HEIF encoder settings
+
+    `chroma` is the subsampling (420, 422 or 444), `speed` is handed to
+    the encoder as heic:speed from 0, slowest, to 9, fastest, and
+    `depth` is the bit depth per channel
+    """
+
+    def __init__(self, name: str, quality: int, chroma: str = '420', speed: int = 5, depth: int = 8):
+        self.name = name
+        self.quality = quality
+        self.chroma = str(chroma)
+        self.speed = speed
+        self.depth = depth
+
+    def __repr__(self):
+        return (f'EncodeProfile({self.name!r}, quality={self.quality}, '
+                f'chroma={self.chroma}, speed={self.speed}, depth={self.depth})')
+
+    def apply(self, image):
+        """Set the encoder options of a Wand image before its encode"""
+        image.compression_quality = self.quality
+        image.depth = self.depth
+        image.options['heic:chroma'] = self.chroma
+        image.options['heic:speed'] = str(self.speed)
+
+
+class ProfileSelector:
+    """Picks the encode profile of a picture
+
+    A requested profile wins, otherwise the first `by_size` rule whose
+    long edge limit fits the picture applies, None being no limit.
+    Selectors are picklable, they travel to the engine workers with jobs
+    """
+
+    def __init__(self, profiles: dict, by_size: tuple):
+        self.profiles = {
+            name: EncodeProfile(name, **options)
+            for name, options in profiles.items()}
+        self.by_size = tuple(by_size)
+
+    def get(self, name: str) -> EncodeProfile:
+        try:
+            return self.profiles[name]
+        except KeyError:
+            raise ValueError(
+                f'Unknown encode profile {name}, choose from {", ".join(self.profiles)}')
+
+    def select(self, width: int, height: int, name: str = None) -> EncodeProfile:
+        if name:
+            return self.get(name)
+        for limit, profile in self.by_size:
+            if limit is None or max(width, height) <= limit:
+                return self.get(profile)
+        return self.get(self.by_size[-1][1])
+
+
+def get_profiles() -> ProfileSelector:
+    """Selector configured from Django settings"""
+    from django.conf import settings
+    return ProfileSelector(
+        settings.HEIFMGUR_ENCODE_PROFILES,
+        settings.HEIFMGUR_ENCODE_PROFILE_BY_SIZE)
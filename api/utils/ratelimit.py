@@ -0,0 +1,118 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+# Share of consume() calls that also purge the buckets refilled long ago
+PURGE_PROBABILITY = 0.001
+
+
+class BucketStore:
+    """Token buckets, one per key, refilled continuously
+
+    A bucket holds up to `capacity` tokens and gains `capacity` tokens per
+    `period` seconds. A charge is let through when the bucket holds the
+    cost, or is full for costs over the capacity, and then takes the whole
+    cost, possibly leaving the bucket in debt
+    """
+
+    def consume(self, key: str, cost: float, capacity: float, period: float) -> float:
+        """Charge a bucket, returns 0 if allowed or the seconds to wait"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _charge(tokens: float, elapsed: float, cost: float, capacity: float, period: float) -> tuple:
+        """(tokens left, seconds to wait) of a bucket holding `tokens` `elapsed` seconds ago"""
+        rate = capacity / period
+        tokens = min(capacity, tokens + elapsed * rate)
+        needed = min(cost, capacity)
+        if tokens < needed:
+            return tokens, (needed - tokens) / rate
+        return tokens - cost, 0
+
+
+class MemoryBucketStore(BucketStore):
+    """Buckets of this process only, for tests and single process servers"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, cost: float, capacity: float, period: float) -> float:
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, wait = self._charge(tokens, now - updated, cost, capacity, period)
+            self._buckets[key] = (tokens, now)
+        return wait
+
+
+class SQLiteBucketStore(BucketStore):
+    """Buckets in a SQLite file shared by every process of the host
+
+    Each charge is a single immediate transaction, so concurrent workers
+    never lose an update. Buckets back to full are purged now and then
+    """
+
+    def __init__(self, path: str, timeout: float = 5):
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections are not shared across threads nor forked processes
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                'key TEXT PRIMARY KEY, tokens REAL, updated REAL, full REAL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def consume(self, key: str, cost: float, capacity: float, period: float) -> float:
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, wait = self._charge(tokens, now - updated, cost, capacity, period)
+            full = now + (capacity - tokens) * period / capacity
+            connection.execute(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated, full) '
+                'VALUES (?, ?, ?, ?)', (key, tokens, now, full))
+            if random.random() < PURGE_PROBABILITY:
+                connection.execute('DELETE FROM buckets WHERE full < ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+_store = None
+_store_options = None
+
+
+def get_throttle_store() -> BucketStore:
+    """Bucket store configured by HEIFMGUR_THROTTLE_STORE"""
+
+    global _store, _store_options
+    from django.conf import settings
+    options = settings.HEIFMGUR_THROTTLE_STORE
+    if _store is None or options is not _store_options:
+        _store = import_string(options['BACKEND'])(**options.get('OPTIONS', {}))
+        _store_options = options
+    return _store
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import re
+import secrets
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+from django.utils.module_loading import import_string
+
+from .cache import DIGEST_CHUNK_SIZE, file_digest, stream_digest
+
+# ab/cd/<sha256>-<token>.ext
+CONTENT_NAME = re.compile(
+    r'^(?P<fan>[0-9a-f]{2}/[0-9a-f]{2})/(?P<digest>[0-9a-f]{64})-[0-9a-f]+(\.\w+)?$')
+
+
+def content_digest(name: str) -> str | None:
+    """SHA-256 of a file stored by ContentAddressedStorage, from its name"""
+    match = CONTENT_NAME.match(name or '')
+    return match['digest'] if match else None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Local object store laying files out by the SHA-256 of their content
+
+    Every content is stored once, as objects/ab/cd/<sha256>. A saved file
+    is a hardlink ab/cd/<sha256>-<token>.ext to its object, so identical
+    files take the space of one and deleting a name never affects the
+    others. An object goes away with its last name. Objects are written
+    to a temporary file, flushed with `fsync` and linked into place, so
+    that readers never see a partial file and a concurrent write of the
+    same content is harmless. Names not in this layout, e.g. files stored
+    before, are handled like FileSystemStorage does
+    """
+
+    def __init__(self, location=None, base_url=None, fsync: bool = True, **kwargs):
+        super().__init__(location, base_url, **kwargs)
+        self.fsync = fsync
+
+    def get_available_name(self, name, max_length=None):
+        # Names are unique by construction, see _save()
+        return name
+
+    def object_path(self, digest: str) -> str:
+        return self.path(os.path.join('objects', digest[:2], digest[2:4], digest))
+
+    def _save(self, name, content):
+        directory = self.path(os.path.join('objects', 'tmp'))
+        os.makedirs(directory, exist_ok=True)
+
+        # Encoder outputs already are files of their own, link them as is
+        source = None
+        if hasattr(content, 'temporary_file_path'):
+            source = content.temporary_file_path()
+            if os.stat(source).st_dev != os.stat(directory).st_dev:
+                source = None
+
+        digest = hashlib.sha256()
+        temporary = None
+        try:
+            if source:
+                with open(source, 'rb') as file:
+                    while chunk := file.read(DIGEST_CHUNK_SIZE):
+                        digest.update(chunk)
+                    if self.fsync:
+                        os.fsync(file.fileno())
+            else:
+                fd, temporary = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'wb') as file:
+                    content.seek(0)
+                    for chunk in content.chunks(DIGEST_CHUNK_SIZE):
+                        digest.update(chunk)
+                        file.write(chunk)
+                    if self.fsync:
+                        file.flush()
+                        os.fsync(file.fileno())
+                source = temporary
+            digest = digest.hexdigest()
+
+            _, extension = os.path.splitext(name)
+            name = f'{digest[:2]}/{digest[2:4]}/{digest}-{secrets.token_hex(4)}{extension.lower()}'
+            self._link(source, digest, self.path(name))
+        finally:
+            if temporary:
+                os.unlink(temporary)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(self.path(name), self.file_permissions_mode)
+        return name
+
+    def _link(self, source: str, digest: str, path: str):
+        """Link `path` to the object of `digest`, storing it from `source` if new"""
+
+        target = self.object_path(digest)
+        for directory in (os.path.dirname(target), os.path.dirname(path)):
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            try:
+                # Linking never replaces an existing object
+                os.link(source, target)
+            except FileExistsError:
+                pass
+            else:
+                if self.fsync:
+                    self._fsync_directory(os.path.dirname(target))
+            try:
+                os.link(target, path)
+            except FileNotFoundError:
+                # The last name of the object was just deleted
+                continue
+            break
+        if self.fsync:
+            self._fsync_directory(os.path.dirname(path))
+
+    @staticmethod
+    def _fsync_directory(directory: str):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def delete(self, name):
+        digest = content_digest(name)
+        super().delete(name)
+        if not digest:
+            return
+        target = self.object_path(digest)
+        try:
+            if os.stat(target).st_nlink <= 1:
+                os.unlink(target)
+        except FileNotFoundError:
+            pass
+
+
+def local_path(file) -> str | None:
+    """Filesystem path of a stored file, None for remote storages"""
+
+    try:
+        return file.path
+    except NotImplementedError:
+        return None
+
+
+@contextmanager
+def local_copy(file):
+    """Path of a stored file, downloaded to a temporary file if remote"""
+
+    path = local_path(file)
+    if path is not None:
+        yield path
+        return
+    _, extension = os.path.splitext(file.name)
+    with tempfile.NamedTemporaryFile(suffix=extension) as copy:
+        with file.storage.open(file.name, 'rb') as remote:
+            shutil.copyfileobj(remote, copy, DIGEST_CHUNK_SIZE)
+        copy.flush()
+        yield copy.name
+
+
+def get_storage():
+    """Storage of the pictures configured by HEIFMGUR_STORAGE
+
+    Any Django storage fits, e.g. an S3 compatible one
+    """
+
+    from django.conf import settings
+    options = settings.HEIFMGUR_STORAGE
+    return import_string(options['BACKEND'])(**options.get('OPTIONS', {}))
+
+
+def stored_digest(file) -> str:
+    """SHA-256 of a stored file, from its name when the storage allows"""
+
+    digest = content_digest(file.name)
+    if digest:
+        return digest
+    path = local_path(file)
+    if path is not None:
+        return file_digest(path)
+    with file.storage.open(file.name, 'rb') as remote:
+        return stream_digest(remote)
@@ -0,0 +1,194 @@
+from .engine import get_engine
+from .img import (RENDER_CONTENT_TYPES, WandImage, decode, django_file, encode,
+                  parse_file_name)
+from .metrics import stage
+from .profiles import ProfileSelector, get_profiles
+
+MAX_DIMENSION = 4000
+MAX_OPERATIONS = 16
+
+
+class TransformError(ValueError):
+    """Transform spec is invalid or cannot be applied to an image"""
+
+
+def _integer(step: dict, name: str, minimum: int, maximum: int = MAX_DIMENSION,
+             required: bool = True) -> int | None:
+    value = step.get(name)
+    if value is None:
+        if required:
+            raise TransformError(f'{step["op"]} needs {name}')
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise TransformError(f'{step["op"]} {name} must be an integer')
+    try:
+        value = int(value)
+    except ValueError:
+        raise TransformError(f'{step["op"]} {name} must be an integer')
+    if not minimum <= value <= maximum:
+        raise TransformError(
+            f'{step["op"]} {name} must be between {minimum} and {maximum}')
+    return value
+
+
+class TransformSpec:
+    """Validated and hashable pipeline of image operations
+
+    Pixel operations run in order on a single decode, `format` and
+    `quality` apply to the single final encode. Equal pipelines have
+    the same canonical `key`, which identifies their result
+    """
+
+    OPERATIONS = ('resize', 'crop', 'rotate', 'orient', 'strip')
+
+    def __init__(self, operations: tuple = (), format: str = None, quality: int = None):
+        self.operations = tuple(operations)
+        self.format = format
+        self.quality = quality
+
+    @classmethod
+    def from_operations(cls, steps: list) -> 'TransformSpec':
+        """Validate a list of steps like {"op": "resize", "width": 800}"""
+
+        if not steps:
+            raise TransformError('Please provide at least one operation')
+        if len(steps) > MAX_OPERATIONS:
+            raise TransformError(f'At most {MAX_OPERATIONS} operations are allowed')
+
+        operations = []
+        format = quality = None
+        for step in steps:
+            if not isinstance(step, dict) or 'op' not in step:
+                raise TransformError('Every operation needs an "op"')
+            op = step['op']
+            if op == 'resize':
+                width = _integer(step, 'width', 1, required=False)
+                height = _integer(step, 'height', 1, required=False)
+                if not width and not height:
+                    raise TransformError('resize needs a width, a height or both')
+                operations.append(('resize', width, height))
+            elif op == 'crop':
+                operations.append((
+                    'crop',
+                    _integer(step, 'left', 0),
+                    _integer(step, 'top', 0),
+                    _integer(step, 'width', 1),
+                    _integer(step, 'height', 1)))
+            elif op == 'rotate':
+                degrees = _integer(step, 'degrees', -360, 360) % 360
+                if degrees:
+                    operations.append(('rotate', degrees))
+            elif op in ('orient', 'strip'):
+                operations.append((op,))
+            elif op == 'format':
+                format = str(step.get('format', '')).lower()
+                if format not in RENDER_CONTENT_TYPES:
+                    raise TransformError(
+                        f'format must be one of {", ".join(RENDER_CONTENT_TYPES)}')
+            elif op == 'quality':
+                quality = _integer(step, 'quality', 1, 100)
+            else:
+                raise TransformError(
+                    f'Unknown operation {op}, choose from '
+                    f'{", ".join(cls.OPERATIONS + ("format", "quality"))}')
+
+        spec = cls(operations, format, quality)
+        if not spec.key:
+            raise TransformError('The operations leave the image unchanged')
+        return spec
+
+    @property
+    def key(self) -> str:
+        """Canonical form, e.g. resize:800x/crop:0,0,400,300/format:webp"""
+
+        parts = []
+        for name, *args in self.operations:
+            if name == 'resize':
+                width, height = args
+                parts.append(f'resize:{width or ""}x{height or ""}')
+            elif args:
+                parts.append(f'{name}:{",".join(str(arg) for arg in args)}')
+            else:
+                parts.append(name)
+        if self.format:
+            parts.append(f'format:{self.format}')
+        if self.quality:
+            parts.append(f'quality:{self.quality}')
+        return '/'.join(parts)
+
+    def __eq__(self, other):
+        return isinstance(other, TransformSpec) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f'TransformSpec({self.key!r})'
+
+    def apply(self, image: WandImage) -> WandImage:
+        """Run the pipeline on an image, decoding it once"""
+
+        for name, *args in self.operations:
+            width, height = image.image.size
+            if name == 'resize':
+                new_width, new_height = args
+                if not new_width:
+                    new_width = max(1, round(width * new_height / height))
+                if not new_height:
+                    new_height = max(1, round(height * new_width / width))
+                image.call_method(method='resize', width=new_width, height=new_height)
+            elif name == 'crop':
+                left, top, crop_width, crop_height = args
+                if left + crop_width > width or top + crop_height > height:
+                    raise TransformError(
+                        f'Crop {crop_width}x{crop_height}+{left}+{top} '
+                        f'is outside of the {width}x{height} image')
+                image.call_method(
+                    method='crop', left=left, top=top,
+                    width=crop_width, height=crop_height)
+            elif name == 'rotate':
+                image.call_method(method='rotate', degree=args[0])
+            elif name == 'orient':
+                image.call_method(method='auto_orient')
+            elif name == 'strip':
+                image.call_method(method='strip')
+
+        if self.format:
+            image.convert_to(self.format)
+        if self.quality:
+            image.image.compression_quality = self.quality
+        return image
+
+
+def _job_transform(data: bytes, spec: TransformSpec = None, sizes: tuple = (),
+                   profiles: ProfileSelector = None) -> tuple:
+    """Engine job: run a transform pipeline with one decode and one encode
+
+    Renditions of `sizes` are downscaled from the transformed pixels.
+    Returns the blobs, transformed picture first, along with its format
+    and the sizes of the renditions
+    """
+    image = decode(WandImage(blob=data))
+    with stage('transform'):
+        spec.apply(image)
+    blobs = [encode(image.image)]
+    renditions = list(image.renditions(sizes, profiles))
+    blobs.extend(encode(rendition.image) for _, rendition in renditions)
+    return blobs, (image.format, [size for size, _ in renditions])
+
+
+def transform_image(path: str, spec: TransformSpec, sizes: tuple = ()) -> tuple:
+    """Transformed copy of an image file and its renditions as Django files
+
+    Returns the picture and a list of (size, picture)
+    """
+    with open(path, 'rb') as file:
+        blobs, (format, rendition_sizes) = get_engine().run(
+            _job_transform, file.read(), spec=spec, sizes=tuple(sizes),
+            profiles=get_profiles())
+    name = parse_file_name(path)
+    picture = django_file(blobs.pop(0), f'{name}.{format.lower()}')
+    renditions = [
+        (size, django_file(blob, f'{name}_{size}.heif'))
+        for size, blob in zip(rendition_sizes, blobs)]
+    return picture, renditions
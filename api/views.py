@@ -1,93 +1,457 @@
+from functools import update_wrapper
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.shortcuts import get_object_or_404
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
+from .ingest import Ingestor, upload_item, url_item
+from .lineage import (EXPANSIONS, LIST_FIELDS, attach_ancestors,
+                      compact_renditions, expand_queryset, expanded_images)
 from .models import Image
-from .serializers import (ImageResizeSerializer, ImageSerializer,
+from .pagination import ImagePagination
+from .serializers import (ImageBatchSerializer, ImageListSerializer,
+                          ImageRenderSerializer, ImageResizeSerializer,
+                          ImageSerializer, ImageTransformSerializer,
                           ImageUpdateSerializer)
+from .tasks import (derive_image, find_duplicate, process_image,
+                    release_files, share_picture)
 from .throttlers import *
-from .utils.img import Util
+from .utils.cache import RenderCache, stream_digest
+from .utils.engine import EngineError, EngineTimeout
+from .utils.http import (IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL,
+                         guess_content_type, serve_file)
+from .utils.img import RENDER_CONTENT_TYPES, Util
+from .utils.metrics import REGISTRY, stage
+from .utils.storage import local_copy, local_path, stored_digest
+from .utils.transform import TransformError, TransformSpec, transform_image
 
 
 class ImageViewSet(viewsets.ModelViewSet):
-    queryset = Image.objects.all()
+    queryset = Image.objects.prefetch_related('renditions')
+    pagination_class = ImagePagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Load only the columns the compact list serializer needs
+        if self.action == 'list':
+            queryset = Image.objects.only(*LIST_FIELDS).prefetch_related(
+                compact_renditions())
+        if self.action in ('list', 'retrieve'):
+            queryset = expand_queryset(queryset, self.expand)
+        return queryset
+
+    @property
+    def expand(self) -> set:
+        """Relatives requested inline with ?expand=parent,children,ancestors"""
+
+        value = self.request.query_params.get('expand', '')
+        expand = {name.strip() for name in value.split(',') if name.strip()}
+        unknown = expand.difference(EXPANSIONS)
+        if unknown:
+            raise ValidationError(
+                {'expand': f'Unknown expansion {", ".join(sorted(unknown))}, '
+                           f'choose from {", ".join(EXPANSIONS)}'})
+        return expand
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ('list', 'retrieve'):
+            context['expand'] = self.expand
+        return context
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None and 'ancestors' in self.expand:
+            attach_ancestors(page)
+        return page
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        with stage('validate'):
+            serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        return self.created_response(serializer)
+
+    def created_response(self, serializer) -> Response:
+        """Respond with 202 when the conversion is left to the workers"""
+
+        response = Response(
+            serializer.data,
+            status=status.HTTP_201_CREATED,
+            headers=self.get_success_headers(serializer.data))
+        if response.data.get('status') == Image.Status.PENDING:
+            response.status_code = status.HTTP_202_ACCEPTED
+        elif response.data.get('status') == Image.Status.FAILED:
+            response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        return response
 
     def perform_create(self, serializer):
-        """Download image via URL
-        and automatically assign a name if it is not given"""
+        """Store the uploaded or URL fetched image as a pending Image
+
+        It is converted inline or by the conversion workers,
+        a name is automatically assigned if it is not given
+        """
+
+        image = serializer.validated_data.pop('picture', None)
+        with stage('digest'):
+            digest = stream_digest(image)
+
+        instance = self.save_created(serializer, image, digest)
+        if instance is not None and not settings.HEIFMGUR_ASYNC_CONVERSION:
+            process_image(instance)
+
+    def save_created(self, serializer, image, digest: str) -> Image | None:
+        """Save the new Image, returned when it still has to be converted"""
 
         new_data = serializer.validated_data
-        new_data._mutable = True
-        name = new_data.get('name')
-        url = new_data.get('url')
-        image = new_data.get('picture')
-
-        if image:
-            img_ext = Util.parse_file_extension(image.name)
-            if img_ext not in ['heic', 'heif']:
-                image = Util.convert_to_heic(image, django=True)
-                new_data['picture'] = image
-            if not name:
-                new_data['name'] = image.name
-
-        if url:
-            image = Util.download_img(url, django=True, to_heif=True)
-            new_data['picture'] = image
-            if not name:
-                new_data['name'] = image.name
-
-        new_data._mutable = False
-        serializer.save(**new_data)
+        # Identical bytes were already converted, reuse their files
+        original = find_duplicate(digest, profile=new_data.get('profile', ''))
+        if original:
+            instance = serializer.save(digest=digest, **new_data)
+            share_picture(instance, original)
+            return None
+
+        # Images converted inline are claimed right away, workers skip them
+        initial = (Image.Status.PENDING if settings.HEIFMGUR_ASYNC_CONVERSION
+                   else Image.Status.PROCESSING)
+        with stage('store'):
+            return serializer.save(
+                source=image,
+                digest=digest,
+                status=initial,
+                **new_data)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Image detail with validators for conditional requests"""
+
+        image = self.get_object()
+        expand = self.expand
+        if 'ancestors' in expand:
+            attach_ancestors([image])
+        # Expanded relatives are part of the representation and its validators
+        versions = [image, *expanded_images(image, expand)]
+        etag = 'W/"{}"'.format('.'.join([
+            *sorted(expand),
+            *(f'{relative.pk}-{relative.version}' for relative in versions)]))
+        last_modified = int(max(
+            relative.date_updated for relative in versions).timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = Response(self.get_serializer(image).data)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+        return response
 
     def destroy(self, request, **kwargs):
         image = self.get_object()
         try:
-            image.picture.delete(save=False)
+            release_files(image)
         except:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         self.perform_destroy(image)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        """@action ingesting many uploaded files and URLs at once
+
+        Rows are inserted in bulk and converted in parallel, or left to
+        the conversion workers. Responds with the result of every item
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = [
+            *(upload_item(file) for file in serializer.validated_data['pictures']),
+            *(url_item(url) for url in serializer.validated_data['urls'])]
+
+        queue = settings.HEIFMGUR_ASYNC_CONVERSION
+        results = Ingestor(
+            batch_size=settings.HEIFMGUR_BATCH_MAX_ITEMS,
+            queue=queue,
+            profile=serializer.validated_data['profile'],
+            charge=lambda file: charge_megapixels(request, self, file)).run(items)
+        return Response(
+            {'results': results},
+            status=status.HTTP_202_ACCEPTED if queue else status.HTTP_201_CREATED)
+
     @action(detail=True, methods=['post'])
     def resize(self, request, pk=None):
-        """@action for resizing image"""
+        """@action deriving a resized child Image
+
+        The original is never modified. Children are always derived from
+        the root original and an identical request returns the existing
+        child without decoding anything
+        """
 
         image = self.get_object()
-        serializer = serializer = self.get_serializer(
-            image, data=request.data, partial=True)
+        if image.status != Image.Status.READY:
+            return Response(
+                {'error': f'Image is {image.status}, try again later'},
+                status=status.HTTP_409_CONFLICT)
+        serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        new_dimensions = (
-            int(request.data['width']),
-            int(request.data['height']))
-        image_path = image.picture.path
-        image_name = Util.parse_file_name(
-            image.picture.name, ext=True)
-        new_image = Util.resize_image(
-            image_path, *new_dimensions, django=True)
-        image.picture.delete(save=False)
-        image.picture.save(image_name, new_image)
-
-        self.perform_update(serializer)
+        spec = TransformSpec([(
+            'resize',
+            serializer.validated_data['width'],
+            serializer.validated_data['height'])])
+        return self.derive(image, spec)
+
+    @action(detail=True, methods=['post'])
+    def transform(self, request, pk=None):
+        """@action deriving a child Image through a transform pipeline
+
+        The operations run with a single decode and a single encode of
+        the root original, identical pipelines return the existing child
+        """
+
+        image = self.get_object()
+        if image.status != Image.Status.READY:
+            return Response(
+                {'error': f'Image is {image.status}, try again later'},
+                status=status.HTTP_409_CONFLICT)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.derive(image, serializer.validated_data['spec'])
+
+    def derive(self, image: Image, spec: TransformSpec) -> Response:
+        """Respond with the child of an Image for a transform spec"""
+
+        try:
+            child, created = derive_image(
+                image, spec.key,
+                lambda path: transform_image(path, spec, settings.HEIFMGUR_RENDITION_SIZES))
+        except EngineTimeout as error:
+            return Response(
+                {'error': str(error)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except (EngineError, TransformError) as error:
+            return Response(
+                {'error': str(error)},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
         return Response(
-            serializer.data,
-            status=status.HTTP_201_CREATED)
+            ImageSerializer(child, context=self.get_serializer_context()).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'], url_path='render')
+    def render_image(self, request, pk=None):
+        """@action for on-the-fly resized copies of an image
+
+        Derived images are served from the render cache,
+        the original is never modified
+        """
+
+        image = self.get_object()
+        if image.status != Image.Status.READY:
+            return Response(
+                {'error': f'Image is {image.status}, try again later'},
+                status=status.HTTP_409_CONFLICT)
+        serializer = ImageRenderSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        def render():
+            with local_copy(image.picture) as source_path:
+                return Util.render_image(
+                    source_path, params.get('w'), params.get('h'), params['fmt'])
+
+        cache = RenderCache(
+            settings.HEIFMGUR_RENDER_CACHE_DIR,
+            settings.HEIFMGUR_RENDER_CACHE_MAX_SIZE)
+        key = RenderCache.key(stored_digest(image.picture), **params)
+        try:
+            file = cache.open_or_create(key, params['fmt'], render)
+        except EngineError as error:
+            return Response(
+                {'error': str(error)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return FileResponse(
+            file,
+            content_type=RENDER_CONTENT_TYPES[params['fmt']])
+
+    @action(detail=True, methods=['get'], url_path='picture')
+    def serve_picture(self, request, pk=None):
+        """@action serving the picture file, or one of its renditions
+        with ?size=, with HTTP caching
+
+        URLs carrying the current ?v= version are cached as immutable,
+        others are revalidated with a strong ETag of the file content.
+        Pictures in remote storages are redirected to
+        """
+
+        image, picture = self.get_picture(request)
+        if image is None:
+            return picture
+        return self.picture_response(request, image, picture, stored_digest(picture))
+
+    def get_picture(self, request) -> tuple:
+        """(Image, picture file) to serve, or (None, error Response)"""
+
+        image = self.get_object()
+        if image.status != Image.Status.READY or not image.picture:
+            return None, Response(
+                {'error': f'Image is {image.status}, try again later'},
+                status=status.HTTP_409_CONFLICT)
+
+        picture = image.picture
+        size = request.query_params.get('size')
+        if size:
+            rendition = None
+            if size.isdigit():
+                rendition = image.renditions.filter(size=size).first()
+            if rendition is None:
+                return None, Response(
+                    {'error': f'No rendition of size {size}'},
+                    status=status.HTTP_404_NOT_FOUND)
+            picture = rendition.picture
+        return image, picture
+
+    def picture_response(self, request, image: Image, picture, digest: str):
+        path = local_path(picture)
+        if path is None:
+            return HttpResponseRedirect(picture.url)
+
+        cache_control = REVALIDATE_CACHE_CONTROL
+        if request.query_params.get('v') == image.version:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+
+        return serve_file(
+            request,
+            path,
+            content_type=guess_content_type(picture.name),
+            etag=f'"{digest}"',
+            last_modified=int(image.date_updated.timestamp()),
+            cache_control=cache_control)
 
     def get_serializer_class(self):
         # Custom serializer for resize
         if self.action == 'resize':
             return ImageResizeSerializer
+        # Custom serializer for transform pipelines
+        if self.action == 'transform':
+            return ImageTransformSerializer
+        # Custom serializer for batch ingestion
+        if self.action == 'batch':
+            return ImageBatchSerializer
         # Custom serializer for update
         if self.action == 'update':
             return ImageUpdateSerializer
+        # Compact serializer for list
+        if self.action == 'list':
+            return ImageListSerializer
         return ImageSerializer
 
     def get_throttles(self):
         if self.action == 'list':
             throttle_classes = [ListThrottleBurst, ListThrottleSustained]
-        elif self.action in ['update', 'partial_update', 'resize', 'create']:
+        elif self.action in ['update', 'partial_update', 'resize', 'transform',
+                             'create', 'batch']:
             throttle_classes = [ActionThrottleBurst, ActionThrottleSustained]
         else:
             throttle_classes = [DetailThrottleBurst, DetailThrottleSustained]
         return [throttle() for throttle in throttle_classes]
+
+
+class AsyncImageViewSet(ImageViewSet):
+    """ImageViewSet with async create and serve_picture for ASGI
+
+    Routes of these actions are async views. URL downloads wait on the
+    event loop, hashing runs in the default executor and the database
+    in the thread of the request, image jobs stay in the engine.
+    The other actions keep running synchronously
+    """
+
+    async_actions = ('create', 'serve_picture')
+    asynchronous = False
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        if not set(actions.values()).intersection(cls.async_actions):
+            return super().as_view(actions, **initkwargs)
+        view = super().as_view(actions, asynchronous=True, **initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+        return update_wrapper(async_view, view)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.asynchronous:
+            return super().dispatch(request, *args, **kwargs)
+        if self.action_map.get(request.method.lower()) in self.async_actions:
+            return self.dispatch_async(request, *args, **kwargs)
+        return sync_to_async(super().dispatch)(request, *args, **kwargs)
+
+    async def dispatch_async(self, request, *args, **kwargs):
+        """dispatch() awaiting the `<action>_async` handler"""
+
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            # Authentication, permissions and throttles may hit the database
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            handler = getattr(self, f'{self.action}_async')
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def create_async(self, request, *args, **kwargs):
+        data = await sync_to_async(lambda: request.data)()
+        fetched = None
+        if data.get('url') and not data.get('picture'):
+            try:
+                fetched = await Util.fetch_img_async(
+                    data['url'],
+                    max_size=settings.HEIFMGUR_URL_MAX_SIZE,
+                    spool_size=settings.HEIFMGUR_URL_SPOOL_SIZE)
+            except DjangoValidationError as error:
+                raise ValidationError(
+                    {'error': 'URL validation error', 'detail': error.messages})
+
+        serializer = self.get_serializer(
+            data=data, context={**self.get_serializer_context(), 'fetched': fetched})
+        with stage('validate'):
+            await sync_to_async(serializer.is_valid)(raise_exception=True)
+
+        image = serializer.validated_data.pop('picture', None)
+        with stage('digest'):
+            digest = await sync_to_async(stream_digest, thread_sensitive=False)(image)
+        instance = await sync_to_async(self.save_created)(serializer, image, digest)
+        if instance is not None and not settings.HEIFMGUR_ASYNC_CONVERSION:
+            await sync_to_async(process_image)(instance)
+        return await sync_to_async(self.created_response)(serializer)
+
+    async def serve_picture_async(self, request, pk=None):
+        image, picture = await sync_to_async(self.get_picture)(request)
+        if image is None:
+            return picture
+        digest = await sync_to_async(stored_digest, thread_sensitive=False)(picture)
+        return self.picture_response(request, image, picture, digest)
+
+
+def metrics(request):
+    """Metrics of every process in the Prometheus text format
+
+    Those of the other processes come from HEIFMGUR_METRICS_DIR
+    """
+
+    return HttpResponse(
+        REGISTRY.render(settings.HEIFMGUR_METRICS_DIR),
+        content_type=REGISTRY.content_type)
@@ -1,9 +1,13 @@
-from api.views import ImageViewSet
+from api.views import AsyncImageViewSet, ImageViewSet
+from django.conf import settings
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
-router.register(r'images', ImageViewSet, basename='images')
+router.register(
+    r'images',
+    AsyncImageViewSet if settings.HEIFMGUR_ASYNC_VIEWS else ImageViewSet,
+    basename='images')
 
 urlpatterns = [
     path('', include(router.urls)),
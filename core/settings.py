@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -131,6 +133,128 @@ STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.ManifestStaticFilesSto
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Storage of pictures and renditions. The default object store lays files
+# out by content hash under MEDIA_ROOT, identical files are hardlinked and
+# fsync makes every write durable before it is visible. Any Django storage
+# fits, e.g. an S3 compatible bucket (MinIO, ...) with django-storages:
+# {'BACKEND': 'storages.backends.s3boto3.S3Boto3Storage', 'OPTIONS': {...}}
+HEIFMGUR_STORAGE = {
+    'BACKEND': 'api.utils.storage.ContentAddressedStorage',
+    'OPTIONS': {'location': MEDIA_ROOT, 'base_url': MEDIA_URL, 'fsync': True},
+}
+
+# Image conversion
+# Uploads are stored as pending Images and encoded to HEIF by
+# `python manage.py convert_images` workers
+HEIFMGUR_ASYNC_CONVERSION = True
+HEIFMGUR_CONVERSION_WORKERS = os.cpu_count() or 1
+HEIFMGUR_CONVERSION_POLL_INTERVAL = 1.0
+HEIFMGUR_CONVERSION_CLAIM_BATCH = 10
+# Seconds after which a job held by a crashed worker is requeued
+HEIFMGUR_CONVERSION_TIMEOUT = 600
+
+# Image engine, CPU heavy Wand and PIL jobs run in a warm pool
+# of worker processes, 0 workers runs them in the calling process
+HEIFMGUR_ENGINE_WORKERS = os.cpu_count() or 1
+# Seconds after which a job is killed
+HEIFMGUR_ENGINE_TIMEOUT = 60
+# Address space limit of every engine worker in bytes
+HEIFMGUR_ENGINE_MEMORY_LIMIT = 4 * 1024 * 1024 * 1024
+
+# Admission of uploads, URLs and ingested files. Dimensions are read from
+# the headers and images over these limits are refused before decoding
+HEIFMGUR_MAX_MEGAPIXELS = 100
+HEIFMGUR_MAX_IMAGE_BYTES = 50 * 1024 * 1024
+# ImageMagick resource limits of every process decoding images, memory and
+# map in bytes, area, width and height in pixels. Pixel caches over the
+# memory limit spill to disk, images over width or height are refused
+HEIFMGUR_MAGICK_LIMITS = {
+    'memory': 512 * 1024 * 1024,
+    'map': 1024 * 1024 * 1024,
+    'area': 128 * 1000 * 1000,
+    'width': 32768,
+    'height': 32768,
+    'thread': 1,
+}
+
+# Animations (GIF, APNG, HEIF sequences) are converted into HEIF image
+# sequences a frame at a time, None keeps them in their own format.
+# Frames over the cap are dropped, it bounds the memory of the encoder
+HEIFMGUR_ANIMATION_FORMAT = 'heif'
+HEIFMGUR_MAX_FRAMES = 300
+
+# Long edges in pixels of the HEIF renditions generated for every upload
+HEIFMGUR_RENDITION_SIZES = (128, 512, 2048)
+
+# HEIF encode profiles. chroma is the subsampling (420, 422 or 444), speed
+# goes to the encoder as heic:speed from 0, slowest, to 9, fastest
+HEIFMGUR_ENCODE_PROFILES = {
+    'fast': {'quality': 60, 'chroma': '420', 'speed': 9, 'depth': 8},
+    'balanced': {'quality': 80, 'chroma': '420', 'speed': 5, 'depth': 8},
+    'archival': {'quality': 95, 'chroma': '444', 'speed': 1, 'depth': 10},
+}
+# Profile of pictures uploaded without one and of all renditions,
+# the first rule whose long edge limit in pixels fits, None is no limit
+HEIFMGUR_ENCODE_PROFILE_BY_SIZE = ((1024, 'fast'), (None, 'balanced'))
+
+# On-the-fly renders, least recently used entries are evicted
+# once the cache grows over its maximum size in bytes
+HEIFMGUR_RENDER_CACHE_DIR = MEDIA_ROOT / 'cache'
+HEIFMGUR_RENDER_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# Streaming ingestion
+# Uploads and URL bodies above the spill size are buffered in temporary
+# files instead of memory. The encoder then reads the source from storage
+# and writes its outputs to temporary files that are moved into MEDIA_ROOT,
+# so a request holds at most HEIFMGUR_SPILL_SIZE bytes of image data,
+# decoded pixels stay in the engine worker (HEIFMGUR_ENGINE_MEMORY_LIMIT)
+HEIFMGUR_STREAMING_INGESTION = True
+HEIFMGUR_SPILL_SIZE = 2621440
+# Kept on the MEDIA_ROOT filesystem so that outputs are renamed, not copied
+HEIFMGUR_ENCODE_TEMP_DIR = MEDIA_ROOT / 'tmp'
+FILE_UPLOAD_MAX_MEMORY_SIZE = HEIFMGUR_SPILL_SIZE
+
+# URL ingestion
+HEIFMGUR_URL_MAX_SIZE = 50 * 1024 * 1024
+HEIFMGUR_URL_SPOOL_SIZE = HEIFMGUR_SPILL_SIZE
+# Seconds to connect, to wait for every read and for a whole download
+HEIFMGUR_URL_CONNECT_TIMEOUT = 5
+HEIFMGUR_URL_READ_TIMEOUT = 15
+HEIFMGUR_URL_TOTAL_TIMEOUT = 120
+# Keep-alive connections per remote host and concurrent downloads
+HEIFMGUR_URL_CONNECTIONS_PER_HOST = 4
+HEIFMGUR_URL_CONCURRENCY = 16
+# Remote hosts whose keep-alive connections are kept, least recently used go first
+HEIFMGUR_URL_MAX_HOSTS = 64
+
+# Levels of parent_picture followed when expanding ancestors
+HEIFMGUR_LINEAGE_MAX_DEPTH = 50
+
+# Bulk ingestion, `POST /api/images/batch/` and `python manage.py ingest_images`
+HEIFMGUR_BATCH_MAX_ITEMS = 100
+HEIFMGUR_INGEST_BATCH_SIZE = 100
+
+# Serve image creation, details and pictures with async views, for
+# deployments on an ASGI server, e.g. `uvicorn core.asgi:application`
+HEIFMGUR_ASYNC_VIEWS = False
+
+# Metrics are exposed on /metrics, requests slower than this many seconds
+# are logged with their per stage breakdown, None disables the log
+HEIFMGUR_SLOW_REQUEST_SECONDS = 2.0
+# Directory where web and conversion worker processes publish their
+# metrics, so that /metrics sums those of every process. Clear it when
+# deploying, None keeps the metrics of every process to itself
+HEIFMGUR_METRICS_DIR = BASE_DIR / 'metrics'
+
+# Throttling. The rates of REST_FRAMEWORK are token buckets shared by every
+# process through this store, a request costs one token plus one for every
+# HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST megapixels it has encoded
+HEIFMGUR_THROTTLE_STORE = {
+    'BACKEND': 'api.utils.ratelimit.SQLiteBucketStore',
+    'OPTIONS': {'path': BASE_DIR / 'throttle.sqlite3'},
+}
+HEIFMGUR_THROTTLE_MEGAPIXELS_PER_REQUEST = 12
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 